@@ -0,0 +1,218 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_TIMEOUT_SECONDS = 1.0
+DEFAULT_RETRY_AFTER_SECONDS = 1
+
+
+class Overloaded(Exception):
+    """Raised when an invocation is not admitted, answered with a 429 and Retry-After"""
+
+    def __init__(self, message, reason, retry_after_seconds):
+        super(Overloaded, self).__init__(message)
+        self.reason = reason
+        self.retry_after_seconds = retry_after_seconds
+
+
+class _Model(object):
+    def __init__(self, condition):
+        self.condition = condition
+        self.in_flight = 0
+        self.queued = 0
+
+
+class AdmissionControl(object):
+    """Concurrency and queue limits per model, of one gunicorn worker.
+
+    At most max_concurrency invocations of a model run at once. Up to max_queue more wait for
+    queue_timeout_seconds at most. Other invocations are rejected right away, so that clients
+    and autoscaling see the overload instead of a growing latency. A max_concurrency of 0
+    disables the limits.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=0,
+        max_queue=0,
+        queue_timeout_seconds=DEFAULT_QUEUE_TIMEOUT_SECONDS,
+        retry_after_seconds=DEFAULT_RETRY_AFTER_SECONDS,
+    ):
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        self._queue_timeout_seconds = queue_timeout_seconds
+        self._retry_after_seconds = retry_after_seconds
+        self._lock = threading.Lock()
+        self._models = {}
+        self._rejected = {"concurrency": 0, "queue_timeout": 0}
+
+    @property
+    def enabled(self):
+        return self._max_concurrency > 0
+
+    def _model(self, model_name):
+        model = self._models.get(model_name)
+        if model is None:
+            model = self._models[model_name] = _Model(self._new_condition())
+        return model
+
+    def _new_condition(self):
+        return threading.Condition(self._lock)
+
+    def _forget_idle(self, model_name, model):
+        # drop the entries of idle models, so that they do not pile up with the model names
+        if model.in_flight == 0 and model.queued == 0 and self._models.get(model_name) is model:
+            del self._models[model_name]
+
+    def _reject(self, model_name, reason):
+        self._rejected[reason] += 1
+        message = (
+            "too many concurrent invocations of model {}".format(model_name)
+            if reason == "concurrency"
+            else "timed out waiting to invoke model {}".format(model_name)
+        )
+        return Overloaded(message, reason, self._retry_after_seconds)
+
+    def _enter(self, model_name):
+        """Admits the invocation, returns None if it must wait, or raises Overloaded"""
+        model = self._model(model_name)
+        if model.in_flight < self._max_concurrency:
+            model.in_flight += 1
+            return model
+        if model.queued >= self._max_queue:
+            raise self._reject(model_name, "concurrency")
+        return None
+
+    @contextmanager
+    def admit(self, model_name):
+        if not self.enabled:
+            yield
+            return
+
+        with self._lock:
+            model = self._enter(model_name)
+            if model is None:
+                model = self._model(model_name)
+                model.queued += 1
+                deadline = time.time() + self._queue_timeout_seconds
+                try:
+                    while model.in_flight >= self._max_concurrency:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise self._reject(model_name, "queue_timeout")
+                        model.condition.wait(remaining)
+                    model.in_flight += 1
+                finally:
+                    model.queued -= 1
+                    self._forget_idle(model_name, model)
+        try:
+            yield
+        finally:
+            with self._lock:
+                model.in_flight -= 1
+                model.condition.notify()
+                self._forget_idle(model_name, model)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrency": self._max_concurrency,
+                "max_queue": self._max_queue,
+                "queue_timeout_seconds": self._queue_timeout_seconds,
+                "rejected": dict(self._rejected),
+                "models": {
+                    name: {"in_flight": model.in_flight, "queued": model.queued}
+                    for name, model in self._models.items()
+                },
+            }
+
+
+class AsyncAdmissionControl(AdmissionControl):
+    """AdmissionControl of the invocations of an asyncio event loop, used by asgi_service"""
+
+    def _new_condition(self):
+        return asyncio.Condition()
+
+    async def admit_async(self, model_name):
+        """Waits until the invocation is admitted and returns a coroutine function releasing it.
+
+        The counters are only changed from the event loop thread, self._lock keeps them
+        consistent with stats().
+        """
+        if not self.enabled:
+            return _release_nothing
+
+        with self._lock:
+            model = self._enter(model_name)
+            if model is not None:
+                return self._releaser(model_name, model)
+            model = self._model(model_name)
+            model.queued += 1
+        try:
+            async with model.condition:
+                await asyncio.wait_for(
+                    model.condition.wait_for(lambda: model.in_flight < self._max_concurrency),
+                    self._queue_timeout_seconds,
+                )
+                with self._lock:
+                    model.in_flight += 1
+        except asyncio.TimeoutError:
+            with self._lock:
+                raise self._reject(model_name, "queue_timeout")
+        finally:
+            with self._lock:
+                model.queued -= 1
+                self._forget_idle(model_name, model)
+        return self._releaser(model_name, model)
+
+    def _releaser(self, model_name, model):
+        async def release():
+            with self._lock:
+                model.in_flight -= 1
+                self._forget_idle(model_name, model)
+            async with model.condition:
+                # a notified waiter may have timed out already, the others check the limit again
+                model.condition.notify_all()
+
+        return release
+
+
+async def _release_nothing():
+    pass
+
+
+def admission_control_from_env(asynchronous=False):
+    max_concurrency = int(os.environ.get("SAGEMAKER_MAX_CONCURRENT_INVOCATIONS_PER_MODEL", 0))
+    max_queue = int(os.environ.get("SAGEMAKER_MAX_QUEUED_INVOCATIONS_PER_MODEL", 0))
+    queue_timeout_seconds = float(
+        os.environ.get("SAGEMAKER_INVOCATION_QUEUE_TIMEOUT_SECONDS", DEFAULT_QUEUE_TIMEOUT_SECONDS)
+    )
+    retry_after_seconds = int(
+        os.environ.get("SAGEMAKER_RETRY_AFTER_SECONDS", DEFAULT_RETRY_AFTER_SECONDS)
+    )
+    if max_concurrency > 0:
+        log.info(
+            "admission control: {} concurrent and {} queued invocations per model".format(
+                max_concurrency, max_queue
+            )
+        )
+    admission_control = AsyncAdmissionControl if asynchronous else AdmissionControl
+    return admission_control(max_concurrency, max_queue, queue_timeout_seconds, retry_after_seconds)
@@ -0,0 +1,386 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import asyncio
+import contextvars
+import functools
+import inspect
+import io
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import aiohttp
+import falcon
+import falcon.asgi
+import grpc
+import requests
+from grpc import aio
+
+import admission_utils
+import cache_utils
+import grpc_utils
+import json_utils
+import python_service
+import session_utils
+import tfs_utils
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# python_service, served by gunicorn's uvicorn worker when SAGEMAKER_GUNICORN_APP is "asgi".
+# Invocations are handled by coroutines with aiohttp and grpc.aio clients for TFS, so a worker
+# holds many requests without a greenlet or thread each. Handlers of inference.py may be
+# coroutines, which can await tfs_predict below; other handlers run in SYNC_EXECUTOR.
+# Model management and /stats reuse the resources of python_service in SYNC_EXECUTOR.
+
+SYNC_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("SAGEMAKER_ASGI_SYNC_THREADS", 32)),
+    thread_name_prefix="sync-handler",
+)
+METRICS = python_service.METRICS
+RESPONSE_CACHE = python_service.RESPONSE_CACHE
+# python_service.ADMISSION_CONTROL, for coroutines
+ADMISSION_CONTROL = admission_utils.admission_control_from_env(asynchronous=True)
+
+
+class AsyncTfsClient(object):
+    """aiohttp session to the TFS REST ports, with at most pool_size connections per port.
+
+    Responses are returned as requests.Response objects, like python_service does, so that
+    output handlers work the same with both services.
+    """
+
+    def __init__(self, pool_size=session_utils.DEFAULT_POOL_SIZE, keep_alive=True):
+        self._pool_size = pool_size
+        self._keep_alive = keep_alive
+        self._session = None
+        self._requests = 0
+
+    def _get_session(self):
+        # created on first use, in the event loop of the worker
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=0, limit_per_host=self._pool_size, force_close=not self._keep_alive
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def get(self, url):
+        return await self._request("GET", url)
+
+    async def post(self, url, data=None):
+        return await self._request("POST", url, data)
+
+    async def _request(self, method, url, data=None):
+        self._requests += 1
+        async with self._get_session().request(method, url, data=data) as response:
+            content = await response.read()
+            return _make_response(
+                response.status, content, response.headers.get("Content-Type", "application/json")
+            )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self):
+        return {
+            "requests": self._requests,
+            "pool_size": self._pool_size,
+            "keep_alive": self._keep_alive,
+        }
+
+
+def tfs_client_from_env():
+    pool_size = int(
+        os.environ.get("SAGEMAKER_TFS_CONNECTION_POOL_SIZE", session_utils.DEFAULT_POOL_SIZE)
+    )
+    keep_alive = os.environ.get("SAGEMAKER_TFS_KEEP_ALIVE", "true").lower() == "true"
+    return AsyncTfsClient(pool_size=pool_size, keep_alive=keep_alive)
+
+
+TFS_CLIENT = tfs_client_from_env()
+# grpc.aio channels by TFS grpc port, created in the event loop of the worker
+_aio_channels = {}
+
+
+def _aio_channel(grpc_port):
+    if grpc_port not in _aio_channels:
+        log.info("Creating grpc.aio channel for port: %s", grpc_port)
+        _aio_channels[grpc_port] = aio.insecure_channel(tfs_utils.grpc_target(grpc_port))
+    return _aio_channels[grpc_port]
+
+
+def _make_response(status, content, content_type="application/json"):
+    response = requests.models.Response()
+    response.status_code = int(str(status).split()[0])
+    response.headers["Content-Type"] = content_type
+    response._content = content
+    return response
+
+
+async def run_sync(function, *args):
+    """Runs a blocking function in SYNC_EXECUTOR, in the context of the calling task, so that
+    its TFS calls are accounted to the invocation
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(
+        SYNC_EXECUTOR, functools.partial(context.run, function, *args)
+    )
+
+
+async def default_handler(data, context):
+    response = await tfs_predict(data, context)
+    return response.content, context.accept_header
+
+
+async def converter_handler(data, context):
+    request = tfs_utils.convert_request(data.read(), context.request_content_type)
+    json_context = context._replace(request_content_type="application/json")
+    if isinstance(request, bytes):
+        response = await tfs_predict(request, json_context)
+    else:
+        response = await tfs_predict_instances(request, json_context)
+    return python_service.converted_response(response, context)
+
+
+async def tfs_predict(data, context):
+    """Coroutine sending a TFS request body like python_service.tfs_predict. Async handlers
+    of inference.py can await it.
+
+    :param data: request body (bytes, str, or a file-like object)
+    :param context: context instance that contains tfs_rest_uri
+    :return: requests.Response of the TFS REST API, or an equivalent one built from gRPC
+    """
+    if hasattr(data, "read"):
+        data = data.read()
+    body = data.encode("utf-8") if isinstance(data, str) else data
+    if not python_service.use_response_cache(context):
+        return await _tfs_predict(body, context)
+    key = cache_utils.request_key(context.rest_uri, body)
+    return await _cached_response(key, context, lambda: _tfs_predict(body, context))
+
+
+async def _tfs_predict(body, context):
+    with METRICS.tfs_call(urlsplit(context.rest_uri).port):
+        if python_service.use_grpc(context):
+            response = await _grpc_response(grpc_utils.grpc_predict_async, body, context)
+            if response is not None:
+                return response
+        return await TFS_CLIENT.post(context.rest_uri, data=body)
+
+
+async def tfs_predict_instances(instances, context):
+    """Coroutine sending a numpy array of instances like python_service.tfs_predict_instances"""
+    if python_service.use_response_cache(context):
+        key = cache_utils.request_key(
+            context.rest_uri, str(instances.dtype), str(instances.shape), instances.tobytes()
+        )
+        return await _cached_response(
+            key, context, lambda: _tfs_predict_instances(instances, context)
+        )
+    return await _tfs_predict_instances(instances, context)
+
+
+async def _tfs_predict_instances(instances, context):
+    with METRICS.tfs_call(urlsplit(context.rest_uri).port):
+        if python_service.use_grpc(context):
+            response = await _grpc_response(
+                grpc_utils.grpc_predict_arrays_async, instances, context
+            )
+            if response is not None:
+                return response
+        return await TFS_CLIENT.post(
+            context.rest_uri, data=json_utils.dumps({"instances": instances})
+        )
+
+
+async def _cached_response(key, context, predict):
+    cached = await run_sync(RESPONSE_CACHE.get, key)
+    if cached is not None:
+        status, content = cached
+        return _make_response(status, content)
+    response = await predict()
+    if response.status_code == 200:
+        # named after the model of the URI when no model is given, so that a reload clears it
+        model_name = context.model_name or tfs_utils.uri_model_name(context.rest_uri)
+        await run_sync(RESPONSE_CACHE.put, key, model_name, response.status_code, response.content)
+    return response
+
+
+async def _grpc_response(predict, payload, context):
+    """Returns the response of a grpc.aio predict call, or None to fall back to REST"""
+    aio_context = context._replace(channel=_aio_channel(context.grpc_port))
+    try:
+        content = await predict(payload, aio_context, http=TFS_CLIENT)
+        python_service.count_grpc("predictions")
+        return _make_response(falcon.HTTP_200, content)
+    except grpc_utils.UnsupportedGrpcRequest as e:
+        log.info("falling back to REST: {}".format(e))
+        python_service.count_grpc("rest_fallbacks")
+    except grpc.RpcError as e:
+        python_service.count_grpc("errors")
+        status = python_service.GRPC_ERROR_STATUS.get(e.code(), falcon.HTTP_500)
+        return _make_response(status, json.dumps({"error": e.details()}).encode("utf-8"))
+    return None
+
+
+def _awaitable(function):
+    """Coroutine functions are awaited, other functions run in SYNC_EXECUTOR"""
+    if inspect.iscoroutinefunction(function):
+        return function
+
+    async def _run(*args):
+        return await run_sync(function, *args)
+
+    return _run
+
+
+def make_handler(custom_handler, custom_input_handler, custom_output_handler):
+    if custom_handler:
+        return _awaitable(custom_handler)
+
+    input_handler = _awaitable(custom_input_handler)
+    output_handler = _awaitable(custom_output_handler)
+
+    async def handler(data, context):
+        processed_input = await input_handler(data, context)
+        # input handlers always produce a TFS REST (json) request body
+        json_context = context._replace(request_content_type="application/json")
+        response = await tfs_predict(processed_input, json_context)
+        return await output_handler(response, context)
+
+    return handler
+
+
+class PythonServiceResource(object):
+    """Invocations of python_service.PythonServiceResource, handled by coroutines"""
+
+    def __init__(self, python_service_resource):
+        self._resource = python_service_resource
+        if python_service_resource.inference_handlers:
+            self._handlers = make_handler(*python_service_resource.inference_handlers)
+        elif python_service.TFS_REQUEST_CONVERTER == "python":
+            self._handlers = converter_handler
+        else:
+            self._handlers = default_handler
+
+    async def on_post(self, req, res, model_name=None):
+        if model_name or "invocations" in req.uri:
+            model = None
+            if python_service.SAGEMAKER_MULTI_MODEL_ENABLED:
+                # the models are looked up in the sqlite registry
+                model = await run_sync(self._resource.find_model, model_name)
+            metrics_model_name = self._resource.metrics_model_name(req, model_name, model)
+            with METRICS.invocation(metrics_model_name) as status:
+                try:
+                    release = await ADMISSION_CONTROL.admit_async(metrics_model_name)
+                except admission_utils.Overloaded as e:
+                    python_service.overloaded_response(res, metrics_model_name, e)
+                else:
+                    try:
+                        await self._handle_invocation_post(req, res, model_name, model)
+                    finally:
+                        await release()
+                status[0] = res.status.split()[0]
+        else:
+            data = json_utils.loads(await req.stream.read())
+            await run_sync(self._resource.load_model, res, data)
+
+    async def _handle_invocation_post(self, req, res, model_name=None, model=None):
+        if python_service.SAGEMAKER_MULTI_MODEL_ENABLED:
+            # the access times of the models are recorded in the sqlite registry
+            invocation = await run_sync(
+                self._resource.invocation_context, req, res, model_name, model
+            )
+        else:
+            invocation = self._resource.invocation_context(req, res, model_name)
+        if invocation is None:
+            return
+
+        _, context, route = invocation
+        try:
+            data = io.BytesIO(await req.stream.read())
+            res.status = falcon.HTTP_200
+            res.body, res.content_type = await self._handlers(data, context)
+        except Exception as e:  # pylint: disable=broad-except
+            log.exception("exception handling request: {}".format(e))
+            res.status = falcon.HTTP_500
+            res.body = json.dumps({"error": str(e)}).encode("utf-8")
+        finally:
+            self._resource.release_route(route)
+
+    async def on_get(self, req, res, model_name=None):
+        await run_sync(self._resource.on_get, req, res, model_name)
+
+    async def on_delete(self, req, res, model_name):
+        await run_sync(self._resource.on_delete, req, res, model_name)
+
+
+class PingResource:
+    async def on_get(self, req, res):  # pylint: disable=W0613
+        res.status = falcon.HTTP_200
+
+
+class StatsResource(python_service.StatsResource):
+    """python_service /stats, with the requests of the async TFS client"""
+
+    async def on_get(self, req, res):  # pylint: disable=W0613,W0236
+        await run_sync(super().on_get, req, res)
+        stats = json.loads(res.body)
+        stats["async_tfs_client"] = TFS_CLIENT.stats()
+        if ADMISSION_CONTROL.enabled:
+            stats["admission_control"] = ADMISSION_CONTROL.stats()
+        res.body = json.dumps(stats)
+
+
+class MetricsResource(python_service.MetricsResource):
+    async def on_get(self, req, res):  # pylint: disable=W0613,W0236
+        await run_sync(super().on_get, req, res)
+
+
+class LifespanMiddleware(object):
+    async def process_shutdown(self, scope, event):  # pylint: disable=W0613
+        await TFS_CLIENT.close()
+        for channel in _aio_channels.values():
+            await channel.close()
+
+
+class ServiceResources:
+    def __init__(self):
+        self._enable_model_manager = python_service.SAGEMAKER_MULTI_MODEL_ENABLED
+        # the models, TFS routing and handlers are those of python_service
+        python_service_resource = python_service.resources.python_service_resource
+        self._python_service_resource = PythonServiceResource(python_service_resource)
+        self._ping_resource = PingResource()
+        self._stats_resource = StatsResource(python_service_resource)
+        self._metrics_resource = MetricsResource()
+
+    def add_routes(self, application):
+        application.add_route("/ping", self._ping_resource)
+        application.add_route("/stats", self._stats_resource)
+        application.add_route("/metrics", self._metrics_resource)
+        application.add_route("/invocations", self._python_service_resource)
+
+        if self._enable_model_manager:
+            application.add_route("/models", self._python_service_resource)
+            application.add_route("/models/{model_name}", self._python_service_resource)
+            application.add_route("/models/{model_name}/invoke", self._python_service_resource)
+
+
+app = falcon.asgi.App(middleware=[LifespanMiddleware()])
+resources = ServiceResources()
+resources.add_routes(app)
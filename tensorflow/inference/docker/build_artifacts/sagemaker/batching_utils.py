@@ -0,0 +1,194 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import logging
+import os
+import threading
+
+import requests
+
+import json_utils
+import tfs_utils
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH_SIZE = 32
+DEFAULT_WINDOW_MS = 5
+
+
+class _Batch(object):
+    def __init__(self):
+        self.instances = []
+        # (offset, count) of the instances of each request
+        self.requests = []
+        self.contexts = []
+        self.bodies = []
+        self.responses = None
+        # raised by the send function, re-raised in every request of the batch
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """Coalesces concurrent TFS predict requests of a gunicorn worker into one request.
+
+    The first request of a batch waits for other requests to the same model and signature,
+    for at most window_seconds and until max_batch_size instances are collected. It only waits
+    while a previous batch is still in TFS, so a lone request is sent right away. The
+    predictions are then split back per request. If the batch fails, e.g. because one request
+    is invalid, the requests are sent one by one so that each gets its own response.
+
+    Only request bodies with an "instances" list are batched, others are sent as they are.
+    gunicorn's gevent worker patches threading, so waiting requests do not block each other.
+    """
+
+    def __init__(
+        self, max_batch_size=DEFAULT_MAX_BATCH_SIZE, window_seconds=DEFAULT_WINDOW_MS / 1000.0
+    ):
+        self._max_batch_size = max_batch_size
+        self._window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._open = {}
+        self._in_flight = {}
+        self._batches = 0
+        self._batched_requests = 0
+
+    def predict(self, body, context, send):
+        """Sends a TFS REST request body, batched with concurrent ones when possible.
+
+        :param body: TFS request body (str or bytes)
+        :param context: tfs_utils.Context of the request
+        :param send: function(body, context) sending a request to TFS, e.g. tfs_predict
+        :return: requests.Response of this request
+        """
+        key, instances = self._batch_key(body, context)
+        if key is None:
+            return send(body, context)
+
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self._open[key] = batch
+            index = len(batch.requests)
+            batch.requests.append((len(batch.instances), len(instances)))
+            batch.instances.extend(instances)
+            batch.contexts.append(context)
+            batch.bodies.append(body)
+            if len(batch.instances) >= self._max_batch_size:
+                self._close(key, batch)
+            busy = self._in_flight.get(key, 0) > 0
+
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.responses[index]
+
+        if busy:
+            batch.full.wait(self._window_seconds)
+        with self._lock:
+            self._close(key, batch)
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        try:
+            batch.responses = self._send_batch(key, batch, send)
+        except Exception as e:  # pylint: disable=broad-except
+            batch.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight[key] -= 1
+                self._batches += 1
+                self._batched_requests += len(batch.requests)
+            batch.done.set()
+        return batch.responses[index]
+
+    def _close(self, key, batch):
+        if self._open.get(key) is batch:
+            del self._open[key]
+        batch.full.set()
+
+    def _batch_key(self, body, context):
+        try:
+            payload = json_utils.loads(body)
+        except (TypeError, ValueError):
+            return None, None
+        if (
+            not isinstance(payload, dict)
+            or not isinstance(payload.get("instances"), list)
+            or set(payload) - {"instances", "signature_name"}
+        ):
+            return None, None
+        # requests are only batched with requests sent the same way, e.g. over the same protocol
+        attributes = tfs_utils.parse_custom_attributes_header(context.custom_attributes)
+        key = (context.rest_uri, payload.get("signature_name"), tuple(sorted(attributes.items())))
+        return key, payload["instances"]
+
+    def _send_batch(self, key, batch, send):
+        if len(batch.requests) == 1:
+            return [send(batch.bodies[0], batch.contexts[0])]
+
+        payload = {"instances": batch.instances}
+        if key[1] is not None:
+            payload["signature_name"] = key[1]
+        try:
+            response = send(json_utils.dumps(payload), batch.contexts[0])
+            predictions = None
+            if response.status_code == 200:
+                predictions = json_utils.loads(response.content).get("predictions")
+        except Exception as e:  # pylint: disable=broad-except
+            log.warning("batched predict failed: {}".format(e))
+            predictions = None
+
+        if not isinstance(predictions, list) or len(predictions) != len(batch.instances):
+            log.info(
+                "sending the {} requests of a failed batch one by one".format(len(batch.requests))
+            )
+            return [send(body, context) for body, context in zip(batch.bodies, batch.contexts)]
+
+        return [
+            _make_response(response, {"predictions": predictions[offset : offset + count]})
+            for offset, count in batch.requests
+        ]
+
+    def stats(self):
+        return {
+            "max_batch_size": self._max_batch_size,
+            "window_ms": round(self._window_seconds * 1000, 3),
+            "batches": self._batches,
+            "requests": self._batched_requests,
+        }
+
+
+def _make_response(batch_response, payload):
+    response = requests.models.Response()
+    response.status_code = batch_response.status_code
+    response.headers["Content-Type"] = "application/json"
+    response._content = json_utils.dumps(payload)
+    return response
+
+
+def micro_batcher_from_env():
+    """Returns a MicroBatcher if SAGEMAKER_MICRO_BATCHING is true, otherwise None"""
+    if os.environ.get("SAGEMAKER_MICRO_BATCHING", "false").lower() != "true":
+        return None
+    max_batch_size = int(os.environ.get("SAGEMAKER_MICRO_BATCH_MAX_SIZE", DEFAULT_MAX_BATCH_SIZE))
+    window_ms = float(os.environ.get("SAGEMAKER_MICRO_BATCH_WINDOW_MS", DEFAULT_WINDOW_MS))
+    log.info(
+        "micro-batching enabled, max batch size: {}, window: {} ms".format(
+            max_batch_size, window_ms
+        )
+    )
+    return MicroBatcher(max_batch_size=max_batch_size, window_seconds=window_ms / 1000.0)
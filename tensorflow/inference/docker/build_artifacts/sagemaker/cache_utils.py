@@ -0,0 +1,213 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from multi_model_utils import SharedState, remove_state
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# tmpfs, so that the cache shared by the gunicorn workers stays in memory
+SHARED_MEMORY_DIR = "/dev/shm"
+DEFAULT_CACHE_FILE = "sagemaker-response-cache.db"
+DEFAULT_MAX_MB = 64
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL_SECONDS = 300
+# lookups are read-only, their counts and access times are written at most this often
+DEFAULT_FLUSH_SECONDS = 1.0
+COUNTERS = ["hits", "misses", "stores", "evictions", "expirations"]
+
+
+def cache_file():
+    cache_dir = SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else "/sagemaker"
+    return os.path.join(cache_dir, DEFAULT_CACHE_FILE)
+
+
+def remove_cache():
+    """Remove the responses of a previous run, called before gunicorn starts"""
+    remove_state(cache_file())
+
+
+def request_key(rest_uri, *parts):
+    """Digest of the model, version and method of a TFS REST URI, and the request payload"""
+    # the host and port differ between the TFS instances serving the same model
+    path = rest_uri.split("/", 3)[-1]
+    digest = hashlib.sha256(path.encode("utf-8"))
+    for part in parts:
+        digest.update(b"\0")
+        digest.update(part.encode("utf-8") if isinstance(part, str) else part)
+    return digest.hexdigest()
+
+
+class ResponseCache(object):
+    """Successful TFS responses by request key, shared by all gunicorn workers.
+
+    Entries expire ttl_seconds after they are stored. The least recently used entries are
+    evicted when the cache holds more than max_bytes of responses or max_entries entries.
+
+    Lookups do not take the write lock of the shared state: the hits, misses and access times
+    of a worker are kept in memory and written with the next put(), or after flush_seconds.
+    """
+
+    def __init__(
+        self,
+        state,
+        max_bytes=DEFAULT_MAX_MB * 1024 * 1024,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        ttl_seconds=DEFAULT_TTL_SECONDS,
+        flush_seconds=DEFAULT_FLUSH_SECONDS,
+    ):
+        self._state = state
+        self._max_bytes = max_bytes
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._lookups = {"hits": 0, "misses": 0}
+        self._accessed = {}
+        self._flushed = time.time()
+        with self._state.transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, model_name TEXT, status INTEGER NOT NULL, "
+                "content BLOB NOT NULL, size INTEGER NOT NULL, expires REAL NOT NULL, "
+                "last_access REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO counters VALUES (?, 0)", [(name,) for name in COUNTERS]
+            )
+
+    def get(self, key):
+        """Returns the (status, content) of a cached response, or None"""
+        now = time.time()
+        rows = self._state.query(
+            "SELECT status, content, expires FROM responses WHERE key = ?", (key,)
+        )
+        # expired responses are removed, and counted, by put()
+        row = rows[0] if rows and rows[0][2] > now else None
+        with self._lock:
+            if row is None:
+                self._lookups["misses"] += 1
+            else:
+                self._lookups["hits"] += 1
+                self._accessed[key] = now
+            flush = now - self._flushed >= self._flush_seconds
+        if flush:
+            self.flush()
+        return None if row is None else (row[0], row[1])
+
+    def flush(self):
+        """Writes the lookups of this worker to the shared state"""
+        with self._state.transaction() as connection:
+            self._write_lookups(connection)
+
+    def _write_lookups(self, connection):
+        with self._lock:
+            lookups, accessed = self._lookups, self._accessed
+            self._lookups, self._accessed = {"hits": 0, "misses": 0}, {}
+            self._flushed = time.time()
+        for name, value in lookups.items():
+            _count(connection, name, value)
+        connection.executemany(
+            "UPDATE responses SET last_access = ? WHERE key = ? AND last_access < ?",
+            [(last_access, key, last_access) for key, last_access in accessed.items()],
+        )
+
+    def put(self, key, model_name, status, content):
+        if len(content) > self._max_bytes:
+            return
+        now = time.time()
+        with self._state.transaction() as connection:
+            self._write_lookups(connection)
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model_name, status, content, len(content), now + self._ttl_seconds, now),
+            )
+            _count(connection, "stores")
+            expired = connection.execute(
+                "DELETE FROM responses WHERE expires <= ?", (now,)
+            ).rowcount
+            _count(connection, "expirations", expired)
+            self._evict(connection)
+
+    def _evict(self, connection):
+        entries, size = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if entries <= self._max_entries and size <= self._max_bytes:
+            return
+        evicted = 0
+        for key, entry_size in connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_access"
+        ).fetchall():
+            if entries <= self._max_entries and size <= self._max_bytes:
+                break
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            entries -= 1
+            size -= entry_size
+            evicted += 1
+        _count(connection, "evictions", evicted)
+
+    def invalidate(self, model_name):
+        """Removes the responses of a model, e.g. when it is unloaded"""
+        with self._state.transaction() as connection:
+            connection.execute("DELETE FROM responses WHERE model_name = ?", (model_name,))
+
+    def stats(self):
+        self.flush()
+        counters = dict(self._state.query("SELECT name, value FROM counters"))
+        entries, size = self._state.query("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses")[
+            0
+        ]
+        lookups = counters["hits"] + counters["misses"]
+        counters.update(
+            {
+                "hit_ratio": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+                "entries": entries,
+                "size_bytes": size,
+                "max_bytes": self._max_bytes,
+                "max_entries": self._max_entries,
+                "ttl_seconds": self._ttl_seconds,
+            }
+        )
+        return counters
+
+
+def _count(connection, name, value=1):
+    if value:
+        connection.execute("UPDATE counters SET value = value + ? WHERE name = ?", (value, name))
+
+
+def response_cache_from_env():
+    """Returns a ResponseCache if SAGEMAKER_RESPONSE_CACHE is true, otherwise None"""
+    if os.environ.get("SAGEMAKER_RESPONSE_CACHE", "false").lower() != "true":
+        return None
+    max_mb = int(os.environ.get("SAGEMAKER_RESPONSE_CACHE_MAX_MB", DEFAULT_MAX_MB))
+    max_entries = int(os.environ.get("SAGEMAKER_RESPONSE_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    ttl_seconds = float(os.environ.get("SAGEMAKER_RESPONSE_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS))
+    return ResponseCache(
+        SharedState(cache_file()),
+        max_bytes=max_mb * 1024 * 1024,
+        max_entries=max_entries,
+        ttl_seconds=ttl_seconds,
+    )
@@ -0,0 +1,190 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import json_utils
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+CANDIDATE_MAX_BATCH_SIZES = [1, 4, 8, 16, 32, 64]
+CANDIDATE_BATCH_TIMEOUTS_MICROS = [0, 500, 1000, 2000, 5000]
+DEFAULT_SIGNATURE_NAME = "serving_default"
+# value of a synthetic input element, by TFS dtype
+SYNTHETIC_VALUES = {
+    "DT_FLOAT": 0.5,
+    "DT_DOUBLE": 0.5,
+    "DT_HALF": 0.5,
+    "DT_BFLOAT16": 0.5,
+    "DT_INT8": 1,
+    "DT_INT16": 1,
+    "DT_INT32": 1,
+    "DT_INT64": 1,
+    "DT_UINT8": 1,
+    "DT_UINT16": 1,
+    "DT_UINT32": 1,
+    "DT_UINT64": 1,
+    "DT_BOOL": False,
+    "DT_STRING": "a",
+}
+
+
+def calibration_key(model_paths, *settings):
+    """Identifies the models and the settings a calibration result is valid for"""
+    digest = hashlib.sha256()
+    for model_path in sorted(model_paths):
+        for version in sorted(v for v in os.listdir(model_path) if v.isnumeric()):
+            saved_model = os.path.join(model_path, version, "saved_model.pb")
+            if os.path.exists(saved_model):
+                stat = os.stat(saved_model)
+                digest.update("{}:{}:{};".format(saved_model, stat.st_size, stat.st_mtime).encode())
+    digest.update(json.dumps(settings).encode())
+    return digest.hexdigest()[:16]
+
+
+def load_calibration(calibration_file, key):
+    """Returns the batching parameters of a previous calibration with the same key, or None"""
+    try:
+        with open(calibration_file, encoding="utf8") as f:
+            calibration = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if calibration.get("key") != key:
+        log.info("ignoring batching calibration of other models or settings")
+        return None
+    return calibration["parameters"]
+
+
+def save_calibration(calibration_file, key, parameters, results):
+    os.makedirs(os.path.dirname(calibration_file), exist_ok=True)
+    tmp_file = "{}.tmp".format(calibration_file)
+    with open(tmp_file, "w", encoding="utf8") as f:
+        json.dump({"key": key, "parameters": parameters, "results": results}, f, indent=2)
+    os.replace(tmp_file, calibration_file)
+
+
+def synthetic_request(rest_port, model_name, signature_name=DEFAULT_SIGNATURE_NAME):
+    """Builds a predict request body with one instance, from the signature of the model"""
+    url = "http://localhost:{}/v1/models/{}/metadata".format(rest_port, model_name)
+    response = requests.get(url)
+    response.raise_for_status()
+    signatures = response.json()["metadata"]["signature_def"]["signature_def"]
+    if signature_name not in signatures:
+        signature_name = sorted(name for name in signatures if not name.startswith("__"))[0]
+
+    inputs = {}
+    for name, tensor in signatures[signature_name]["inputs"].items():
+        shape = tensor.get("tensor_shape", {})
+        if shape.get("unknown_rank") or tensor["dtype"] not in SYNTHETIC_VALUES:
+            raise ValueError(
+                "cannot generate input {} ({}) of signature {}".format(
+                    name, tensor["dtype"], signature_name
+                )
+            )
+        value = SYNTHETIC_VALUES[tensor["dtype"]]
+        # instances do not have the batch dimension, unknown dimensions get size 1
+        for dim in reversed(shape.get("dim", [])[1:]):
+            value = [value] * max(int(dim["size"]), 1)
+        inputs[name] = value
+
+    instance = next(iter(inputs.values())) if len(inputs) == 1 else inputs
+    return json_utils.dumps({"signature_name": signature_name, "instances": [instance]})
+
+
+def measure(rest_ports, model_name, body, concurrency, requests_count):
+    """Sends requests_count requests from concurrency clients, round robin to rest_ports.
+    Returns the throughput in requests per second and the p99 latency in milliseconds.
+    """
+    urls = itertools.cycle(
+        ["http://localhost:{}/v1/models/{}:predict".format(port, model_name) for port in rest_ports]
+    )
+    sessions = threading.local()
+    lock = threading.Lock()
+
+    def _predict(_):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        with lock:
+            url = next(urls)
+        start = time.time()
+        response = sessions.session.post(url, data=body)
+        response.raise_for_status()
+        return time.time() - start
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(_predict, range(requests_count)))
+    seconds = time.time() - start
+    p99 = latencies[min(int(math.ceil(len(latencies) * 0.99)) - 1, len(latencies) - 1)]
+    return {
+        "requests_per_second": round(requests_count / seconds, 1),
+        "p99_ms": round(p99 * 1000, 3),
+    }
+
+
+def best_parameters(results, p99_target_ms):
+    """Highest throughput with a p99 latency within the target, or the lowest p99 latency"""
+    within_target = [result for result in results if result["p99_ms"] <= p99_target_ms]
+    if within_target:
+        return max(within_target, key=lambda result: result["requests_per_second"])
+    log.warning("no batching parameters meet the p99 latency target of {} ms".format(p99_target_ms))
+    return min(results, key=lambda result: result["p99_ms"])
+
+
+def calibrate(run_trial, fixed_parameters, p99_target_ms, deadline=None):
+    """Sweeps max_batch_size with the default timeout, then batch_timeout_micros with the best
+    max_batch_size. fixed_parameters, set by environment variables, are not swept.
+
+    :param run_trial: function(parameters) restarting TFS with the batching parameters and
+        returning the result of measure()
+    :param deadline: time.time() after which no trial is started, the best parameters of the
+        trials run so far are returned
+    :return: the best parameters, and the results of all trials
+    """
+    results = []
+    parameters = {"max_batch_size": 8, "batch_timeout_micros": 1000}
+    parameters.update(fixed_parameters)
+    for key, candidates in [
+        ("max_batch_size", CANDIDATE_MAX_BATCH_SIZES),
+        ("batch_timeout_micros", CANDIDATE_BATCH_TIMEOUTS_MICROS),
+    ]:
+        if key in fixed_parameters:
+            continue
+        sweep = []
+        for candidate in candidates:
+            trial = dict(parameters, **{key: candidate})
+            previous = [result for result in results if result["parameters"] == trial]
+            if previous:
+                sweep.append(previous[0])
+                continue
+            if deadline is not None and time.time() >= deadline:
+                log.warning("batching calibration timed out after {} trials".format(len(results)))
+                if sweep:
+                    parameters = best_parameters(sweep, p99_target_ms)["parameters"]
+                return parameters, results
+            result = dict(run_trial(trial), parameters=trial)
+            log.info("batching calibration trial: {}".format(result))
+            sweep.append(result)
+            results.append(result)
+        parameters = best_parameters(sweep, p99_target_ms)["parameters"]
+    return parameters, results
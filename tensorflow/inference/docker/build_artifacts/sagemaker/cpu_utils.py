@@ -0,0 +1,133 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import glob
+import logging
+import os
+import re
+from collections import namedtuple
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+SYS_CPU_DIR = "/sys/devices/system/cpu"
+SYS_NODE_DIR = "/sys/devices/system/node"
+
+# a logical CPU, and the NUMA node, socket and physical core it belongs to
+Cpu = namedtuple("Cpu", ["node", "package", "core", "cpu"])
+# CPUs of a TFS instance and the matching TensorFlow thread pool sizes
+CpuPartition = namedtuple("CpuPartition", ["cpus", "intra_op_parallelism", "inter_op_parallelism"])
+
+
+def parse_cpu_list(cpu_list):
+    """Parses a kernel CPU list, such as '0-3,8,10-11'"""
+    cpus = set()
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        low, _, high = part.partition("-")
+        cpus.update(range(int(low), int(high or low) + 1))
+    return cpus
+
+
+def _read_int(path, default):
+    try:
+        with open(path, encoding="utf8") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def read_topology(sys_cpu_dir=SYS_CPU_DIR, sys_node_dir=SYS_NODE_DIR):
+    """Returns the CPUs this process may run on, with their NUMA node, socket and core"""
+    nodes = {}
+    for node_dir in glob.glob(os.path.join(sys_node_dir, "node[0-9]*")):
+        node = int(re.search(r"(\d+)$", node_dir).group(1))
+        try:
+            with open(os.path.join(node_dir, "cpulist"), encoding="utf8") as f:
+                for cpu in parse_cpu_list(f.read()):
+                    nodes[cpu] = node
+        except OSError:
+            continue
+
+    topology = []
+    for cpu in sorted(os.sched_getaffinity(0)):
+        topology_dir = os.path.join(sys_cpu_dir, "cpu{}".format(cpu), "topology")
+        package = _read_int(os.path.join(topology_dir, "physical_package_id"), 0)
+        core = _read_int(os.path.join(topology_dir, "core_id"), cpu)
+        topology.append(Cpu(nodes.get(cpu, 0), package, core, cpu))
+    return topology
+
+
+def partition_cpus(topology, instance_count, service_cpu_count):
+    """Splits the physical cores into service_cpu_count logical CPUs for nginx and gunicorn,
+    and instance_count disjoint sets of cores for the TFS instances. Hyper-threads of a core
+    stay in the same set, and an instance only spans NUMA nodes if there are fewer instances
+    than nodes.
+
+    :return: a CpuPartition per TFS instance, and the CPUs of the services; or None if there
+        are fewer physical cores than TFS instances plus one for the services
+    """
+    cores = {}
+    for cpu in sorted(topology):
+        cores.setdefault((cpu.node, cpu.package, cpu.core), []).append(cpu.cpu)
+    cores = [cores[key] for key in sorted(cores)]
+
+    # services get whole cores from the end, usually the last NUMA node
+    service_cpus = []
+    while cores and len(service_cpus) < service_cpu_count:
+        service_cpus = cores.pop() + service_cpus
+    if not service_cpus or len(cores) < instance_count:
+        return None
+
+    node_of = {cpu.cpu: cpu.node for cpu in topology}
+    node_cores = {}
+    for core in cores:
+        node_cores.setdefault(node_of[core[0]], []).append(core)
+    node_cores = [node_cores[node] for node in sorted(node_cores)]
+    if instance_count >= len(node_cores):
+        # no instance spans NUMA nodes, nodes with more cores get more instances
+        node_instances = [1] * len(node_cores)
+        for _ in range(instance_count - len(node_cores)):
+            node = max(range(len(node_cores)), key=lambda n: len(node_cores[n]) / node_instances[n])
+            node_instances[node] += 1
+        groups = zip(node_cores, node_instances)
+    else:
+        groups = [(cores, instance_count)]
+
+    partitions = []
+    for group_cores, group_instances in groups:
+        size = len(group_cores)
+        for i in range(group_instances):
+            instance_cores = group_cores[
+                i * size // group_instances : (i + 1) * size // group_instances
+            ]
+            if not instance_cores:
+                return None
+            cpus = sorted(cpu for core in instance_cores for cpu in core)
+            partitions.append(
+                CpuPartition(
+                    cpus=cpus,
+                    intra_op_parallelism=len(instance_cores),
+                    inter_op_parallelism=len(set(node_of[cpu] for cpu in cpus)),
+                )
+            )
+    return partitions, sorted(service_cpus)
+
+
+def pin_to(cpus):
+    """Returns a Popen preexec_fn restricting the child process to cpus"""
+
+    def _set_affinity():
+        os.sched_setaffinity(0, cpus)
+
+    return _set_affinity
@@ -0,0 +1,358 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import io
+import logging
+
+import grpc
+import requests
+
+import json_utils
+import tfs_utils
+
+try:
+    import numpy as np
+    from tensorflow.core.framework import tensor_pb2, tensor_shape_pb2, types_pb2
+    from tensorflow_serving.apis import predict_pb2, prediction_service_pb2_grpc
+
+    GRPC_PREDICT_AVAILABLE = True
+except ImportError:
+    GRPC_PREDICT_AVAILABLE = False
+
+try:
+    from google.protobuf import text_format
+    from tensorflow_serving.apis import model_management_pb2, model_service_pb2_grpc
+
+    GRPC_RELOAD_CONFIG_AVAILABLE = True
+except ImportError:
+    GRPC_RELOAD_CONFIG_AVAILABLE = False
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+DEFAULT_SIGNATURE_NAME = "serving_default"
+GRPC_PREDICT_TIMEOUT_SECONDS = 60
+GRPC_RELOAD_CONFIG_TIMEOUT_SECONDS = 600
+
+JSON_CONTENT_TYPES = tfs_utils.JSON_CONTENT_TYPES
+CSV_CONTENT_TYPE = tfs_utils.CSV_CONTENT_TYPE
+NPY_CONTENT_TYPE = "application/x-npy"
+
+# TFS dtype names (as reported by the REST metadata API) -> numpy dtype names
+_NUMPY_DTYPES = {
+    "DT_FLOAT": "float32",
+    "DT_DOUBLE": "float64",
+    "DT_HALF": "float16",
+    "DT_INT8": "int8",
+    "DT_INT16": "int16",
+    "DT_INT32": "int32",
+    "DT_INT64": "int64",
+    "DT_UINT8": "uint8",
+    "DT_UINT16": "uint16",
+    "DT_BOOL": "bool",
+}
+
+# typed TensorProto value fields, used when TFS does not fill tensor_content
+_VALUE_FIELDS = {
+    "DT_FLOAT": "float_val",
+    "DT_DOUBLE": "double_val",
+    "DT_HALF": "half_val",
+    "DT_INT8": "int_val",
+    "DT_INT16": "int_val",
+    "DT_INT32": "int_val",
+    "DT_UINT8": "int_val",
+    "DT_UINT16": "int_val",
+    "DT_INT64": "int64_val",
+    "DT_BOOL": "bool_val",
+}
+
+# (metadata uri, signature name) -> (model version, signature) of the models served over gRPC
+_signature_cache = {}
+# errors of a predict call that may be caused by a signature changed by a new model version
+_STALE_SIGNATURE_CODES = (
+    grpc.StatusCode.INVALID_ARGUMENT,
+    grpc.StatusCode.NOT_FOUND,
+    grpc.StatusCode.FAILED_PRECONDITION,
+)
+
+
+class UnsupportedGrpcRequest(Exception):
+    """Raised when a request cannot be mapped to a PredictRequest; callers fall back to REST."""
+
+
+def grpc_predict(body, context, http=requests):
+    """Send an invocation body to TFS over the cached gRPC channel of the context.
+
+    :param body: raw request body (bytes)
+    :param context: tfs_utils.Context of the request
+    :param http: requests compatible client used to fetch the signature metadata
+    :return: JSON response body (bytes) in the same format as the TFS REST API
+    :raises UnsupportedGrpcRequest: if the body or signature cannot be mapped to tensors
+    """
+    _check_grpc_predict(context)
+    row_format, signature_name, arrays = _parse_body(body, context)
+    return grpc_predict_arrays(arrays, context, signature_name, row_format, http)
+
+
+def grpc_predict_arrays(
+    arrays, context, signature_name=DEFAULT_SIGNATURE_NAME, row_format=True, http=requests
+):
+    """Send input arrays to TFS over the cached gRPC channel of the context.
+
+    :param arrays: dict of input name to array, or a single array for single input signatures
+    :param row_format: True if the arrays hold instances, in which case the response holds
+        predictions like the TFS REST API does for "instances" requests
+    :return: JSON response body (bytes) in the same format as the TFS REST API
+    :raises UnsupportedGrpcRequest: if the arrays cannot be mapped to the signature
+    """
+    _check_grpc_predict(context)
+    key = (_metadata_uri(context), signature_name)
+    entry = _signature_cache.get(key)
+    if entry is None:
+        entry = _cache_signature(key, http.get(key[0]))
+    request = _make_predict_request(arrays, context, signature_name, entry[1])
+    stub = prediction_service_pb2_grpc.PredictionServiceStub(context.channel)
+    try:
+        result = stub.Predict(request, GRPC_PREDICT_TIMEOUT_SECONDS)
+    except grpc.RpcError as e:
+        _forget_stale_signature(key, e)
+        raise
+    _check_version(key, entry, result)
+    return _format_result(result, row_format)
+
+
+async def grpc_predict_async(body, context, http):
+    """grpc_predict over a grpc.aio channel.
+
+    :param http: client whose get() coroutine returns a requests compatible response
+    """
+    _check_grpc_predict(context)
+    row_format, signature_name, arrays = _parse_body(body, context)
+    return await grpc_predict_arrays_async(arrays, context, signature_name, row_format, http)
+
+
+async def grpc_predict_arrays_async(
+    arrays, context, signature_name=DEFAULT_SIGNATURE_NAME, row_format=True, http=None
+):
+    """grpc_predict_arrays over a grpc.aio channel"""
+    _check_grpc_predict(context)
+    key = (_metadata_uri(context), signature_name)
+    entry = _signature_cache.get(key)
+    if entry is None:
+        entry = _cache_signature(key, await http.get(key[0]))
+    request = _make_predict_request(arrays, context, signature_name, entry[1])
+    stub = prediction_service_pb2_grpc.PredictionServiceStub(context.channel)
+    try:
+        result = await stub.Predict(request, GRPC_PREDICT_TIMEOUT_SECONDS)
+    except grpc.RpcError as e:
+        _forget_stale_signature(key, e)
+        raise
+    _check_version(key, entry, result)
+    return _format_result(result, row_format)
+
+
+def _make_predict_request(arrays, context, signature_name, signature):
+    inputs = _map_inputs(arrays, signature["inputs"])
+    try:
+        request = predict_pb2.PredictRequest()
+        # the model of the REST uri, which falls back to TFS_DEFAULT_MODEL_NAME
+        request.model_spec.name = context.model_name or tfs_utils.uri_model_name(context.rest_uri)
+        request.model_spec.signature_name = signature_name
+        if context.model_version:
+            request.model_spec.version.value = int(context.model_version)
+        for key, (tfs_dtype, array) in inputs.items():
+            request.inputs[key].CopyFrom(_make_tensor_proto(tfs_dtype, array))
+    except (TypeError, ValueError) as e:
+        raise UnsupportedGrpcRequest("cannot build the predict request: {}".format(e))
+    return request
+
+
+def _format_result(result, row_format):
+    # arrays are serialized by json_utils, straight from their buffers when orjson is installed
+    try:
+        outputs = {key: _make_ndarray(tensor) for key, tensor in result.outputs.items()}
+    except ValueError as e:
+        raise UnsupportedGrpcRequest(str(e))
+    return json_utils.dumps(_format_outputs(outputs, row_format))
+
+
+def clear_signature_cache(model_name=None):
+    """Forgets the cached signatures of a model, or of all models, e.g. after an unload"""
+    for key in list(_signature_cache):
+        if model_name is None or tfs_utils.uri_model_name(key[0]) == model_name:
+            _signature_cache.pop(key, None)
+
+
+def _forget_stale_signature(key, error):
+    if error.code() in _STALE_SIGNATURE_CODES:
+        _signature_cache.pop(key, None)
+
+
+def _check_version(key, entry, result):
+    """Forgets a cached signature once TFS serves another version than the one it came from"""
+    version = entry[0]
+    if version is not None and result.model_spec.HasField("version"):
+        if str(result.model_spec.version.value) != version:
+            log.info("model version changed, refreshing the signature of {}".format(key[0]))
+            _signature_cache.pop(key, None)
+
+
+def _check_grpc_predict(context):
+    if not GRPC_PREDICT_AVAILABLE:
+        raise UnsupportedGrpcRequest("tensorflow-serving-api protos or numpy are not installed")
+    if context.channel is None:
+        raise UnsupportedGrpcRequest("no grpc channel for port {}".format(context.grpc_port))
+    if (context.method or "predict") != "predict":
+        raise UnsupportedGrpcRequest("method {} is only served over REST".format(context.method))
+
+
+def reload_model_config(channel, config):
+    """Replace the model config of a running TFS with the ReloadConfig API. TFS loads the new
+    models and unloads the ones missing from the config before it answers.
+
+    :param channel: grpc channel to the TFS instance
+    :param config: model config in text format, as written to the model config file
+    :raises RuntimeError: if TFS rejects the config
+    """
+    request = model_management_pb2.ReloadConfigRequest()
+    text_format.Parse(config, request.config)
+    stub = model_service_pb2_grpc.ModelServiceStub(channel)
+    response = stub.HandleReloadConfigRequest(request, GRPC_RELOAD_CONFIG_TIMEOUT_SECONDS)
+    if response.status.error_code != 0:
+        raise RuntimeError(response.status.error_message)
+
+
+def _parse_body(body, context):
+    """Returns (row_format, signature_name, arrays); arrays is a dict, or a list for one input"""
+    content_type = (context.request_content_type or "").split(";")[0].strip()
+    if content_type == CSV_CONTENT_TYPE:
+        return True, DEFAULT_SIGNATURE_NAME, _parse_csv(body)
+    if content_type == NPY_CONTENT_TYPE:
+        try:
+            return True, DEFAULT_SIGNATURE_NAME, np.load(io.BytesIO(body), allow_pickle=False)
+        except ValueError:
+            raise UnsupportedGrpcRequest("body is not a npy array")
+    if content_type not in JSON_CONTENT_TYPES:
+        raise UnsupportedGrpcRequest("unsupported content type {}".format(content_type))
+
+    try:
+        payload = json_utils.loads(body)
+    except ValueError:
+        raise UnsupportedGrpcRequest("body is not a single JSON document")
+    if not isinstance(payload, dict):
+        raise UnsupportedGrpcRequest("JSON body is not a TFS request")
+
+    signature_name = payload.get("signature_name", DEFAULT_SIGNATURE_NAME)
+    if "instances" in payload:
+        instances = payload["instances"]
+        if instances and isinstance(instances[0], dict):
+            keys = instances[0].keys()
+            return True, signature_name, {k: [i[k] for i in instances] for k in keys}
+        return True, signature_name, instances
+    if "inputs" in payload:
+        return False, signature_name, payload["inputs"]
+    raise UnsupportedGrpcRequest("JSON body has neither 'instances' nor 'inputs'")
+
+
+def _parse_csv(body):
+    instances = tfs_utils.csv_to_array(body)
+    if instances is None:
+        raise UnsupportedGrpcRequest("CSV body is not numeric")
+    return instances
+
+
+def _metadata_uri(context):
+    return context.rest_uri.rsplit(":", 1)[0] + "/metadata"
+
+
+def _cache_signature(key, response):
+    """Caches the signature of a metadata response, with the model version it belongs to"""
+    metadata_uri, signature_name = key
+    if response.status_code != 200:
+        raise UnsupportedGrpcRequest("no metadata for {}".format(metadata_uri))
+    body = json_utils.loads(response.content)
+    signatures = body["metadata"]["signature_def"]["signature_def"]
+    if signature_name not in signatures:
+        raise UnsupportedGrpcRequest("unknown signature {}".format(signature_name))
+    version = body.get("model_spec", {}).get("version")
+    entry = (str(version) if version is not None else None, signatures[signature_name])
+    _signature_cache[key] = entry
+    return entry
+
+
+def _map_inputs(arrays, signature_inputs):
+    if not isinstance(arrays, dict):
+        if len(signature_inputs) != 1:
+            raise UnsupportedGrpcRequest("unnamed input for a multi-input signature")
+        arrays = {next(iter(signature_inputs)): arrays}
+
+    inputs = {}
+    for key, value in arrays.items():
+        if key not in signature_inputs:
+            raise UnsupportedGrpcRequest("input {} is not in the signature".format(key))
+        tfs_dtype = signature_inputs[key]["dtype"]
+        dtype = _NUMPY_DTYPES.get(tfs_dtype)
+        if dtype is None:
+            raise UnsupportedGrpcRequest("dtype {} is only served over REST".format(tfs_dtype))
+        try:
+            inputs[key] = (tfs_dtype, np.asarray(value, dtype=dtype))
+        except (TypeError, ValueError):
+            raise UnsupportedGrpcRequest("input {} is not a dense {} array".format(key, dtype))
+    return inputs
+
+
+def _make_tensor_proto(tfs_dtype, array):
+    shape = tensor_shape_pb2.TensorShapeProto(
+        dim=[tensor_shape_pb2.TensorShapeProto.Dim(size=size) for size in array.shape]
+    )
+    return tensor_pb2.TensorProto(
+        dtype=types_pb2.DataType.Value(tfs_dtype),
+        tensor_shape=shape,
+        tensor_content=np.ascontiguousarray(array).tobytes(),
+    )
+
+
+def _make_ndarray(tensor):
+    dtype_name = types_pb2.DataType.Name(tensor.dtype)
+    shape = [dim.size for dim in tensor.tensor_shape.dim]
+    if dtype_name == "DT_STRING":
+        values = [value.decode("utf-8", "backslashreplace") for value in tensor.string_val]
+        # object arrays are not serialized by orjson, nest the strings in lists instead
+        return np.array(values, dtype=object).reshape(shape).tolist()
+    if dtype_name not in _NUMPY_DTYPES:
+        raise ValueError("unsupported output dtype {}".format(dtype_name))
+
+    dtype = np.dtype(_NUMPY_DTYPES[dtype_name])
+    if tensor.tensor_content:
+        return np.frombuffer(tensor.tensor_content, dtype=dtype).reshape(shape)
+    values = getattr(tensor, _VALUE_FIELDS[dtype_name])
+    if dtype_name == "DT_HALF":
+        values = np.array(values, dtype=np.uint16).view(np.float16)
+    size = int(np.prod(shape))
+    if len(values) == size:
+        return np.array(values, dtype=dtype).reshape(shape)
+    # TFS may send a single value for a constant tensor
+    return np.full(shape, values[0] if len(values) else 0, dtype=dtype)
+
+
+def _format_outputs(outputs, row_format):
+    """Mirrors the TFS REST response: predictions for row format, outputs for columnar"""
+    if not row_format:
+        if len(outputs) == 1:
+            return {"outputs": next(iter(outputs.values()))}
+        return {"outputs": outputs}
+
+    if len(outputs) == 1:
+        return {"predictions": next(iter(outputs.values()))}
+    keys = list(outputs)
+    rows = len(outputs[keys[0]])
+    return {"predictions": [{key: outputs[key][i] for key in keys} for i in range(rows)]}
@@ -0,0 +1,76 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import importlib
+import json
+import logging
+import os
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# in order of preference when SAGEMAKER_JSON_LIBRARY is not set
+JSON_LIBRARIES = ["orjson", "ujson", "json"]
+
+
+def _select_library(name=None):
+    candidates = [name] if name else JSON_LIBRARIES
+    for candidate in candidates:
+        if candidate not in JSON_LIBRARIES:
+            raise ValueError(
+                "SAGEMAKER_JSON_LIBRARY must be one of {}, got {}".format(JSON_LIBRARIES, name)
+            )
+        try:
+            return candidate, importlib.import_module(candidate)
+        except ImportError:
+            log.info("{} is not installed".format(candidate))
+    log.warning("{} is not installed, using json".format(name))
+    return "json", json
+
+
+JSON_LIBRARY, _library = _select_library(os.environ.get("SAGEMAKER_JSON_LIBRARY"))
+log.info("json library: {}".format(JSON_LIBRARY))
+
+
+def _default(obj):
+    # numpy arrays and scalars
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError("{} is not JSON serializable".format(type(obj).__name__))
+
+
+def _to_builtin(obj):
+    if isinstance(obj, dict):
+        return {key: _to_builtin(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_builtin(value) for value in obj]
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return obj
+
+
+def loads(data):
+    """Decode a JSON document from str or bytes. Raises ValueError if it is not valid JSON."""
+    if isinstance(data, memoryview) and JSON_LIBRARY != "orjson":
+        data = data.tobytes()
+    return _library.loads(data)
+
+
+def dumps(obj):
+    """Encode obj as UTF-8 JSON bytes. numpy arrays are serialized from their buffers with
+    orjson, and converted to lists for the other libraries.
+    """
+    if JSON_LIBRARY == "orjson":
+        return _library.dumps(obj, default=_default, option=_library.OPT_SERIALIZE_NUMPY)
+    if JSON_LIBRARY == "ujson":
+        return _library.dumps(_to_builtin(obj), ensure_ascii=False).encode("utf-8")
+    return _library.dumps(obj, default=_default).encode("utf-8")
@@ -0,0 +1,320 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import bisect
+import glob
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # python 3.6, where invocations are tracked per thread or greenlet
+    ContextVar = None
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# every process writes its metrics to a file of this directory, /metrics adds them up
+METRICS_DIR = "/dev/shm/sagemaker-metrics" if os.path.isdir("/dev/shm") else "/sagemaker/metrics"
+# a process writes its metrics file this often when they changed, and when /metrics is requested
+FLUSH_INTERVAL_SECONDS = 1.0
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+METRICS = {
+    "sagemaker_invocations_total": (COUNTER, "Invocations by model and HTTP status."),
+    "sagemaker_invocation_duration_seconds": (
+        HISTOGRAM,
+        "Invocation latency by model and phase: pre_process until the first TFS call, tfs in "
+        "TFS calls, post_process after the last TFS call, and total.",
+    ),
+    "sagemaker_tfs_in_flight_requests": (GAUGE, "Requests being processed by TFS, by port."),
+    "sagemaker_process_restarts_total": (
+        COUNTER,
+        "Unexpected exits of tensorflow serving, nginx and gunicorn restarted by serve.py.",
+    ),
+    "sagemaker_model_load_duration_seconds": (
+        HISTOGRAM,
+        "Multi-model endpoint model load latency by HTTP status.",
+    ),
+    "sagemaker_model_unload_duration_seconds": (
+        HISTOGRAM,
+        "Multi-model endpoint model unload latency, including evictions, by HTTP status.",
+    ),
+    "sagemaker_model_reload_duration_seconds": (
+        HISTOGRAM,
+        "Time from finding added or removed model versions in /opt/ml/model until the new "
+        "versions are available on every TFS instance.",
+    ),
+    "sagemaker_response_cache_hits_total": (COUNTER, "Invocations answered by the cache."),
+    "sagemaker_response_cache_misses_total": (COUNTER, "Invocations not found in the cache."),
+    "sagemaker_response_cache_evictions_total": (COUNTER, "Least recently used entries evicted."),
+    "sagemaker_response_cache_size_bytes": (GAUGE, "Size of the cached responses."),
+    "sagemaker_rejected_invocations_total": (
+        COUNTER,
+        "Invocations answered with a 429 by admission control, by model and reason: concurrency "
+        "when the queue of the model is full, queue_timeout when waiting for a slot timed out.",
+    ),
+}
+
+
+def remove_metrics(metrics_dir=METRICS_DIR):
+    """Remove the metrics of a previous run, called before the services start"""
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+class _Invocation(object):
+    def __init__(self, start):
+        self.start = start
+        self.first_tfs_start = None
+        self.last_tfs_end = None
+        self.tfs_seconds = 0.0
+        # nested TFS calls, e.g. a micro-batch sent while waiting for it, are counted once
+        self.tfs_depth = 0
+
+
+class _CurrentInvocation(object):
+    """Invocation of the current thread or greenlet, or asyncio task when contextvars exists"""
+
+    def __init__(self):
+        if ContextVar is not None:
+            self._var = ContextVar("sagemaker_invocation", default=None)
+        else:
+            self._local = threading.local()
+
+    def get(self):
+        if ContextVar is not None:
+            return self._var.get()
+        return getattr(self._local, "invocation", None)
+
+    def set(self, invocation):
+        if ContextVar is not None:
+            self._var.set(invocation)
+        else:
+            self._local.invocation = invocation
+
+
+class Metrics(object):
+    """Counters, gauges and histograms of one process, written to a file of metrics_dir.
+
+    Counters and histograms of all files are added up, including those of exited processes,
+    gauges only for running processes.
+    """
+
+    def __init__(self, metrics_dir=METRICS_DIR, name=None, buckets=DEFAULT_BUCKETS):
+        self._metrics_dir = metrics_dir
+        self._name = name
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}
+        self._dirty = False
+        # pid of the process the flush thread runs in, gunicorn workers are forked
+        self._flush_pid = None
+        self._invocation = _CurrentInvocation()
+
+    def inc(self, name, labels, value=1):
+        key = metric_key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+        self._changed()
+
+    def observe(self, name, labels, seconds):
+        key = metric_key(name, labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = {
+                    "buckets": [0] * len(self._buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            index = bisect.bisect_left(self._buckets, seconds)
+            if index < len(self._buckets):
+                histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+        self._changed()
+
+    @contextmanager
+    def invocation(self, model_name):
+        """Times an invocation, split into phases around the TFS calls made by tfs_call"""
+        invocation = _Invocation(time.time())
+        self._invocation.set(invocation)
+        status = ["500"]
+        try:
+            yield status
+        finally:
+            self._invocation.set(None)
+            end = time.time()
+            labels = {"model": model_name}
+            self.inc("sagemaker_invocations_total", dict(labels, status=status[0]))
+            phases = {"total": end - invocation.start}
+            if invocation.first_tfs_start is not None:
+                phases["pre_process"] = invocation.first_tfs_start - invocation.start
+                phases["tfs"] = invocation.tfs_seconds
+                phases["post_process"] = end - invocation.last_tfs_end
+            for phase, seconds in phases.items():
+                self.observe(
+                    "sagemaker_invocation_duration_seconds", dict(labels, phase=phase), seconds
+                )
+
+    @contextmanager
+    def tfs_call(self, port):
+        invocation = self._invocation.get()
+        if invocation is not None and invocation.tfs_depth:
+            yield
+            return
+
+        self.inc("sagemaker_tfs_in_flight_requests", {"port": port})
+        start = time.time()
+        if invocation is not None:
+            invocation.tfs_depth += 1
+            if invocation.first_tfs_start is None:
+                invocation.first_tfs_start = start
+        try:
+            yield
+        finally:
+            end = time.time()
+            if invocation is not None:
+                invocation.tfs_depth -= 1
+                invocation.tfs_seconds += end - start
+                invocation.last_tfs_end = end
+            self.inc("sagemaker_tfs_in_flight_requests", {"port": port}, -1)
+
+    @contextmanager
+    def timer(self, name, labels):
+        """Observes the duration of the block. The caller may add labels, such as the status"""
+        labels = dict(labels)
+        start = time.time()
+        try:
+            yield labels
+        finally:
+            self.observe(name, labels, time.time() - start)
+
+    def _changed(self):
+        self._dirty = True
+        if self._flush_pid != os.getpid():
+            self._flush_pid = os.getpid()
+            threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL_SECONDS)
+            if self._dirty:
+                try:
+                    self.flush()
+                except OSError as e:
+                    log.warning("failed to write metrics: {}".format(e))
+
+    def flush(self):
+        with self._lock:
+            self._dirty = False
+            snapshot = {
+                "pid": os.getpid(),
+                "buckets": self._buckets,
+                "values": [[key, _copy(value)] for key, value in self._values.items()],
+            }
+        os.makedirs(self._metrics_dir, exist_ok=True)
+        metrics_file = os.path.join(self._metrics_dir, "{}.json".format(self._name or os.getpid()))
+        tmp_file = "{}.tmp".format(metrics_file)
+        with open(tmp_file, "w", encoding="utf8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, metrics_file)
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return dict(value, buckets=list(value["buckets"]))
+    return value
+
+
+def metric_key(name, labels):
+    return "{}|{}".format(name, json.dumps(sorted(labels.items())))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def collect(metrics_dir=METRICS_DIR):
+    """Adds up the metrics files of all processes"""
+    values = {}
+    buckets = DEFAULT_BUCKETS
+    for metrics_file in glob.glob(os.path.join(metrics_dir, "*.json")):
+        try:
+            with open(metrics_file, encoding="utf8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        alive = _alive(snapshot["pid"])
+        buckets = snapshot["buckets"]
+        for key, value in snapshot["values"]:
+            kind = METRICS.get(key.split("|")[0], (GAUGE, None))[0]
+            if kind == HISTOGRAM:
+                total = values.setdefault(
+                    key, {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+                )
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], value["buckets"])]
+                total["sum"] += value["sum"]
+                total["count"] += value["count"]
+            elif kind == COUNTER or alive:
+                values[key] = values.get(key, 0) + value
+    return values, buckets
+
+
+def _format_labels(labels):
+    return ",".join(
+        '{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in labels
+    )
+
+
+def render(values, buckets):
+    """Prometheus text exposition format of collected metrics"""
+    by_name = {}
+    for key, value in values.items():
+        name, labels = key.split("|", 1)
+        by_name.setdefault(name, []).append((json.loads(labels), value))
+
+    lines = []
+    for name in sorted(by_name):
+        kind, description = METRICS.get(name, (GAUGE, name))
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in sorted(by_name[name], key=lambda sample: sample[0]):
+            if kind != HISTOGRAM:
+                lines.append("{}{{{}}} {}".format(name, _format_labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ["+Inf"], value["buckets"] + [None]):
+                cumulative = value["count"] if count is None else cumulative + count
+                lines.append(
+                    "{}_bucket{{{}}} {}".format(
+                        name, _format_labels(labels + [["le", bound]]), cumulative
+                    )
+                )
+            lines.append("{}_sum{{{}}} {}".format(name, _format_labels(labels), value["sum"]))
+            lines.append("{}_count{{{}}} {}".format(name, _format_labels(labels), value["count"]))
+    return "\n".join(lines) + "\n"
@@ -11,25 +11,414 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 import fcntl
+import logging
+import os
 import signal
+import sqlite3
+import threading
 import time
 from contextlib import contextmanager
 
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
 MODEL_CONFIG_FILE = "/sagemaker/model-config.cfg"
 DEFAULT_LOCK_FILE = "/sagemaker/lock-file.lock"
+DEFAULT_STATE_FILE = "/sagemaker/mme-state.db"
+# model config and pid files of the TFS instances shared by all models (consolidated mode)
+INSTANCE_DIR = "/sagemaker/tfs-instances/{}"
+INSTANCE_CONFIG_FILE = INSTANCE_DIR + "/model-config.cfg"
+INSTANCE_PID_FILE = INSTANCE_DIR + "/tfs.pid"
+INSTANCE_LOCK_FILE = INSTANCE_DIR + "/lock-file.lock"
+# seconds a worker waits for another worker's transaction on the state file
+STATE_BUSY_TIMEOUT_SECONDS = 30
 
 
 @contextmanager
 def lock(path=DEFAULT_LOCK_FILE):
-    f = open(path, "w", encoding="utf8")
-    fd = f.fileno()
-    fcntl.lockf(fd, fcntl.LOCK_EX)
+    with open(path, "w", encoding="utf8") as f:
+        fd = f.fileno()
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+
+def remove_state(path=DEFAULT_STATE_FILE):
+    """Remove the state shared by gunicorn workers, called before gunicorn starts"""
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+class SharedState(object):
+    """sqlite database shared by all gunicorn workers of the container.
+
+    Every worker opens its own connection; write transactions are serialized by sqlite's own
+    file locks, which are released as soon as the transaction commits. Threads of a worker,
+    such as the executor threads of asgi_service, use the connection one at a time.
+    """
+
+    def __init__(self, path=DEFAULT_STATE_FILE):
+        self._path = path
+        self._connection = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        # connections must not be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(
+                self._path,
+                timeout=STATE_BUSY_TIMEOUT_SECONDS,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    @contextmanager
+    def transaction(self):
+        """Exclusive (write) transaction across all workers"""
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            else:
+                connection.execute("COMMIT")
+
+    def query(self, sql, parameters=()):
+        with self._lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+
+class PortPool(object):
+    """TFS rest/grpc ports of the multi-model endpoint, allocated in pairs to model names"""
+
+    def __init__(self, state, rest_ports, grpc_ports):
+        self._state = state
+        with self._state.transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS ports "
+                "(port INTEGER PRIMARY KEY, kind TEXT NOT NULL, model_name TEXT)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ports_model ON ports (model_name)")
+            connection.executemany(
+                "INSERT OR IGNORE INTO ports (port, kind) VALUES (?, ?)",
+                [(port, "rest") for port in rest_ports] + [(port, "grpc") for port in grpc_ports],
+            )
+
+    def available(self):
+        counts = dict(
+            self._state.query(
+                "SELECT kind, COUNT(*) FROM ports WHERE model_name IS NULL GROUP BY kind"
+            )
+        )
+        return min(counts.get("rest", 0), counts.get("grpc", 0))
+
+    def allocate(self, model_name):
+        """Returns a free (rest_port, grpc_port) pair reserved for model_name, or None"""
+        with self._state.transaction() as connection:
+            ports = []
+            for kind in ("rest", "grpc"):
+                row = connection.execute(
+                    "SELECT MAX(port) FROM ports WHERE kind = ? AND model_name IS NULL", (kind,)
+                ).fetchone()
+                if row[0] is None:
+                    return None
+                ports.append(row[0])
+            connection.executemany(
+                "UPDATE ports SET model_name = ? WHERE port = ?",
+                [(model_name, port) for port in ports],
+            )
+        return tuple(ports)
+
+    def release(self, ports):
+        with self._state.transaction() as connection:
+            connection.executemany(
+                "UPDATE ports SET model_name = NULL WHERE port = ?", [(port,) for port in ports]
+            )
+
+    def release_model(self, model_name):
+        """Frees the ports still allocated to a model, e.g. by a worker that died loading it"""
+        with self._state.transaction() as connection:
+            connection.execute(
+                "UPDATE ports SET model_name = NULL WHERE model_name = ?", (model_name,)
+            )
+
+
+class ModelRegistry(object):
+    """Models loaded by the multi-model endpoint and the TFS process serving each of them.
+
+    Shared by all gunicorn workers, so any worker can route invocations to a model loaded by
+    another one.
+    """
+
+    LOADING = "loading"
+    AVAILABLE = "available"
+    UNLOADING = "unloading"
+
+    def __init__(self, state, loading_timeout_seconds=None):
+        """
+        :param loading_timeout_seconds: loads running for longer are abandoned, and another
+            worker may take them over
+        """
+        self._state = state
+        self._loading_timeout_seconds = loading_timeout_seconds
+        with self._state.transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS models "
+                "(model_name TEXT PRIMARY KEY, base_path TEXT NOT NULL, state TEXT NOT NULL, "
+                "rest_port INTEGER, grpc_port INTEGER, pid INTEGER, last_access REAL, "
+                "size_bytes INTEGER, loader_pid INTEGER, loading_since REAL)"
+            )
+
+    def reserve(self, model_name, base_path, size_bytes=None):
+        """Returns False if the model is already loaded, or being loaded by another worker.
+        The load of a worker that died, or did not complete in time, is taken over.
+
+        :param size_bytes: size of the model on disk, counted toward the memory budget while
+            the model is loading
+        """
+        with self._state.transaction() as connection:
+            row = connection.execute(
+                "SELECT state, loader_pid, loading_since FROM models WHERE model_name = ?",
+                (model_name,),
+            ).fetchone()
+            if row is not None:
+                state, loader_pid, loading_since = row
+                if state != self.LOADING or not self._abandoned(loader_pid, loading_since):
+                    return False
+                log.warning(
+                    "taking over the load of model {} abandoned by pid {}".format(
+                        model_name, loader_pid
+                    )
+                )
+                connection.execute("DELETE FROM models WHERE model_name = ?", (model_name,))
+            connection.execute(
+                "INSERT INTO models "
+                "(model_name, base_path, state, size_bytes, loader_pid, loading_since) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (model_name, base_path, self.LOADING, size_bytes, os.getpid(), time.time()),
+            )
+        return True
+
+    def _abandoned(self, loader_pid, loading_since):
+        if not _alive(loader_pid):
+            return True
+        timeout = self._loading_timeout_seconds
+        return timeout is not None and time.time() - loading_since > timeout
+
+    def assign(self, model_name, instances, size_bytes):
+        """Assigns a model being loaded to the shared TFS instance with the fewest bytes of
+        models assigned, then the fewest models, and returns its (rest_port, grpc_port).
+
+        :param instances: (rest_port, grpc_port) of every shared TFS instance
+        :param size_bytes: size of the model on disk
+        """
+        with self._state.transaction() as connection:
+            assigned = {
+                port: (size, count)
+                for port, size, count in connection.execute(
+                    "SELECT rest_port, SUM(size_bytes), COUNT(*) FROM models "
+                    "WHERE rest_port IS NOT NULL GROUP BY rest_port"
+                ).fetchall()
+            }
+            rest_port, grpc_port = min(instances, key=lambda i: assigned.get(i[0], (0, 0)))
+            connection.execute(
+                "UPDATE models SET rest_port = ?, grpc_port = ?, size_bytes = ? "
+                "WHERE model_name = ?",
+                (rest_port, grpc_port, size_bytes, model_name),
+            )
+        return rest_port, grpc_port
+
+    def instance_models(self, rest_port):
+        """Returns (model_name, base_path) of the models a shared TFS instance must serve"""
+        return self._state.query(
+            "SELECT model_name, base_path FROM models "
+            "WHERE rest_port = ? AND state != ? ORDER BY model_name",
+            (rest_port, self.UNLOADING),
+        )
+
+    def set_available(self, model_name, rest_port, grpc_port, pid):
+        with self._state.transaction() as connection:
+            connection.execute(
+                "UPDATE models SET state = ?, rest_port = ?, grpc_port = ?, pid = ?, "
+                "last_access = ? WHERE model_name = ?",
+                (self.AVAILABLE, rest_port, grpc_port, pid, time.time(), model_name),
+            )
+
+    def set_instance_pid(self, rest_port, pid):
+        """Records the pid of a shared TFS instance restarted by serve.py"""
+        with self._state.transaction() as connection:
+            connection.execute("UPDATE models SET pid = ? WHERE rest_port = ?", (pid, rest_port))
 
+    def claim(self, model_name):
+        """Marks an available model as being unloaded. Returns False if it is not available,
+        e.g. because another worker is already unloading it.
+        """
+        with self._state.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE models SET state = ? WHERE model_name = ? AND state = ?",
+                (self.UNLOADING, model_name, self.AVAILABLE),
+            )
+        return cursor.rowcount == 1
+
+    def touch(self, model_name, access_time):
+        with self._state.transaction() as connection:
+            connection.execute(
+                "UPDATE models SET last_access = ? WHERE model_name = ?",
+                (access_time, model_name),
+            )
+
+    def get(self, model_name):
+        """Returns the record of an available model, or None"""
+        rows = self._state.query(
+            "SELECT {} FROM models WHERE model_name = ? AND state = ?".format(_MODEL_COLUMNS),
+            (model_name, self.AVAILABLE),
+        )
+        return _model_record(rows[0]) if rows else None
+
+    def list(self, after=None, limit=None):
+        """Returns the records of the available models, ordered by name.
+
+        :param after: only the models named after it, to page through the models
+        :param limit: maximum number of models returned
+        """
+        rows = self._state.query(
+            "SELECT {} FROM models WHERE state = ? AND model_name > ? "
+            "ORDER BY model_name LIMIT ?".format(_MODEL_COLUMNS),
+            (self.AVAILABLE, after or "", -1 if limit is None else limit),
+        )
+        return [_model_record(row) for row in rows]
+
+    def budgeted(self):
+        """Returns the records of the models loaded or being loaded, which count toward the
+        model budget. The pid of a model being loaded is None.
+        """
+        rows = self._state.query(
+            "SELECT {} FROM models WHERE state != ?".format(_MODEL_COLUMNS), (self.UNLOADING,)
+        )
+        return [_model_record(row) for row in rows]
+
+    def remove(self, model_name):
+        with self._state.transaction() as connection:
+            connection.execute("DELETE FROM models WHERE model_name = ?", (model_name,))
+
+
+def _alive(pid):
     try:
-        yield
-    finally:
-        time.sleep(1)
-        fcntl.lockf(fd, fcntl.LOCK_UN)
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_MODEL_COLUMNS = "model_name, base_path, rest_port, grpc_port, pid, last_access, size_bytes"
+
+
+def _model_record(row):
+    return dict(zip([column.strip() for column in _MODEL_COLUMNS.split(",")], row))
+
+
+def model_size_bytes(base_path):
+    """Size of the files of a model on disk"""
+    size = 0
+    for root, _, files in os.walk(base_path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def instance_pid(rest_port):
+    """pid of the shared TFS instance listening on rest_port, or None if it is unknown"""
+    try:
+        with open(INSTANCE_PID_FILE.format(rest_port), "r", encoding="utf8") as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def process_rss_bytes(pid):
+    """Resident set size of a process, read from /proc. Returns 0 if the process is gone."""
+    try:
+        with open("/proc/{}/statm".format(pid), "r", encoding="utf8") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class LruEviction(object):
+    """Chooses which models to unload so that a new model can be loaded.
+
+    The budget is exceeded when no ports are left, when more than max_models models are loaded
+    or being loaded, or when the models would use more than memory_budget_bytes. Loaded models
+    are measured by the resident memory of their TFS processes, and models being loaded,
+    including the new one, by their size on disk. Only models that have not been invoked for
+    idle_seconds are evicted, least recently used first.
+
+    Shared TFS instances (consolidated) keep their resident memory after a model is removed
+    from their config, so their models are measured by their size on disk instead.
+    """
+
+    def __init__(
+        self,
+        registry,
+        memory_budget_bytes=None,
+        max_models=None,
+        idle_seconds=30,
+        consolidated=False,
+    ):
+        self._registry = registry
+        self._memory_budget_bytes = memory_budget_bytes
+        self._max_models = max_models
+        self._idle_seconds = idle_seconds
+        self._consolidated = consolidated
+
+    def over_budget(self, free_port_pairs, model_name, size_bytes):
+        """Whether loading a model, reserved in the registry, exceeds the budget.
+
+        :param model_name: name of the model being loaded
+        :param size_bytes: size of the model on disk
+        """
+        if free_port_pairs == 0:
+            return True
+        # the loads of other workers count too, so that concurrent loads do not overshoot
+        models = [m for m in self._registry.budgeted() if m["model_name"] != model_name]
+        if self._max_models and len(models) + 1 > self._max_models:
+            return True
+        if self._memory_budget_bytes:
+            if self._consolidated:
+                used = sum(m["size_bytes"] or 0 for m in models)
+            else:
+                # models hosted by the same TFS process share its memory
+                pids = set(m["pid"] for m in models if m["pid"] is not None)
+                used = sum(process_rss_bytes(pid) for pid in pids)
+                used += sum(m["size_bytes"] or 0 for m in models if m["pid"] is None)
+            return used + (size_bytes or 0) > self._memory_budget_bytes
+        return False
+
+    def pick_victim(self):
+        idle_since = time.time() - self._idle_seconds
+        candidates = [m for m in self._registry.list() if (m["last_access"] or 0) <= idle_since]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda model: model["last_access"] or 0)
 
 
 @contextmanager
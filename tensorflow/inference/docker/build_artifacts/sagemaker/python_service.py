@@ -10,19 +10,44 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
-import bisect
 import importlib.util
 import json
 import logging
 import os
+import resource
+import signal
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
 import grpc
 
 import falcon
 import requests
-import random
 
-from multi_model_utils import lock, MultiModelException
+from multi_model_utils import (
+    INSTANCE_CONFIG_FILE,
+    INSTANCE_LOCK_FILE,
+    LruEviction,
+    ModelRegistry,
+    MultiModelException,
+    PortPool,
+    SharedState,
+    instance_pid,
+    lock,
+    model_size_bytes,
+    process_rss_bytes,
+)
+import admission_utils
+import batching_utils
+import cache_utils
+import grpc_utils
+import json_utils
+import metrics_utils
+import routing_utils
+import session_utils
 import tfs_utils
 
 SAGEMAKER_MULTI_MODEL_ENABLED = os.environ.get("SAGEMAKER_MULTI_MODEL", "false").lower() == "true"
@@ -31,15 +56,60 @@ INFERENCE_SCRIPT_PATH = f"/opt/ml/{MODEL_DIR}/code/inference.py"
 
 SAGEMAKER_BATCHING_ENABLED = os.environ.get("SAGEMAKER_TFS_ENABLE_BATCHING", "false").lower()
 MODEL_CONFIG_FILE_PATH = "/sagemaker/model-config.cfg"
+# metrics label of the invocations of models that are not served
+UNKNOWN_MODEL = "unknown"
 TFS_GRPC_PORTS = os.environ.get("TFS_GRPC_PORTS")
 TFS_REST_PORTS = os.environ.get("TFS_REST_PORTS")
 SAGEMAKER_TFS_PORT_RANGE = os.environ.get("SAGEMAKER_SAFE_PORT_RANGE")
 TFS_INSTANCE_COUNT = int(os.environ.get("SAGEMAKER_TFS_INSTANCE_COUNT", "1"))
+# comma separated model names (or "*") whose predict requests are sent over gRPC
+TFS_GRPC_MODELS = os.environ.get("SAGEMAKER_TFS_GRPC_MODELS", "")
+TFS_ROUTING_POLICY = os.environ.get("SAGEMAKER_TFS_ROUTING_POLICY", "least_outstanding")
+TFS_REQUEST_CONVERTER = os.environ.get("SAGEMAKER_TFS_REQUEST_CONVERTER", "njs")
+# load all models into the SAGEMAKER_TFS_INSTANCE_COUNT TFS processes started by serve.py,
+# instead of starting one TFS process per model
+SAGEMAKER_MME_CONSOLIDATED_TFS = (
+    os.environ.get("SAGEMAKER_MME_CONSOLIDATED_TFS", "false").lower() == "true"
+)
+SAGEMAKER_MME_EVICTION_ENABLED = (
+    os.environ.get("SAGEMAKER_MME_ENABLE_EVICTION", "false").lower() == "true"
+)
+SAGEMAKER_MME_MEMORY_BUDGET_MB = int(os.environ.get("SAGEMAKER_MME_MEMORY_BUDGET_MB", 0))
+SAGEMAKER_MME_MAX_MODELS = int(os.environ.get("SAGEMAKER_MME_MAX_MODELS", 0))
+SAGEMAKER_MME_EVICTION_IDLE_SECONDS = int(os.environ.get("SAGEMAKER_MME_EVICTION_IDLE_SECONDS", 30))
+# GET /models reuses the TFS status of a model for this long, and asks TFS for the status of up
+# to SAGEMAKER_MME_STATUS_CONCURRENCY models at once
+SAGEMAKER_MME_STATUS_TTL_SECONDS = float(os.environ.get("SAGEMAKER_MME_STATUS_TTL_SECONDS", 1))
+SAGEMAKER_MME_STATUS_CONCURRENCY = int(os.environ.get("SAGEMAKER_MME_STATUS_CONCURRENCY", 16))
+# loads not completed within the TFS wait time, plus a minute, are taken over by other workers
+MODEL_LOADING_TIMEOUT_SECONDS = int(os.environ.get("SAGEMAKER_TFS_WAIT_TIME_SECONDS", 300)) + 60
+# last access times are written to the shared registry at most this often per model and worker
+LAST_ACCESS_RESOLUTION_SECONDS = 1
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# keep-alive sessions to the TFS REST ports, shared by all requests of this worker
+TFS_SESSIONS = session_utils.session_pool_from_env()
+# successful TFS responses shared by all workers, when SAGEMAKER_RESPONSE_CACHE is true
+RESPONSE_CACHE = cache_utils.response_cache_from_env()
+METRICS = metrics_utils.Metrics()
+# concurrency and queue limits per model of this worker, when
+# SAGEMAKER_MAX_CONCURRENT_INVOCATIONS_PER_MODEL is set
+ADMISSION_CONTROL = admission_utils.admission_control_from_env()
+
 CUSTOM_ATTRIBUTES_HEADER = "X-Amzn-SageMaker-Custom-Attributes"
+STREAM_BLOCK_SIZE = 64 * 1024
+
+GRPC_ERROR_STATUS = {
+    grpc.StatusCode.INVALID_ARGUMENT: falcon.HTTP_400,
+    grpc.StatusCode.NOT_FOUND: falcon.HTTP_404,
+    grpc.StatusCode.FAILED_PRECONDITION: falcon.HTTP_400,
+    grpc.StatusCode.DEADLINE_EXCEEDED: falcon.HTTP_408,
+}
+# predict requests of this worker answered over gRPC, sent over REST instead, and failed
+GRPC_STATS = {"predictions": 0, "rest_fallbacks": 0, "errors": 0}
+GRPC_STATS_LOCK = threading.Lock()
 
 
 def default_handler(data, context):
@@ -50,26 +120,254 @@ def default_handler(data, context):
     :param context: context instance that contains tfs_rest_uri
     :return: inference response from TFS model server
     """
-    data = data.read().decode("utf-8")
-    if not isinstance(data, str):
-        data = json.loads(data)
-    response = requests.post(context.rest_uri, data=data)
+    response = tfs_predict(data, context)
     return response.content, context.accept_header
 
 
+def use_grpc(context):
+    """Returns True if the request should be sent over gRPC. The tfs-protocol custom attribute
+    overrides the models selected by SAGEMAKER_TFS_GRPC_MODELS.
+    """
+    attributes = tfs_utils.parse_custom_attributes_header(context.custom_attributes)
+    protocol = attributes.get("tfs-protocol")
+    if protocol:
+        return protocol == "grpc"
+    grpc_models = [model.strip() for model in TFS_GRPC_MODELS.split(",")]
+    model_name = context.model_name or tfs_utils.uri_model_name(context.rest_uri)
+    return "*" in grpc_models or model_name in grpc_models
+
+
+def use_response_cache(context):
+    if RESPONSE_CACHE is None:
+        return False
+    attributes = tfs_utils.parse_custom_attributes_header(context.custom_attributes)
+    return attributes.get("tfs-cache", "true") != "false"
+
+
+def tfs_predict(data, context):
+    """Send a TFS request body over gRPC if enabled for the model, falling back to REST for
+    payloads and signatures that can not be mapped to tensors.
+
+    A request stream is forwarded to the TFS REST API as it is read, without buffering the
+    whole body, when its length is known.
+
+    Responses are cached when the response cache is enabled, unless the tfs-cache custom
+    attribute is "false".
+
+    :param data: request body (bytes, str, or the file-like request stream)
+    :param context: context instance that contains tfs_rest_uri and the grpc channel
+    :return: requests.Response of the TFS REST API, or an equivalent one built from gRPC
+    """
+    if not use_response_cache(context):
+        return _tfs_predict(data, context)
+
+    if hasattr(data, "read"):
+        data = data.read()
+    body = data.encode("utf-8") if isinstance(data, str) else data
+    key = cache_utils.request_key(context.rest_uri, body)
+    return _cached_response(key, context, lambda: _tfs_predict(body, context))
+
+
+def _tfs_predict(data, context):
+    with METRICS.tfs_call(urlsplit(context.rest_uri).port):
+        return _send_tfs_request(data, context)
+
+
+def _send_tfs_request(data, context):
+    grpc_enabled = use_grpc(context)
+    if hasattr(data, "read"):
+        if context.content_length and not grpc_enabled:
+            return TFS_SESSIONS.post(
+                context.rest_uri, data=_StreamBody(data, context.content_length)
+            )
+        data = data.read()
+
+    if grpc_enabled:
+        body = data.encode("utf-8") if isinstance(data, str) else data
+        response = _grpc_response(lambda: grpc_utils.grpc_predict(body, context, http=TFS_SESSIONS))
+        if response is not None:
+            return response
+
+    return TFS_SESSIONS.post(context.rest_uri, data=data)
+
+
+def tfs_predict_instances(instances, context):
+    """Send a numpy array of instances to TFS as a tensor over gRPC if enabled for the model,
+    or else as a REST request built from the array.
+    """
+    if use_response_cache(context):
+        key = cache_utils.request_key(
+            context.rest_uri, str(instances.dtype), str(instances.shape), instances.tobytes()
+        )
+        return _cached_response(key, context, lambda: _tfs_predict_instances(instances, context))
+    return _tfs_predict_instances(instances, context)
+
+
+def _tfs_predict_instances(instances, context):
+    with METRICS.tfs_call(urlsplit(context.rest_uri).port):
+        return _send_tfs_instances(instances, context)
+
+
+def _send_tfs_instances(instances, context):
+    if use_grpc(context):
+        response = _grpc_response(
+            lambda: grpc_utils.grpc_predict_arrays(instances, context, http=TFS_SESSIONS)
+        )
+        if response is not None:
+            return response
+
+    return TFS_SESSIONS.post(context.rest_uri, data=json_utils.dumps({"instances": instances}))
+
+
+def _cached_response(key, context, predict):
+    cached = RESPONSE_CACHE.get(key)
+    if cached is not None:
+        status, content = cached
+        return _make_response(str(status), content)
+    response = predict()
+    if response.status_code == 200:
+        # named after the model of the URI when no model is given, so that a reload clears it
+        model_name = context.model_name or tfs_utils.uri_model_name(context.rest_uri)
+        RESPONSE_CACHE.put(key, model_name, response.status_code, response.content)
+    return response
+
+
+def count_grpc(name):
+    with GRPC_STATS_LOCK:
+        GRPC_STATS[name] += 1
+
+
+def _grpc_stats():
+    with GRPC_STATS_LOCK:
+        return dict(GRPC_STATS)
+
+
+def _grpc_response(predict):
+    """Returns the response of a gRPC predict call, or None to fall back to REST"""
+    try:
+        response = _make_response(falcon.HTTP_200, predict())
+        count_grpc("predictions")
+        return response
+    except grpc_utils.UnsupportedGrpcRequest as e:
+        log.info("falling back to REST: {}".format(e))
+        count_grpc("rest_fallbacks")
+    except grpc.RpcError as e:
+        count_grpc("errors")
+        status = GRPC_ERROR_STATUS.get(e.code(), falcon.HTTP_500)
+        return _make_response(status, json.dumps({"error": e.details()}).encode("utf-8"))
+    return None
+
+
+def converter_handler(data, context):
+    """Inference request handler that converts CSV and JSON lines requests like
+    tensorflowServing.js does in nginx, when SAGEMAKER_TFS_REQUEST_CONVERTER is "python"
+
+    :param data: input data
+    :param context: context instance that contains tfs_rest_uri
+    :return: inference response from TFS model server
+    """
+    request = tfs_utils.convert_request(data.read(), context.request_content_type)
+    json_context = context._replace(request_content_type="application/json")
+    if isinstance(request, bytes):
+        response = tfs_predict(request, json_context)
+    else:
+        response = tfs_predict_instances(request, json_context)
+    return converted_response(response, context)
+
+
+def converted_response(response, context):
+    """Response body and content type of a converted CSV or JSON lines invocation"""
+    content_types = context.accept_header.replace(" ", "").split(",")
+    if "application/jsonlines" in content_types or "application/json" in content_types:
+        return response.content.replace(b"\n", b""), content_types[0]
+    return response.content, "application/json"
+
+
+class _StreamBody(object):
+    """File-like request body of a known length. requests sends it with a Content-Length
+    header, reading it block by block.
+    """
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(lambda: self._stream.read(STREAM_BLOCK_SIZE), b"")
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+
+def overloaded_response(res, model_name, error):
+    """429 response of an invocation rejected by admission control"""
+    METRICS.inc(
+        "sagemaker_rejected_invocations_total", {"model": model_name, "reason": error.reason}
+    )
+    res.status = falcon.HTTP_429
+    res.set_header("Retry-After", str(error.retry_after_seconds))
+    res.body = json.dumps({"error": str(error)})
+
+
+def _make_response(status, content):
+    response = requests.models.Response()
+    response.status_code = int(status.split()[0])
+    response.headers["Content-Type"] = "application/json"
+    response._content = content
+    return response
+
+
 class PythonServiceResource:
     def __init__(self):
         if SAGEMAKER_MULTI_MODEL_ENABLED:
-            self._model_tfs_rest_port = {}
-            self._model_tfs_grpc_port = {}
-            self._model_tfs_pid = {}
-            self._tfs_ports = self._parse_sagemaker_port_range_mme(SAGEMAKER_TFS_PORT_RANGE)
+            # loaded models and their ports are shared by all gunicorn workers
+            state = SharedState()
+            self._model_registry = ModelRegistry(state, MODEL_LOADING_TIMEOUT_SECONDS)
+            if SAGEMAKER_MME_CONSOLIDATED_TFS:
+                # (rest_port, grpc_port) of the TFS instances shared by all models
+                self._tfs_instances = list(
+                    zip(
+                        [int(port) for port in self._parse_concat_ports(TFS_REST_PORTS)],
+                        [int(port) for port in self._parse_concat_ports(TFS_GRPC_PORTS)],
+                    )
+                )
+                self._port_pool = None
+            else:
+                tfs_ports = self._parse_sagemaker_port_range_mme(SAGEMAKER_TFS_PORT_RANGE)
+                self._port_pool = PortPool(state, tfs_ports["rest_port"], tfs_ports["grpc_port"])
+            # TFS processes started by this worker, by pid
+            self._tfs_processes = {}
+            self._eviction = None
+            if SAGEMAKER_MME_EVICTION_ENABLED:
+                self._eviction = LruEviction(
+                    self._model_registry,
+                    memory_budget_bytes=SAGEMAKER_MME_MEMORY_BUDGET_MB * 1024 * 1024,
+                    max_models=SAGEMAKER_MME_MAX_MODELS,
+                    idle_seconds=SAGEMAKER_MME_EVICTION_IDLE_SECONDS,
+                    consolidated=SAGEMAKER_MME_CONSOLIDATED_TFS,
+                )
+            self._last_access = {}
+            self._model_hits = 0
+            self._model_misses = 0
+            self._model_evictions = 0
+            self._channels = {}
+            # model name -> (expiry time, rest port, TFS model status)
+            self._model_status = {}
+            self._model_status_executor = ThreadPoolExecutor(
+                max_workers=SAGEMAKER_MME_STATUS_CONCURRENCY, thread_name_prefix="model-status"
+            )
             # If Multi-Model mode is enabled, dependencies/handlers will be imported
             # during the _handle_load_model_post()
             self.model_handlers = {}
         else:
             self._tfs_grpc_ports = self._parse_concat_ports(TFS_GRPC_PORTS)
             self._tfs_rest_ports = self._parse_concat_ports(TFS_REST_PORTS)
+            self._router = routing_utils.TfsRouter(
+                self._tfs_grpc_ports, self._tfs_rest_ports, policy=TFS_ROUTING_POLICY
+            )
 
             self._channels = {}
             for grpc_port in self._tfs_grpc_ports:
@@ -77,32 +375,89 @@ class PythonServiceResource:
                 # between each grpc port and channel
                 self._setup_channel(grpc_port)
 
+        # coalesces the predict requests of input_handler/output_handler scripts, when enabled
+        self._batcher = batching_utils.micro_batcher_from_env()
+        # handler, input_handler and output_handler of inference.py, also used by asgi_service
+        self.inference_handlers = None
         if os.path.exists(INFERENCE_SCRIPT_PATH):
             # Single-Model Mode & Multi-Model Mode both use one inference.py
-            self._handler, self._input_handler, self._output_handler = self._import_handlers()
+            self.inference_handlers = self._import_handlers()
+            self._handler, self._input_handler, self._output_handler = self.inference_handlers
             self._handlers = self._make_handler(
                 self._handler, self._input_handler, self._output_handler
             )
         else:
             self._handlers = default_handler
+            if TFS_REQUEST_CONVERTER == "python":
+                self._handlers = converter_handler
 
         self._tfs_enable_batching = SAGEMAKER_BATCHING_ENABLED == "true"
         self._tfs_default_model_name = os.environ.get("TFS_DEFAULT_MODEL_NAME", "None")
         self._tfs_wait_time_seconds = int(os.environ.get("SAGEMAKER_TFS_WAIT_TIME_SECONDS", 300))
+        # names of the models in the model config of a single-model endpoint
+        self._served_models = frozenset()
+        self._served_models_mtime = None
 
     def on_post(self, req, res, model_name=None):
         if model_name or "invocations" in req.uri:
-            self._handle_invocation_post(req, res, model_name)
+            model = self.find_model(model_name)
+            metrics_model_name = self.metrics_model_name(req, model_name, model)
+            with METRICS.invocation(metrics_model_name) as status:
+                try:
+                    with ADMISSION_CONTROL.admit(metrics_model_name):
+                        self._handle_invocation_post(req, res, model_name, model)
+                except admission_utils.Overloaded as e:
+                    overloaded_response(res, metrics_model_name, e)
+                status[0] = res.status.split()[0]
         else:
-            data = json.loads(req.stream.read().decode("utf-8"))
+            self.load_model(res, json_utils.loads(req.stream.read()))
+
+    def find_model(self, model_name):
+        """Returns the registry record of a model invoked on a multi-model endpoint, or None if
+        it is not loaded
+        """
+        if SAGEMAKER_MULTI_MODEL_ENABLED and model_name:
+            return self._model_registry.get(model_name)
+        return None
+
+    def metrics_model_name(self, req, model_name, model):
+        """Name of an invoked model for the metrics labels. Models that are not served are
+        labeled UNKNOWN_MODEL, so that clients cannot add label values.
+        """
+        if SAGEMAKER_MULTI_MODEL_ENABLED:
+            return model_name if model is not None else UNKNOWN_MODEL
+        name = tfs_utils.parse_tfs_custom_attributes(req).get(
+            "tfs-model-name", self._tfs_default_model_name
+        )
+        if name == self._tfs_default_model_name or name in self._served_model_names():
+            return name
+        return UNKNOWN_MODEL
+
+    def _served_model_names(self):
+        # serve.py rewrites the model config when models are added or removed
+        try:
+            mtime = os.stat(MODEL_CONFIG_FILE_PATH).st_mtime_ns
+            if mtime != self._served_models_mtime:
+                with open(MODEL_CONFIG_FILE_PATH, "r", encoding="utf8") as f:
+                    self._served_models = frozenset(tfs_utils.model_config_names(f.read()))
+                self._served_models_mtime = mtime
+        except OSError:
+            pass
+        return self._served_models
+
+    def load_model(self, res, data):
+        with METRICS.timer("sagemaker_model_load_duration_seconds", {}) as labels:
+            labels["status"] = "500"
             self._handle_load_model_post(res, data)
+            labels["status"] = res.status.split()[0]
+
+    def _supported_content_type(self, req):
+        content_type = (req.content_type or "").split(";")[0].strip()
+        return content_type in tfs_utils.JSON_CONTENT_TYPES + (tfs_utils.CSV_CONTENT_TYPE,)
 
     def _parse_concat_ports(self, concat_ports):
         return concat_ports.split(",")
 
-    def _pick_port(self, ports):
-        return random.choice(ports)
-
     def _parse_sagemaker_port_range_mme(self, port_range):
         lower, upper = port_range.split("-")
         lower = int(lower)
@@ -115,166 +470,367 @@ class PythonServiceResource:
         }
         return tfs_ports
 
-    def _ports_available(self):
-        with lock():
-            rest_ports = self._tfs_ports["rest_port"]
-            grpc_ports = self._tfs_ports["grpc_port"]
-        return len(rest_ports) > 0 and len(grpc_ports) > 0
-
     def _handle_load_model_post(self, res, data):  # noqa: C901
         model_name = data["model_name"]
         base_path = data["url"]
+        self._reap_tfs_processes()
+
+        # validate model files are in the specified base_path
+        if not self.validate_model_dir(base_path):
+            res.status = falcon.HTTP_404
+            res.body = json.dumps(
+                {
+                    "error": "Could not find valid base path {} for servable {}".format(
+                        base_path, model_name
+                    )
+                }
+            )
+            return
 
-        # model is already loaded
-        if model_name in self._model_tfs_pid:
+        size_bytes = None
+        if self._eviction is not None or SAGEMAKER_MME_CONSOLIDATED_TFS:
+            size_bytes = model_size_bytes(base_path)
+
+        # model is already loaded, or being loaded by another worker
+        if not self._model_registry.reserve(model_name, base_path, size_bytes):
             res.status = falcon.HTTP_409
             res.body = json.dumps({"error": "Model {} is already loaded.".format(model_name)})
+            return
+
+        # evict after reserving, so that concurrent loads see each other
+        if self._eviction is not None and not self._evict_for_load(model_name, size_bytes):
+            self._model_registry.remove(model_name)
+            res.status = falcon.HTTP_507
+            res.body = json.dumps(
+                {"error": "Memory exhausted: over the model budget, and no idle model to evict."}
+            )
+            return
+
+        if SAGEMAKER_MME_CONSOLIDATED_TFS:
+            self._load_model_consolidated(res, model_name, base_path, size_bytes)
+            return
 
-        # check if there are available ports
-        if not self._ports_available():
+        # reserve ports, shared with the other gunicorn workers, after freeing the ones of a
+        # load abandoned by another worker
+        self._port_pool.release_model(model_name)
+        ports = self._port_pool.allocate(model_name)
+        if ports is None:
+            self._model_registry.remove(model_name)
             res.status = falcon.HTTP_507
             res.body = json.dumps(
                 {"error": "Memory exhausted: no available ports to load the model."}
             )
-        with lock():
-            self._model_tfs_rest_port[model_name] = self._tfs_ports["rest_port"].pop()
-            self._model_tfs_grpc_port[model_name] = self._tfs_ports["grpc_port"].pop()
+            return
+        rest_port, grpc_port = ports
 
-        # validate model files are in the specified base_path
-        if self.validate_model_dir(base_path):
-            try:
-                tfs_config = tfs_utils.create_tfs_config_individual_model(model_name, base_path)
-                tfs_config_file = "/sagemaker/tfs-config/{}/model-config.cfg".format(model_name)
-                log.info("tensorflow serving model config: \n%s\n", tfs_config)
-                os.makedirs(os.path.dirname(tfs_config_file))
-                with open(tfs_config_file, "w", encoding="utf8") as f:
-                    f.write(tfs_config)
-
-                batching_config_file = "/sagemaker/batching/{}/batching-config.cfg".format(
-                    model_name
-                )
-                if self._tfs_enable_batching:
-                    tfs_utils.create_batching_config(batching_config_file)
-
-                cmd = tfs_utils.tfs_command(
-                    self._model_tfs_grpc_port[model_name],
-                    self._model_tfs_rest_port[model_name],
-                    tfs_config_file,
-                    self._tfs_enable_batching,
-                    batching_config_file,
-                )
-                p = subprocess.Popen(cmd.split())
+        tfs_config_file = "/sagemaker/tfs-config/{}/model-config.cfg".format(model_name)
+        batching_config_file = "/sagemaker/batching/{}/batching-config.cfg".format(model_name)
+        p = None
+        try:
+            tfs_config = tfs_utils.create_tfs_config_individual_model(model_name, base_path)
+            log.info("tensorflow serving model config: \n%s\n", tfs_config)
+            os.makedirs(os.path.dirname(tfs_config_file), exist_ok=True)
+            with open(tfs_config_file, "w", encoding="utf8") as f:
+                f.write(tfs_config)
 
-                tfs_utils.wait_for_model(
-                    self._model_tfs_rest_port[model_name], model_name, self._tfs_wait_time_seconds
-                )
+            if self._tfs_enable_batching:
+                os.makedirs(os.path.dirname(batching_config_file), exist_ok=True)
+                tfs_utils.create_batching_config(batching_config_file)
 
-                log.info("started tensorflow serving (pid: %d)", p.pid)
-                # update model name <-> tfs pid map
-                self._model_tfs_pid[model_name] = p
+            cmd = tfs_utils.tfs_command(
+                grpc_port,
+                rest_port,
+                tfs_config_file,
+                self._tfs_enable_batching,
+                batching_config_file,
+            )
+            p = subprocess.Popen(cmd.split())
+            self._tfs_processes[p.pid] = p
 
-                res.status = falcon.HTTP_200
-                res.body = json.dumps(
-                    {
-                        "success": "Successfully loaded model {}, "
-                        "listening on rest port {} "
-                        "and grpc port {}.".format(
-                            model_name,
-                            self._model_tfs_rest_port,
-                            self._model_tfs_grpc_port,
-                        )
-                    }
-                )
-            except MultiModelException as multi_model_exception:
-                self._cleanup_config_file(tfs_config_file)
-                self._cleanup_config_file(batching_config_file)
-                if multi_model_exception.code == 409:
-                    res.status = falcon.HTTP_409
-                    res.body = multi_model_exception.msg
-                elif multi_model_exception.code == 408:
-                    res.status = falcon.HTTP_408
-                    res.body = multi_model_exception.msg
-                else:
-                    raise MultiModelException(falcon.HTTP_500, multi_model_exception.msg)
-            except FileExistsError as e:
+            tfs_utils.wait_for_model(
+                rest_port,
+                model_name,
+                self._tfs_wait_time_seconds,
+                session=TFS_SESSIONS.session(rest_port),
+            )
+
+            log.info("started tensorflow serving (pid: %d)", p.pid)
+            # publish model name <-> tfs ports and pid to all workers
+            self._model_registry.set_available(model_name, rest_port, grpc_port, p.pid)
+            self._setup_channel(grpc_port)
+
+            res.status = falcon.HTTP_200
+            res.body = json.dumps(
+                {
+                    "success": "Successfully loaded model {}, "
+                    "listening on rest port {} "
+                    "and grpc port {}.".format(model_name, rest_port, grpc_port)
+                }
+            )
+        except MultiModelException as multi_model_exception:
+            self._abort_load(model_name, ports, p, tfs_config_file, batching_config_file)
+            if multi_model_exception.code == 409:
                 res.status = falcon.HTTP_409
-                res.body = json.dumps(
-                    {"error": "Model {} is already loaded. {}".format(model_name, str(e))}
+                res.body = multi_model_exception.msg
+            elif multi_model_exception.code == 408:
+                res.status = falcon.HTTP_408
+                res.body = multi_model_exception.msg
+            else:
+                raise MultiModelException(falcon.HTTP_500, multi_model_exception.msg)
+        except OSError as os_error:
+            self._abort_load(model_name, ports, p, tfs_config_file, batching_config_file)
+            if os_error.errno == 12:
+                raise MultiModelException(
+                    falcon.HTTP_507,
+                    "Memory exhausted: " "not enough memory to start TFS instance",
                 )
-            except OSError as os_error:
-                self._cleanup_config_file(tfs_config_file)
-                self._cleanup_config_file(batching_config_file)
-                if os_error.errno == 12:
+            else:
+                raise MultiModelException(falcon.HTTP_500, os_error.strerror)
+        except Exception:  # pylint: disable=broad-except
+            # e.g. the model did not become available within SAGEMAKER_TFS_WAIT_TIME_SECONDS
+            self._abort_load(model_name, ports, p, tfs_config_file, batching_config_file)
+            raise
+
+    def _abort_load(self, model_name, ports, process, tfs_config_file, batching_config_file):
+        if process is not None:
+            process.kill()
+            process.wait()
+            self._tfs_processes.pop(process.pid, None)
+        self._cleanup_config_file(tfs_config_file)
+        self._cleanup_config_file(batching_config_file)
+        self._port_pool.release(ports)
+        self._model_registry.remove(model_name)
+
+    def _load_model_consolidated(self, res, model_name, base_path, size_bytes):
+        """Adds a model reserved in the registry to the shared TFS instance with the least bytes
+        of models loaded
+        """
+        rest_port, grpc_port = self._model_registry.assign(
+            model_name, self._tfs_instances, size_bytes
+        )
+        try:
+            self._reload_tfs_instance(rest_port, grpc_port)
+            tfs_utils.wait_for_model(
+                rest_port,
+                model_name,
+                self._tfs_wait_time_seconds,
+                session=TFS_SESSIONS.session(rest_port),
+            )
+        except MultiModelException as multi_model_exception:
+            # e.g. TFS rejected the model
+            self._abort_load_consolidated(model_name, rest_port, grpc_port)
+            res.status = multi_model_exception.code
+            res.body = json.dumps({"error": multi_model_exception.msg})
+            return
+        except Exception:  # pylint: disable=broad-except
+            self._abort_load_consolidated(model_name, rest_port, grpc_port)
+            raise
+
+        self._model_registry.set_available(
+            model_name, rest_port, grpc_port, instance_pid(rest_port)
+        )
+        res.status = falcon.HTTP_200
+        res.body = json.dumps(
+            {
+                "success": "Successfully loaded model {}, "
+                "listening on rest port {} "
+                "and grpc port {}.".format(model_name, rest_port, grpc_port)
+            }
+        )
+
+    def _abort_load_consolidated(self, model_name, rest_port, grpc_port):
+        self._model_registry.remove(model_name)
+        try:
+            self._reload_tfs_instance(rest_port, grpc_port)
+        except MultiModelException as e:
+            log.error("failed to remove model {} from TFS: {}".format(model_name, e.msg))
+
+    def _reload_tfs_instance(self, rest_port, grpc_port):
+        """Writes the models assigned to a shared TFS instance to its model config file, and
+        makes the instance load it with the ReloadConfig API if available. Otherwise the instance
+        picks it up on its next poll of the file.
+        """
+        with lock(INSTANCE_LOCK_FILE.format(rest_port)):
+            config = tfs_utils.create_tfs_config(self._model_registry.instance_models(rest_port))
+            log.info("tensorflow serving model config (port {}): \n{}\n".format(rest_port, config))
+            tfs_utils.write_tfs_config(INSTANCE_CONFIG_FILE.format(rest_port), config)
+            if grpc_utils.GRPC_RELOAD_CONFIG_AVAILABLE:
+                self._setup_channel(grpc_port)
+                try:
+                    grpc_utils.reload_model_config(self._channels[grpc_port], config)
+                except (grpc.RpcError, RuntimeError) as e:
                     raise MultiModelException(
-                        falcon.HTTP_507,
-                        "Memory exhausted: " "not enough memory to start TFS instance",
+                        falcon.HTTP_500, "failed to reload TFS model config: {}".format(e)
                     )
-                else:
-                    raise MultiModelException(falcon.HTTP_500, os_error.strerror)
+
+    def _free_port_pairs(self):
+        # shared TFS instances do not need ports per model
+        return None if self._port_pool is None else self._port_pool.available()
+
+    def _evict_for_load(self, model_name, size_bytes):
+        """Returns False if the model cannot be loaded within the budget"""
+        while self._eviction.over_budget(self._free_port_pairs(), model_name, size_bytes):
+            model = self._eviction.pick_victim()
+            if model is None:
+                log.warning("over the model budget, but no idle model can be evicted")
+                return False
+            if self._model_registry.claim(model["model_name"]):
+                log.info("evicting least recently used model {}".format(model["model_name"]))
+                self._unload_model(model)
+                self._model_evictions += 1
+        return True
+
+    def _record_access(self, model_name):
+        now = time.time()
+        if now - self._last_access.get(model_name, 0) >= LAST_ACCESS_RESOLUTION_SECONDS:
+            self._last_access[model_name] = now
+            self._model_registry.touch(model_name, now)
+
+    def _kill_tfs_process(self, pid):
+        process = self._tfs_processes.pop(pid, None)
+        if process is not None:
+            process.kill()
+            process.wait()
         else:
-            res.status = falcon.HTTP_404
-            res.body = json.dumps(
-                {
-                    "error": "Could not find valid base path {} for servable {}".format(
-                        base_path, model_name
-                    )
-                }
-            )
+            # started by another worker, which reaps it
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self._reap_tfs_processes()
+
+    def _reap_tfs_processes(self):
+        # TFS processes started by this worker may have been killed by another worker
+        for pid, process in list(self._tfs_processes.items()):
+            if process.poll() is not None:
+                del self._tfs_processes[pid]
 
     def _cleanup_config_file(self, config_file):
         if os.path.exists(config_file):
             os.remove(config_file)
 
-    def _handle_invocation_post(self, req, res, model_name=None):
+    def _handle_invocation_post(self, req, res, model_name=None, model=None):
+        invocation = self.invocation_context(req, res, model_name, model)
+        if invocation is None:
+            return
+
+        data, context, route = invocation
+        try:
+            res.status = falcon.HTTP_200
+
+            res.body, res.content_type = self._handlers(data, context)
+        except Exception as e:  # pylint: disable=broad-except
+            log.exception("exception handling request: {}".format(e))
+            res.status = falcon.HTTP_500
+            res.body = json.dumps({"error": str(e)}).encode("utf-8")  # pylint: disable=E1101
+        finally:
+            self.release_route(route)
+
+    def invocation_context(self, req, res, model_name=None, model=None):
+        """Picks the TFS instance of an invocation.
+
+        :param model: registry record of model_name returned by find_model, on a multi-model
+            endpoint
+        :return: the request stream, the tfs_utils.Context and the route to release once the
+            invocation completes; or None if the error response is set on res
+        """
+        if self._handlers is converter_handler and not self._supported_content_type(req):
+            res.status = falcon.HTTP_415
+            res.body = json.dumps(
+                {"error": "Unsupported Media Type: {}".format(req.content_type or "Unknown")}
+            )
+            return None
+
+        route = None
         if SAGEMAKER_MULTI_MODEL_ENABLED:
             if model_name:
-                if model_name not in self._model_tfs_rest_port:
+                if model is None:
+                    self._model_misses += 1
                     res.status = falcon.HTTP_404
                     res.body = json.dumps(
                         {"error": "Model {} is not loaded yet.".format(model_name)}
                     )
-                    return
+                    return None
                 else:
+                    self._model_hits += 1
+                    self._record_access(model_name)
                     log.info("model name: {}".format(model_name))
-                    rest_port = self._model_tfs_rest_port[model_name]
-                    log.info("rest port: {}".format(str(self._model_tfs_rest_port[model_name])))
-                    grpc_port = self._model_tfs_grpc_port[model_name]
-                    log.info("grpc port: {}".format(str(self._model_tfs_grpc_port[model_name])))
+                    rest_port = model["rest_port"]
+                    log.info("rest port: {}".format(str(rest_port)))
+                    grpc_port = model["grpc_port"]
+                    log.info("grpc port: {}".format(str(grpc_port)))
+                    self._setup_channel(grpc_port)
                     data, context = tfs_utils.parse_request(
                         req,
                         rest_port,
                         grpc_port,
                         self._tfs_default_model_name,
                         model_name=model_name,
+                        channel=self._channels[grpc_port],
                     )
             else:
                 res.status = falcon.HTTP_400
                 res.body = json.dumps({"error": "Invocation request does not contain model name."})
+                return None
         else:
-            # Randomly pick port used for routing incoming request.
-            grpc_port = self._pick_port(self._tfs_grpc_ports)
-            rest_port = self._pick_port(self._tfs_rest_ports)
-            data, context = tfs_utils.parse_request(
-                req,
-                rest_port,
-                grpc_port,
-                self._tfs_default_model_name,
-                channel=self._channels[grpc_port],
-            )
+            # Pick the TFS instance (grpc and rest port pair) used for routing incoming request.
+            route = self._router.acquire()
+            instance, _ = route
+            grpc_port = instance.grpc_port
+            rest_port = instance.rest_port
+            try:
+                data, context = tfs_utils.parse_request(
+                    req,
+                    rest_port,
+                    grpc_port,
+                    self._tfs_default_model_name,
+                    channel=self._channels[grpc_port],
+                )
+            except Exception:  # pylint: disable=broad-except
+                # the route is only released by the caller once the context is returned
+                self._router.release(route)
+                raise
+        return data, context, route
 
-        try:
-            res.status = falcon.HTTP_200
+    def release_route(self, route):
+        if route:
+            self._router.release(route)
 
-            res.body, res.content_type = self._handlers(data, context)
-        except Exception as e:  # pylint: disable=broad-except
-            log.exception("exception handling request: {}".format(e))
-            res.status = falcon.HTTP_500
-            res.body = json.dumps({"error": str(e)}).encode("utf-8")  # pylint: disable=E1101
+    def stats(self):
+        stats = {}
+        if SAGEMAKER_MULTI_MODEL_ENABLED:
+            stats["free_port_pairs"] = self._free_port_pairs()
+            now = time.time()
+            models = [
+                {
+                    "model_name": model["model_name"],
+                    "pid": model["pid"],
+                    "rss_bytes": process_rss_bytes(model["pid"]),
+                    "idle_seconds": round(now - (model["last_access"] or now), 3),
+                }
+                for model in self._model_registry.list()
+            ]
+            stats["models"] = {
+                "hits": self._model_hits,
+                "misses": self._model_misses,
+                "evictions": self._model_evictions,
+                "rss_bytes": sum(
+                    process_rss_bytes(pid) for pid in set(model["pid"] for model in models)
+                ),
+                "loaded": models,
+            }
+        else:
+            stats["tfs_routing"] = self._router.stats()
+        if self._batcher:
+            stats["micro_batching"] = self._batcher.stats()
+        if ADMISSION_CONTROL.enabled:
+            stats["admission_control"] = ADMISSION_CONTROL.stats()
+        return stats
 
     def _setup_channel(self, grpc_port):
         if grpc_port not in self._channels:
             log.info("Creating grpc channel for port: %s", grpc_port)
-            self._channels[grpc_port] = grpc.insecure_channel("localhost:{}".format(grpc_port))
+            self._channels[grpc_port] = grpc.insecure_channel(tfs_utils.grpc_target(grpc_port))
 
     def _import_handlers(self):
         inference_script = INFERENCE_SCRIPT_PATH
@@ -299,68 +855,142 @@ class PythonServiceResource:
 
         def handler(data, context):
             processed_input = custom_input_handler(data, context)
-            response = requests.post(context.rest_uri, data=processed_input)
+            # input handlers always produce a TFS REST (json) request body
+            json_context = context._replace(request_content_type="application/json")
+            if self._batcher:
+                # waiting for a batch is accounted as TFS time
+                with METRICS.tfs_call(urlsplit(json_context.rest_uri).port):
+                    response = self._batcher.predict(processed_input, json_context, tfs_predict)
+            else:
+                response = tfs_predict(processed_input, json_context)
             return custom_output_handler(response, context)
 
         return handler
 
     def on_get(self, req, res, model_name=None):  # pylint: disable=W0613
         if model_name is None:
-            models_info = {}
-            uri = "http://localhost:{}/v1/models/{}"
-            for model, port in self._model_tfs_rest_port.items():
-                try:
-                    info = json.loads(requests.get(uri.format(port, model)).content)
-                    models_info[model] = info
-                except ValueError as e:
-                    log.exception("exception handling request: {}".format(e))
-                    res.status = falcon.HTTP_500
-                    res.body = json.dumps({"error": str(e)}).encode("utf-8")
+            max_results = req.get_param_as_int("max_results")
+            if max_results is None:
+                models = self._model_registry.list()
+                res.status = falcon.HTTP_200
+                res.body = json.dumps(self._model_statuses(models))
+                return
+
+            if max_results < 1:
+                res.status = falcon.HTTP_400
+                res.body = json.dumps({"error": "max_results must be a positive integer"})
+                return
+
+            # one more model tells whether there is a next page
+            models = self._model_registry.list(req.get_param("next_token"), max_results + 1)
+            page = {"models": self._model_statuses(models[:max_results])}
+            if len(models) > max_results:
+                page["next_token"] = models[max_results - 1]["model_name"]
             res.status = falcon.HTTP_200
-            res.body = json.dumps(models_info)
+            res.body = json.dumps(page)
         else:
-            if model_name not in self._model_tfs_rest_port:
+            model = self._model_registry.get(model_name)
+            if model is None:
                 res.status = falcon.HTTP_404
                 res.body = json.dumps(
-                    {"error": "Model {} is loaded yet.".format(model_name)}
+                    {"error": "Model {} is not loaded yet.".format(model_name)}
                 ).encode("utf-8")
             else:
-                port = self._model_tfs_rest_port[model_name]
-                uri = "http://localhost:{}/v1/models/{}".format(port, model_name)
-                try:
-                    info = requests.get(uri)
+                info = self._model_statuses([model])[model_name]
+                if "error" in info:
+                    res.status = falcon.HTTP_500
+                    res.body = json.dumps(info).encode("utf-8")
+                else:
                     res.status = falcon.HTTP_200
                     res.body = json.dumps({"model": info}).encode("utf-8")
-                except ValueError as e:
-                    log.exception("exception handling GET models request.")
-                    res.status = falcon.HTTP_500
-                    res.body = json.dumps({"error": str(e)}).encode("utf-8")
+
+    def _model_statuses(self, models):
+        """Returns the TFS status of each model by name. Statuses older than
+        SAGEMAKER_MME_STATUS_TTL_SECONDS are requested from TFS concurrently.
+        """
+        now = time.time()
+        statuses = {}
+        expired = []
+        for model in models:
+            cached = self._model_status.get(model["model_name"])
+            if cached and cached[0] > now and cached[1] == model["rest_port"]:
+                statuses[model["model_name"]] = cached[2]
+            else:
+                expired.append(model)
+
+        for model, status in zip(
+            expired, self._model_status_executor.map(self._request_model_status, expired)
+        ):
+            statuses[model["model_name"]] = status
+            if "error" not in status:
+                self._model_status[model["model_name"]] = (
+                    now + SAGEMAKER_MME_STATUS_TTL_SECONDS,
+                    model["rest_port"],
+                    status,
+                )
+        return statuses
+
+    def _request_model_status(self, model):
+        uri = "http://localhost:{}/v1/models/{}".format(model["rest_port"], model["model_name"])
+        try:
+            return json_utils.loads(TFS_SESSIONS.get(uri).content)
+        except (ValueError, requests.exceptions.RequestException) as e:
+            log.error("failed to get the status of model {}: {}".format(model["model_name"], e))
+            return {"error": str(e)}
 
     def on_delete(self, req, res, model_name):  # pylint: disable=W0613
-        if model_name not in self._model_tfs_pid:
+        model = self._model_registry.get(model_name)
+        if model is None or not self._model_registry.claim(model_name):
             res.status = falcon.HTTP_404
             res.body = json.dumps({"error": "Model {} is not loaded yet".format(model_name)})
         else:
             try:
-                self._model_tfs_pid[model_name].kill()
-                os.remove("/sagemaker/tfs-config/{}/model-config.cfg".format(model_name))
-                os.rmdir("/sagemaker/tfs-config/{}".format(model_name))
-                release_rest_port = self._model_tfs_rest_port[model_name]
-                release_grpc_port = self._model_tfs_grpc_port[model_name]
-                with lock():
-                    bisect.insort(self._tfs_ports["rest_port"], release_rest_port)
-                    bisect.insort(self._tfs_ports["grpc_port"], release_grpc_port)
-                del self._model_tfs_rest_port[model_name]
-                del self._model_tfs_grpc_port[model_name]
-                del self._model_tfs_pid[model_name]
+                self._unload_model(model)
                 res.status = falcon.HTTP_200
                 res.body = json.dumps(
                     {"success": "Successfully unloaded model {}.".format(model_name)}
                 )
-            except OSError as error:
+            except (OSError, MultiModelException) as error:
                 res.status = falcon.HTTP_500
                 res.body = json.dumps({"error": str(error)}).encode("utf-8")
 
+    def _unload_model(self, model):
+        """Stops the TFS process of a model claimed for unloading and frees its resources"""
+        with METRICS.timer("sagemaker_model_unload_duration_seconds", {}) as labels:
+            labels["status"] = "500"
+            self._unload_tfs_model(model)
+            labels["status"] = "200"
+
+    def _unload_tfs_model(self, model):
+        model_name = model["model_name"]
+        grpc_utils.clear_signature_cache(model_name)
+        if RESPONSE_CACHE:
+            RESPONSE_CACHE.invalidate(model_name)
+        if SAGEMAKER_MME_CONSOLIDATED_TFS:
+            # the shared instance keeps serving the other models, so only its config changes
+            try:
+                self._reload_tfs_instance(model["rest_port"], model["grpc_port"])
+            finally:
+                self._last_access.pop(model_name, None)
+                self._model_status.pop(model_name, None)
+                self._model_registry.remove(model_name)
+            return
+
+        release_rest_port = model["rest_port"]
+        release_grpc_port = model["grpc_port"]
+        try:
+            self._kill_tfs_process(model["pid"])
+            os.remove("/sagemaker/tfs-config/{}/model-config.cfg".format(model_name))
+            os.rmdir("/sagemaker/tfs-config/{}".format(model_name))
+        finally:
+            self._last_access.pop(model_name, None)
+            self._model_status.pop(model_name, None)
+            if release_grpc_port in self._channels:
+                self._channels.pop(release_grpc_port).close()
+            TFS_SESSIONS.close(release_rest_port)
+            self._model_registry.remove(model_name)
+            self._port_pool.release([release_rest_port, release_grpc_port])
+
     def validate_model_dir(self, model_path):
         # model base path doesn't exits
         if not os.path.exists(model_path):
@@ -389,14 +1019,61 @@ class PingResource:
         res.status = falcon.HTTP_200
 
 
+class StatsResource:
+    """Reports counters of the gunicorn worker that handles the request"""
+
+    def __init__(self, python_service_resource):
+        self._python_service_resource = python_service_resource
+
+    def on_get(self, req, res):  # pylint: disable=W0613
+        stats = {
+            "pid": os.getpid(),
+            # peak resident memory of this worker since it started
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "tfs_connections": TFS_SESSIONS.stats(),
+            "grpc": _grpc_stats(),
+        }
+        if RESPONSE_CACHE:
+            stats["response_cache"] = RESPONSE_CACHE.stats()
+        stats.update(self._python_service_resource.stats())
+        res.status = falcon.HTTP_200
+        res.body = json.dumps(stats)
+
+
+class MetricsResource:
+    """Reports the metrics of all gunicorn workers and serve.py in the Prometheus text format"""
+
+    def on_get(self, req, res):  # pylint: disable=W0613
+        METRICS.flush()
+        values, buckets = metrics_utils.collect()
+        if RESPONSE_CACHE:
+            cache_stats = RESPONSE_CACHE.stats()
+            for name in ["hits", "misses", "evictions"]:
+                key = metrics_utils.metric_key("sagemaker_response_cache_{}_total".format(name), {})
+                values[key] = cache_stats[name]
+            key = metrics_utils.metric_key("sagemaker_response_cache_size_bytes", {})
+            values[key] = cache_stats["size_bytes"]
+        res.status = falcon.HTTP_200
+        res.content_type = "text/plain; version=0.0.4"
+        res.body = metrics_utils.render(values, buckets)
+
+
 class ServiceResources:
     def __init__(self):
         self._enable_model_manager = SAGEMAKER_MULTI_MODEL_ENABLED
         self._python_service_resource = PythonServiceResource()
         self._ping_resource = PingResource()
+        self._stats_resource = StatsResource(self._python_service_resource)
+        self._metrics_resource = MetricsResource()
+
+    @property
+    def python_service_resource(self):
+        return self._python_service_resource
 
     def add_routes(self, application):
         application.add_route("/ping", self._ping_resource)
+        application.add_route("/stats", self._stats_resource)
+        application.add_route("/metrics", self._metrics_resource)
         application.add_route("/invocations", self._python_service_resource)
 
         if self._enable_model_manager:
@@ -0,0 +1,110 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import logging
+import random
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+ROUTING_POLICIES = ["random", "least_outstanding", "ewma"]
+
+
+class TfsInstance(object):
+    def __init__(self, index, grpc_port, rest_port):
+        self.index = index
+        self.grpc_port = grpc_port
+        self.rest_port = rest_port
+        self.in_flight = 0
+        self.requests = 0
+        self.ewma_latency = 0.0
+
+    def stats(self):
+        return {
+            "grpc_port": self.grpc_port,
+            "rest_port": self.rest_port,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 3),
+        }
+
+
+class TfsRouter(object):
+    """Picks the TFS instance (a grpc and rest port pair) that serves a request.
+
+    "least_outstanding" picks the instance with the fewest in-flight requests of this worker,
+    "ewma" additionally weights them by the moving average of their latency, and "random"
+    keeps the previous behavior. Ties are broken randomly.
+    """
+
+    def __init__(self, grpc_ports, rest_ports, policy="least_outstanding", ewma_alpha=0.3):
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(
+                "routing policy must be one of {}, got {}".format(ROUTING_POLICIES, policy)
+            )
+        if len(grpc_ports) != len(rest_ports):
+            raise ValueError("grpc and rest ports must be provided for every TFS instance")
+
+        self._policy = policy
+        self._ewma_alpha = ewma_alpha
+        self._instances = [
+            TfsInstance(i, grpc_port, rest_port)
+            for i, (grpc_port, rest_port) in enumerate(zip(grpc_ports, rest_ports))
+        ]
+        self._lock = threading.Lock()
+        log.info("tfs routing policy: {}".format(policy))
+
+    def acquire(self):
+        with self._lock:
+            instance = self._pick()
+            instance.in_flight += 1
+            instance.requests += 1
+        return instance, time.time()
+
+    def release(self, ticket):
+        instance, start_time = ticket
+        latency = time.time() - start_time
+        with self._lock:
+            instance.in_flight -= 1
+            if instance.ewma_latency:
+                alpha = self._ewma_alpha
+                instance.ewma_latency = alpha * latency + (1 - alpha) * instance.ewma_latency
+            else:
+                instance.ewma_latency = latency
+
+    def _pick(self):
+        if self._policy == "random" or len(self._instances) == 1:
+            return random.choice(self._instances)
+
+        if self._policy == "ewma":
+            # instances without samples yet are scored as the fastest one
+            scored = [i.ewma_latency for i in self._instances if i.ewma_latency]
+            default_latency = min(scored) if scored else 1.0
+
+            def score(instance):
+                return (instance.in_flight + 1) * (instance.ewma_latency or default_latency)
+
+        else:
+
+            def score(instance):
+                return instance.in_flight
+
+        best = min(score(i) for i in self._instances)
+        return random.choice([i for i in self._instances if score(i) == best])
+
+    def stats(self):
+        return {
+            "policy": self._policy,
+            "instances": [instance.stats() for instance in self._instances],
+        }
@@ -0,0 +1,115 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# ETags of the downloaded objects, by key, written to the destination directory
+MANIFEST_FILE = ".s3-manifest.json"
+DEFAULT_MAX_WORKERS = 16
+DEFAULT_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+)
+
+
+def has_manifest(destination_dir):
+    return os.path.exists(os.path.join(destination_dir, MANIFEST_FILE))
+
+
+def download_prefix(
+    client,
+    bucket,
+    prefix,
+    destination_dir,
+    max_workers=DEFAULT_MAX_WORKERS,
+    transfer_config=DEFAULT_TRANSFER_CONFIG,
+):
+    """Download the objects directly under an S3 prefix to destination_dir/<key>, skipping the
+    objects whose ETag matches the manifest of a previous download.
+
+    :param client: boto3 S3 client
+    :return: dict with the number of downloaded and skipped objects, bytes and seconds spent
+    """
+    start = time.time()
+    manifest_path = os.path.join(destination_dir, MANIFEST_FILE)
+    manifest = _read_manifest(manifest_path)
+
+    objects = []
+    paginator = client.get_paginator("list_objects_v2")
+    for result in paginator.paginate(Bucket=bucket, Delimiter="/", Prefix=prefix):
+        objects.extend(result.get("Contents", []))
+
+    downloads = []
+    # only objects that are still under the prefix and fully downloaded stay in the manifest
+    current = {}
+    for obj in objects:
+        destination = os.path.join(destination_dir, obj["Key"])
+        if manifest.get(obj["Key"]) == obj["ETag"] and os.path.exists(destination):
+            current[obj["Key"]] = obj["ETag"]
+        else:
+            downloads.append(obj)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                (
+                    obj,
+                    executor.submit(
+                        _download, client, bucket, obj, destination_dir, transfer_config
+                    ),
+                )
+                for obj in downloads
+            ]
+            for obj, future in futures:
+                future.result()
+                current[obj["Key"]] = obj["ETag"]
+    finally:
+        _write_manifest(manifest_path, current)
+
+    report = {
+        "downloaded": len(downloads),
+        "skipped": len(objects) - len(downloads),
+        "bytes": sum(obj["Size"] for obj in downloads),
+        "seconds": round(time.time() - start, 3),
+    }
+    log.info("downloaded s3://{}/{}: {}".format(bucket, prefix, report))
+    return report
+
+
+def _download(client, bucket, obj, destination_dir, transfer_config):
+    destination = os.path.join(destination_dir, obj["Key"])
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    client.download_file(bucket, obj["Key"], destination, Config=transfer_config)
+
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path, "r", encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_manifest(manifest_path, manifest):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w", encoding="utf8") as f:
+        json.dump(manifest, f)
@@ -12,13 +12,30 @@
 # language governing permissions and limitations under the License.
 
 import boto3
+import grpc
+import hashlib
+import importlib.util
 import logging
+import multiprocessing
 import os
 import re
+import shutil
 import signal
+import socket
 import subprocess
+import sys
+import threading
+import time
+import cache_utils
+import calibration_utils
+import cpu_utils
+import grpc_utils
+import metrics_utils
+import multi_model_utils
+import s3_utils
 import tfs_utils
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 logging.basicConfig(level=logging.INFO)
@@ -28,21 +45,47 @@ JS_PING = "js_content tensorflowServing.ping"
 JS_INVOCATIONS = "js_content tensorflowServing.invocations"
 GUNICORN_PING = "proxy_pass http://gunicorn_upstream/ping"
 GUNICORN_INVOCATIONS = "proxy_pass http://gunicorn_upstream/invocations"
+GUNICORN_METRICS = "proxy_pass http://gunicorn_upstream/metrics"
+# the metrics are kept by python_service, which only runs when invocations are forwarded to it
+NO_METRICS = (
+    'return 404 \'{"error": "Metrics are served by python_service, which is not running"}\''
+)
 MULTI_MODEL = "s" if os.environ.get("SAGEMAKER_MULTI_MODEL", "False").lower() == "true" else ""
 MODEL_DIR = f"model{MULTI_MODEL}"
 CODE_DIR = "/opt/ml/{}/code".format(MODEL_DIR)
 PYTHON_LIB_PATH = os.path.join(CODE_DIR, "lib")
 REQUIREMENTS_PATH = os.path.join(CODE_DIR, "requirements.txt")
 INFERENCE_PATH = os.path.join(CODE_DIR, "inference.py")
+# written into a requirements.txt cache entry once all packages are installed
+REQUIREMENTS_CACHE_MARKER = ".complete"
+GUNICORN_SOCKET = "/tmp/gunicorn.sock"
+# packages of asgi_service, and the gunicorn worker serving it
+ASGI_MODULES = ["uvicorn", "aiohttp", "falcon.asgi"]
+ASGI_WORKER_CLASS = "uvicorn.workers.UvicornWorker"
+# first and maximum delay between two readiness checks of gunicorn and nginx
+READY_INITIAL_INTERVAL_SECONDS = 0.005
+READY_MAX_INTERVAL_SECONDS = 0.25
+NGINX_WAIT_TIME_SECONDS = 10
+# environment variables of the batching parameters that calibration does not override
+CALIBRATED_BATCHING_ENV_VARS = {
+    "max_batch_size": "SAGEMAKER_TFS_MAX_BATCH_SIZE",
+    "batch_timeout_micros": "SAGEMAKER_TFS_BATCH_TIMEOUT_MICROS",
+}
 
 
 class ServiceManager(object):
     def __init__(self):
         self._state = "initializing"
+        self._start_time = time.time()
+        # (phase, seconds since start) of the completed startup phases
+        self._timeline = []
+        # restarts of the services, reported by /metrics
+        self._metrics = metrics_utils.Metrics(name="serve")
         self._nginx = None
         self._tfs = []
         self._gunicorn = None
         self._gunicorn_command = None
+        self._python_code = None
         self._enable_python_service = False
         self._tfs_version = os.environ.get("SAGEMAKER_TFS_VERSION", "1.13")
         self._nginx_http_port = os.environ.get("SAGEMAKER_BIND_TO_PORT", "8080")
@@ -52,18 +95,59 @@ class ServiceManager(object):
         self._gunicorn_workers = os.environ.get("SAGEMAKER_GUNICORN_WORKERS", 1)
         self._gunicorn_threads = os.environ.get("SAGEMAKER_GUNICORN_THREADS", 1)
         self._gunicorn_loglevel = os.environ.get("SAGEMAKER_GUNICORN_LOGLEVEL", "info")
+        self._requirements_cache_dir = os.environ.get("SAGEMAKER_REQUIREMENTS_CACHE_DIR")
         self._tfs_config_path = "/sagemaker/model-config.cfg"
         self._tfs_batching_config_path = "/sagemaker/batching-config.cfg"
+        self._tfs_batching_calibration_file = os.environ.get(
+            "SAGEMAKER_TFS_BATCHING_CALIBRATION_FILE"
+        )
+        self._tfs_batching_p99_target_ms = float(
+            os.environ.get("SAGEMAKER_TFS_BATCHING_P99_TARGET_MS", 100)
+        )
+        self._tfs_batching_calibration_requests = int(
+            os.environ.get("SAGEMAKER_TFS_BATCHING_CALIBRATION_REQUESTS", 1000)
+        )
+        self._tfs_batching_calibration_concurrency = int(
+            os.environ.get("SAGEMAKER_TFS_BATCHING_CALIBRATION_CONCURRENCY", 64)
+        )
+        # nginx only starts after the calibration, keep it within the startup health check
+        self._tfs_batching_calibration_timeout_seconds = float(
+            os.environ.get("SAGEMAKER_TFS_BATCHING_CALIBRATION_TIMEOUT_SECONDS", 120)
+        )
 
         _enable_batching = os.environ.get("SAGEMAKER_TFS_ENABLE_BATCHING", "false").lower()
+        _calibrate_batching = os.environ.get("SAGEMAKER_TFS_BATCHING_CALIBRATION", "false").lower()
         _enable_multi_model_endpoint = os.environ.get("SAGEMAKER_MULTI_MODEL", "false").lower()
+        _enable_consolidated_tfs = os.environ.get("SAGEMAKER_MME_CONSOLIDATED_TFS", "false").lower()
         # Use this to specify memory that is needed to initialize CUDA/cuDNN and other GPU libraries
         self._tfs_gpu_margin = float(os.environ.get("SAGEMAKER_TFS_FRACTIONAL_GPU_MEM_MARGIN", 0.2))
         self._tfs_instance_count = int(os.environ.get("SAGEMAKER_TFS_INSTANCE_COUNT", 1))
         self._tfs_wait_time_seconds = int(os.environ.get("SAGEMAKER_TFS_WAIT_TIME_SECONDS", 300))
         self._tfs_inter_op_parallelism = os.environ.get("SAGEMAKER_TFS_INTER_OP_PARALLELISM", 0)
         self._tfs_intra_op_parallelism = os.environ.get("SAGEMAKER_TFS_INTRA_OP_PARALLELISM", 0)
-        self._gunicorn_worker_class = os.environ.get("SAGEMAKER_GUNICORN_WORKER_CLASS", "gevent")
+        self._tfs_config_poll_seconds = int(os.environ.get("SAGEMAKER_TFS_CONFIG_POLL_SECONDS", 10))
+        _watch_models = os.environ.get("SAGEMAKER_TFS_WATCH_MODELS", "false").lower()
+        self._tfs_watch_interval_seconds = float(
+            os.environ.get("SAGEMAKER_TFS_WATCH_INTERVAL_SECONDS", 10)
+        )
+        self._model_index_file = os.environ.get("SAGEMAKER_MODEL_INDEX_FILE")
+        if self._model_index_file is None:
+            writable = os.access(tfs_utils.MODEL_BASE_PATH, os.W_OK)
+            self._model_index_file = os.path.join(
+                tfs_utils.MODEL_BASE_PATH if writable else "/sagemaker", ".model-index.json"
+            )
+        self._model_scanner = tfs_utils.ModelScanner(index_file=self._model_index_file)
+        # versions of each model in the model config file
+        self._tfs_model_versions = {}
+        _enable_cpu_pinning = os.environ.get("SAGEMAKER_TFS_CPU_PINNING", "false").lower()
+        # logical CPUs left to nginx and gunicorn when the TFS instances are pinned
+        self._service_cpu_count = int(os.environ.get("SAGEMAKER_SERVICE_CPU_COUNT", 1))
+        # CpuPartition of each TFS instance, and CPUs of nginx and gunicorn, when pinned
+        self._tfs_cpu_partitions = None
+        self._service_cpus = None
+        _gunicorn_app = os.environ.get("SAGEMAKER_GUNICORN_APP", "wsgi").lower()
+        _enable_grpc_socket = os.environ.get("SAGEMAKER_TFS_GRPC_SOCKET", "false").lower()
+        self._nginx_tfs_keepalive = int(os.environ.get("SAGEMAKER_NGINX_TFS_KEEPALIVE", 32))
         self._gunicorn_timeout_seconds = int(
             os.environ.get("SAGEMAKER_GUNICORN_TIMEOUT_SECONDS", 30)
         )
@@ -82,11 +166,87 @@ class ServiceManager(object):
             raise ValueError("SAGEMAKER_TFS_ENABLE_BATCHING must be 'true' or 'false'")
         self._tfs_enable_batching = _enable_batching == "true"
 
+        if _calibrate_batching not in ["true", "false"]:
+            raise ValueError("SAGEMAKER_TFS_BATCHING_CALIBRATION must be 'true' or 'false'")
+        # multi-model endpoints have no model to calibrate with at startup
+        self._tfs_batching_calibration = (
+            self._tfs_enable_batching
+            and _calibrate_batching == "true"
+            and not self._tfs_enable_multi_model_endpoint
+        )
+
         if _enable_multi_model_endpoint not in ["true", "false"]:
             raise ValueError("SAGEMAKER_MULTI_MODEL must be 'true' or 'false'")
         self._tfs_enable_multi_model_endpoint = _enable_multi_model_endpoint == "true"
 
+        if _enable_consolidated_tfs not in ["true", "false"]:
+            raise ValueError("SAGEMAKER_MME_CONSOLIDATED_TFS must be 'true' or 'false'")
+        # multi-model endpoint hosting all models in SAGEMAKER_TFS_INSTANCE_COUNT TFS processes
+        self._tfs_consolidated_mme = (
+            self._tfs_enable_multi_model_endpoint and _enable_consolidated_tfs == "true"
+        )
+
+        if _watch_models not in ["true", "false"]:
+            raise ValueError("SAGEMAKER_TFS_WATCH_MODELS must be 'true' or 'false'")
+        # models of multi-model endpoints are loaded through python_service
+        self._tfs_watch_models = (
+            _watch_models == "true" and not self._tfs_enable_multi_model_endpoint
+        )
+
+        if _enable_cpu_pinning not in ["true", "false"]:
+            raise ValueError("SAGEMAKER_TFS_CPU_PINNING must be 'true' or 'false'")
+        # TFS processes of multi-model endpoints without consolidation are started by gunicorn
+        # and would inherit its CPUs
+        self._tfs_cpu_pinning = _enable_cpu_pinning == "true" and (
+            self._tfs_consolidated_mme or not self._tfs_enable_multi_model_endpoint
+        )
+
+        if _enable_grpc_socket not in ["true", "false"]:
+            raise ValueError("SAGEMAKER_TFS_GRPC_SOCKET must be 'true' or 'false'")
+
+        if _gunicorn_app not in ["wsgi", "asgi"]:
+            raise ValueError("SAGEMAKER_GUNICORN_APP must be 'wsgi' or 'asgi'")
+        if _gunicorn_app == "asgi" and not self._asgi_available():
+            log.warning("{} are not all installed, using wsgi".format(ASGI_MODULES))
+            _gunicorn_app = "wsgi"
+        _micro_batching = os.environ.get("SAGEMAKER_MICRO_BATCHING", "false").lower() == "true"
+        if _gunicorn_app == "asgi" and _micro_batching:
+            raise ValueError("SAGEMAKER_MICRO_BATCHING is not supported by the asgi service")
+        # python_service, or asgi_service with async TFS clients and handlers
+        self._gunicorn_app_module = "asgi_service" if _gunicorn_app == "asgi" else "python_service"
+        self._gunicorn_worker_class = os.environ.get(
+            "SAGEMAKER_GUNICORN_WORKER_CLASS",
+            ASGI_WORKER_CLASS if _gunicorn_app == "asgi" else "gevent",
+        )
+
+        self._tfs_request_converter = os.environ.get("SAGEMAKER_TFS_REQUEST_CONVERTER", "njs")
+        if self._tfs_request_converter not in tfs_utils.REQUEST_CONVERTERS:
+            raise ValueError(
+                "SAGEMAKER_TFS_REQUEST_CONVERTER must be one of {}".format(
+                    tfs_utils.REQUEST_CONVERTERS
+                )
+            )
+
         self._use_gunicorn = self._enable_python_service or self._tfs_enable_multi_model_endpoint
+        self._response_cache = os.environ.get("SAGEMAKER_RESPONSE_CACHE", "false").lower() == "true"
+        # invocations are converted, or cached, by python_service instead of tensorflowServing.js
+        self._forward_invocations = (
+            self._use_gunicorn or self._tfs_request_converter == "python" or self._response_cache
+        )
+
+        # connections and request rate of each model in nginx, over which invocations are
+        # answered with a 429 and Retry-After before reaching gunicorn or TFS
+        _nginx_max_connections = os.environ.get("SAGEMAKER_NGINX_MAX_CONNECTIONS_PER_MODEL")
+        if _nginx_max_connections is None:
+            _nginx_max_connections = self._admitted_invocations()
+        self._nginx_max_connections = int(_nginx_max_connections)
+        self._nginx_max_requests_per_second = int(
+            os.environ.get("SAGEMAKER_NGINX_MAX_REQUESTS_PER_SECOND_PER_MODEL", 0)
+        )
+        self._nginx_request_burst = int(
+            os.environ.get("SAGEMAKER_NGINX_REQUEST_BURST", self._nginx_max_requests_per_second)
+        )
+        self._retry_after_seconds = int(os.environ.get("SAGEMAKER_RETRY_AFTER_SECONDS", 1))
 
         if self._sagemaker_port_range is not None:
             parts = self._sagemaker_port_range.split("-")
@@ -133,7 +293,7 @@ class ServiceManager(object):
         return concat_str_ports
 
     def _create_tfs_config(self):
-        models = tfs_utils.find_models()
+        models = self._model_scanner.find_models()
 
         if not models:
             raise ValueError("no SavedModel bundles found!")
@@ -146,44 +306,183 @@ class ServiceManager(object):
             else:
                 log.info("no default model detected")
 
-        # config (may) include duplicate 'config' keys, so we can't just dump a dict
-        config = "model_config_list: {\n"
-        for m in models:
-            config += "  config: {\n"
-            config += "    name: '{}'\n".format(os.path.basename(m))
-            config += "    base_path: '{}'\n".format(m)
-            config += "    model_platform: 'tensorflow'\n"
-
-            config += "    model_version_policy: {\n"
-            config += "      specific: {\n"
-            for version in tfs_utils.find_model_versions(m):
-                config += "        versions: {}\n".format(version)
-            config += "      }\n"
-            config += "    }\n"
-
-            config += "  }\n"
-        config += "}\n"
-
+        config = self._write_tfs_config(models)
+        self._tfs_model_versions = self._model_versions(models)
         log.info("tensorflow serving model config: \n%s\n", config)
 
-        with open(self._tfs_config_path, "w", encoding="utf8") as f:
-            f.write(config)
+    def _write_tfs_config(self, models):
+        config = tfs_utils.create_tfs_config(
+            [(os.path.basename(m), m) for m in models], self._model_scanner.find_model_versions
+        )
+        tfs_utils.write_tfs_config(self._tfs_config_path, config)
+        return config
+
+    def _model_versions(self, models):
+        versions = self._model_scanner.find_model_versions
+        return {os.path.basename(m): sorted(versions(m)) for m in models}
+
+    def _watch_models(self):
+        while self._state in ["starting", "started"]:
+            time.sleep(self._tfs_watch_interval_seconds)
+            try:
+                self._reload_models()
+            except Exception as e:  # pylint: disable=broad-except
+                log.error("failed to reload the model config: {}".format(e))
+
+    def _reload_models(self):
+        """Rescans /opt/ml/model and, if model versions were added or removed, makes every TFS
+        instance load the new model config. TFS keeps serving the loaded versions meanwhile, and
+        unloads removed versions once their in-flight requests complete. The new versions are
+        only recorded once every instance serves them, so a failed reload is retried, and the
+        cached responses of the swapped models are then removed.
+        """
+        start = time.time()
+        models = self._model_scanner.find_models()
+        if not models:
+            log.warning("no SavedModel bundles found, keeping the model config")
+            return
+        previous_versions = self._tfs_model_versions
+        model_versions = self._model_versions(models)
+        if model_versions == previous_versions:
+            return
+
+        config = self._write_tfs_config(models)
+        log.info("reloading tensorflow serving model config: \n%s\n", config)
+        if grpc_utils.GRPC_RELOAD_CONFIG_AVAILABLE:
+            # otherwise the instances poll the config file
+            with ThreadPoolExecutor(max_workers=len(self._tfs_grpc_ports)) as executor:
+                futures = [
+                    executor.submit(self._reload_tfs, port, config) for port in self._tfs_grpc_ports
+                ]
+                for future in futures:
+                    future.result()
+        swapped = [
+            model_name
+            for model_name, versions in model_versions.items()
+            if versions != previous_versions.get(model_name)
+        ]
+        for model_name in swapped:
+            tfs_utils.wait_for_models(
+                self._tfs_rest_ports,
+                model_name,
+                self._tfs_wait_time_seconds,
+                model_versions[model_name],
+            )
+        self._tfs_model_versions = model_versions
+
+        # the gunicorn workers drop cached signatures when TFS answers with another version
+        if self._response_cache:
+            response_cache = cache_utils.response_cache_from_env()
+            for model_name in swapped:
+                response_cache.invalidate(model_name)
+
+        seconds = time.time() - start
+        log.info("model versions swapped on all instances after {:.3f}s".format(seconds))
+        self._metrics.observe("sagemaker_model_reload_duration_seconds", {}, seconds)
+
+    def _reload_tfs(self, grpc_port, config):
+        with grpc.insecure_channel(tfs_utils.grpc_target(grpc_port)) as channel:
+            grpc_utils.reload_model_config(channel, config)
+
+    def _fixed_batching_parameters(self):
+        return {
+            key: int(os.environ[env_var])
+            for key, env_var in CALIBRATED_BATCHING_ENV_VARS.items()
+            if env_var in os.environ
+        }
 
-    def _setup_gunicorn(self):
-        python_path_content = []
-        python_path_option = ""
+    def _batching_calibration(self):
+        """Returns the calibration file and the key of the calibration of the models and the
+        current settings
+        """
+        calibration_file = self._tfs_batching_calibration_file
+        if calibration_file is None:
+            model_dir = "/opt/ml/{}".format(MODEL_DIR)
+            writable = os.access(model_dir, os.W_OK)
+            calibration_file = os.path.join(
+                model_dir if writable else "/sagemaker", ".batching-calibration.json"
+            )
+        key = calibration_utils.calibration_key(
+            self._model_scanner.find_models(),
+            self._tfs_default_model_name,
+            self._tfs_instance_count,
+            multiprocessing.cpu_count(),
+            self._tfs_batching_p99_target_ms,
+            self._fixed_batching_parameters(),
+        )
+        return calibration_file, key
+
+    def _load_batching_calibration(self):
+        """Writes the batching config of a previous calibration. Returns False if there is none"""
+        calibration_file, key = self._batching_calibration()
+        parameters = calibration_utils.load_calibration(calibration_file, key)
+        if parameters is None:
+            return False
+        log.info("using batching parameters calibrated in {}".format(calibration_file))
+        tfs_utils.create_batching_config(self._tfs_batching_config_path, parameters)
+        return True
+
+    def _calibrate_batching(self):
+        """Restarts TFS with candidate batching parameters, driving the default model with
+        synthetic requests, and keeps the parameters with the highest throughput within the
+        p99 latency target. The result is saved for the next starts. No trial is started after
+        SAGEMAKER_TFS_BATCHING_CALIBRATION_TIMEOUT_SECONDS, and TFS falls back to the default
+        parameters if a trial fails.
+        """
+        log.info("calibrating batching parameters...")
+        deadline = time.time() + self._tfs_batching_calibration_timeout_seconds
+
+        def _run_trial(parameters):
+            tfs_utils.create_batching_config(self._tfs_batching_config_path, parameters)
+            self._restart_tfs()
+            args = (self._tfs_rest_ports, self._tfs_default_model_name, body)
+            concurrency = self._tfs_batching_calibration_concurrency
+            # warm up the model before measuring
+            calibration_utils.measure(*args, concurrency, concurrency)
+            return calibration_utils.measure(
+                *args, concurrency, self._tfs_batching_calibration_requests
+            )
 
+        try:
+            body = calibration_utils.synthetic_request(
+                self._tfs_rest_ports[0], self._tfs_default_model_name
+            )
+            parameters, results = calibration_utils.calibrate(
+                _run_trial,
+                self._fixed_batching_parameters(),
+                self._tfs_batching_p99_target_ms,
+                deadline,
+            )
+        # restarting TFS raises a plain Exception when the models do not become available
+        except Exception as e:  # pylint: disable=broad-except
+            log.warning("batching calibration failed, using the default parameters: {}".format(e))
+            parameters, results = {}, None
+        if not results:
+            parameters = {}
+
+        tfs_utils.create_batching_config(self._tfs_batching_config_path, parameters)
+        self._restart_tfs()
+        if results:
+            calibration_file, key = self._batching_calibration()
+            calibration_utils.save_calibration(calibration_file, key, parameters, results)
+            log.info("saved batching calibration to {}".format(calibration_file))
+
+    def _prepare_python_code(self):
+        """Downloads the universal scripts and installs requirements.txt. Runs in the background
+        while TFS starts, and returns the directories to add to the python path of gunicorn.
+        """
         bucket = os.environ.get("SAGEMAKER_MULTI_MODEL_UNIVERSAL_BUCKET", None)
         prefix = os.environ.get("SAGEMAKER_MULTI_MODEL_UNIVERSAL_PREFIX", None)
 
-        if not os.path.exists(CODE_DIR) and bucket and prefix:
+        # refresh the scripts of a previous download, but never overwrite a mounted code dir
+        if bucket and prefix and (not os.path.exists(CODE_DIR) or s3_utils.has_manifest(CODE_DIR)):
             self._download_scripts(bucket, prefix)
 
+        python_path_content = []
         if self._enable_python_service:
             lib_path_exists = os.path.exists(PYTHON_LIB_PATH)
             requirements_exists = os.path.exists(REQUIREMENTS_PATH)
             python_path_content = ["/opt/ml/model/code"]
-            python_path_option = "--pythonpath "
 
             if lib_path_exists:
                 python_path_content.append(PYTHON_LIB_PATH)
@@ -194,23 +493,72 @@ class ServiceManager(object):
                         "loading modules in '{}', ignoring requirements.txt".format(PYTHON_LIB_PATH)
                     )
                 else:
-                    log.info("installing packages from requirements.txt...")
-                    pip_install_cmd = "pip3 install -r {}".format(REQUIREMENTS_PATH)
-                    try:
-                        subprocess.check_call(pip_install_cmd.split())
-                    except subprocess.CalledProcessError:
-                        log.error("failed to install required packages, exiting.")
-                        self._stop()
-                        raise ChildProcessError("failed to install required packages.")
+                    python_path_content.append(self._install_requirements())
+
+        return python_path_content
+
+    def _install_requirements(self):
+        """Installs requirements.txt into a cache directory keyed by its content, unless a
+        previous start already did, and returns the directory
+        """
+        cache_dir = self._requirements_cache_dir
+        if cache_dir is None:
+            if os.access(CODE_DIR, os.W_OK):
+                cache_dir = os.path.join(CODE_DIR, ".requirements-cache")
+            else:
+                cache_dir = "/sagemaker"
+                log.warning(
+                    "{} is read-only, packages from requirements.txt are cached in {}, which "
+                    "does not persist across container restarts. Set "
+                    "SAGEMAKER_REQUIREMENTS_CACHE_DIR to a persistent directory to reuse "
+                    "them.".format(CODE_DIR, cache_dir)
+                )
+
+        with open(REQUIREMENTS_PATH, "rb") as f:
+            key = hashlib.sha256(f.read() + sys.version.encode("utf-8")).hexdigest()[:16]
+        target = os.path.join(cache_dir, "requirements-{}".format(key))
+        if os.path.exists(os.path.join(target, REQUIREMENTS_CACHE_MARKER)):
+            log.info("using packages from requirements.txt cached in {}".format(target))
+            self._record_phase("pip install")
+            return target
+
+        log.info("installing packages from requirements.txt into {}...".format(target))
+        # install next to the cache entry, and publish it with an atomic rename once complete
+        install_dir = "{}.{}".format(target, os.getpid())
+        shutil.rmtree(install_dir, ignore_errors=True)
+        pip_install_cmd = "pip3 install --target {} --cache-dir {} -r {}".format(
+            install_dir, os.path.join(cache_dir, "wheels"), REQUIREMENTS_PATH
+        )
+        try:
+            subprocess.check_call(pip_install_cmd.split())
+        except subprocess.CalledProcessError:
+            log.error("failed to install required packages, exiting.")
+            raise ChildProcessError("failed to install required packages.")
+
+        with open(os.path.join(install_dir, REQUIREMENTS_CACHE_MARKER), "w", encoding="utf8"):
+            pass
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(install_dir, target)
+        self._record_phase("pip install")
+        return target
+
+    def _setup_gunicorn(self):
+        try:
+            python_path_content = self._python_code.result()
+        except ChildProcessError:
+            self._stop()
+            raise
+        python_path_option = "--pythonpath " if python_path_content else ""
 
         gunicorn_command = (
-            "gunicorn -b unix:/tmp/gunicorn.sock -k {} --chdir /sagemaker "
+            "gunicorn -b unix:{} -k {} --chdir /sagemaker "
             "--workers {} --threads {} --log-level {} --timeout {} "
             "{}{} -e TFS_GRPC_PORTS={} -e TFS_REST_PORTS={} "
             "-e SAGEMAKER_MULTI_MODEL={} -e SAGEMAKER_SAFE_PORT_RANGE={} "
             "-e SAGEMAKER_TFS_WAIT_TIME_SECONDS={} "
-            "python_service:app"
+            "{}:app"
         ).format(
+            GUNICORN_SOCKET,
             self._gunicorn_worker_class,
             self._gunicorn_workers,
             self._gunicorn_threads,
@@ -223,11 +571,21 @@ class ServiceManager(object):
             self._tfs_enable_multi_model_endpoint,
             self._sagemaker_port_range,
             self._tfs_wait_time_seconds,
+            self._gunicorn_app_module,
         )
 
         log.info("gunicorn command: {}".format(gunicorn_command))
         self._gunicorn_command = gunicorn_command
 
+    def _asgi_available(self):
+        for module in ASGI_MODULES:
+            try:
+                if importlib.util.find_spec(module) is None:
+                    return False
+            except ImportError:
+                return False
+        return True
+
     def _download_scripts(self, bucket, prefix):
         log.info("checking boto session region ...")
         boto_session = boto3.session.Session()
@@ -236,26 +594,56 @@ class ServiceManager(object):
             raise ValueError("Universal scripts is not supported in us-iso-east-1 or us-gov-west-1")
 
         log.info("downloading universal scripts ...")
-        client = boto3.client("s3")
-        resource = boto3.resource("s3")
-        # download files
-        paginator = client.get_paginator("list_objects")
-        for result in paginator.paginate(Bucket=bucket, Delimiter="/", Prefix=prefix):
-            for file in result.get("Contents", []):
-                destination = os.path.join(CODE_DIR, file.get("Key"))
-                if not os.path.exists(os.path.dirname(destination)):
-                    os.makedirs(os.path.dirname(destination))
-                resource.meta.client.download_file(bucket, file.get("Key"), destination)
+        s3_utils.download_prefix(boto3.client("s3"), bucket, prefix, CODE_DIR)
 
     def _create_nginx_tfs_upstream(self):
         indentation = "    "
         tfs_upstream = ""
         for port in self._tfs_rest_ports:
             tfs_upstream += "{}server localhost:{};\n".format(indentation, port)
+        if self._nginx_tfs_keepalive:
+            # idle connections to TFS kept open by each nginx worker
+            tfs_upstream += "{}keepalive {};\n".format(indentation, self._nginx_tfs_keepalive)
         tfs_upstream = tfs_upstream[len(indentation) : -2]
 
         return tfs_upstream
 
+    def _admitted_invocations(self):
+        """Invocations of a model admitted by the gunicorn workers, running or queued, when
+        python_service limits them
+        """
+        max_concurrency = int(os.environ.get("SAGEMAKER_MAX_CONCURRENT_INVOCATIONS_PER_MODEL", 0))
+        max_queue = int(os.environ.get("SAGEMAKER_MAX_QUEUED_INVOCATIONS_PER_MODEL", 0))
+        if not self._forward_invocations or max_concurrency <= 0:
+            return 0
+        return int(self._gunicorn_workers) * (max_concurrency + max_queue)
+
+    def _create_nginx_invocation_limit_zones(self):
+        zones = []
+        if self._nginx_max_connections > 0:
+            zones.append("limit_conn_zone $invocation_model zone=invocations:10m;")
+        if self._nginx_max_requests_per_second > 0:
+            zones.append(
+                "limit_req_zone $invocation_model zone=invocation_rate:10m rate={}r/s;".format(
+                    self._nginx_max_requests_per_second
+                )
+            )
+        return "\n  ".join(zones)
+
+    def _create_nginx_invocation_limits(self):
+        limits = []
+        if self._nginx_max_connections > 0:
+            limits.append("limit_conn invocations {};".format(self._nginx_max_connections))
+            limits.append("limit_conn_status 429;")
+        if self._nginx_max_requests_per_second > 0:
+            limits.append(
+                "limit_req zone=invocation_rate burst={} nodelay;".format(self._nginx_request_burst)
+            )
+            limits.append("limit_req_status 429;")
+        if limits:
+            limits.append("error_page 429 = @overloaded;")
+        return "\n        ".join(limits)
+
     def _create_nginx_config(self):
         template = self._read_nginx_template()
         pattern = re.compile(r"%(\w+)%")
@@ -268,8 +656,14 @@ class ServiceManager(object):
             "NGINX_LOG_LEVEL": self._nginx_loglevel,
             "FORWARD_PING_REQUESTS": GUNICORN_PING if self._use_gunicorn else JS_PING,
             "FORWARD_INVOCATION_REQUESTS": GUNICORN_INVOCATIONS
-            if self._use_gunicorn
+            if self._forward_invocations
             else JS_INVOCATIONS,
+            "FORWARD_METRICS_REQUESTS": GUNICORN_METRICS
+            if self._forward_invocations
+            else NO_METRICS,
+            "INVOCATION_LIMIT_ZONES": self._create_nginx_invocation_limit_zones(),
+            "INVOCATION_LIMITS": self._create_nginx_invocation_limits(),
+            "RETRY_AFTER_SECONDS": str(self._retry_after_seconds),
         }
 
         config = pattern.sub(lambda x: template_values[x.group(1)], template)
@@ -303,20 +697,55 @@ class ServiceManager(object):
             p = self._start_single_tfs(i)
             self._tfs.append(p)
 
+    def _restart_tfs(self):
+        for p in self._tfs:
+            p.terminate()
+        for p in self._tfs:
+            p.wait()
+        self._tfs = []
+        self._start_tfs()
+        self._wait_for_tfs()
+
     def _start_gunicorn(self):
         self._log_version("gunicorn --version", "gunicorn version info:")
         env = os.environ.copy()
         env["TFS_DEFAULT_MODEL_NAME"] = self._tfs_default_model_name
-        p = subprocess.Popen(self._gunicorn_command.split(), env=env)
+        if not self._use_gunicorn:
+            # invocations only reach gunicorn to be cached, convert them as tensorflowServing.js
+            env["SAGEMAKER_TFS_REQUEST_CONVERTER"] = "python"
+        p = subprocess.Popen(
+            self._gunicorn_command.split(), env=env, preexec_fn=self._service_preexec_fn()
+        )
         log.info("started gunicorn (pid: %d)", p.pid)
         self._gunicorn = p
 
     def _start_nginx(self):
         self._log_version("/usr/sbin/nginx -V", "nginx version info:")
-        p = subprocess.Popen("/usr/sbin/nginx -c /sagemaker/nginx.conf".split())
+        p = subprocess.Popen(
+            "/usr/sbin/nginx -c /sagemaker/nginx.conf".split(),
+            preexec_fn=self._service_preexec_fn(),
+        )
         log.info("started nginx (pid: %d)", p.pid)
         self._nginx = p
 
+    def _check_grpc_socket(self):
+        """Turns SAGEMAKER_TFS_GRPC_SOCKET off, for TFS and gunicorn, if tensorflow_model_server
+        has no --grpc_socket_path option
+        """
+        try:
+            output = subprocess.run(
+                ["tensorflow_model_server", "--help"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            ).stdout
+        except OSError:
+            output = b""
+        if b"grpc_socket_path" in output:
+            log.info("tensorflow serving gRPC API on unix sockets")
+        else:
+            log.warning("tensorflow_model_server does not support --grpc_socket_path, using tcp")
+            os.environ["SAGEMAKER_TFS_GRPC_SOCKET"] = "false"
+
     def _log_version(self, command, message):
         try:
             output = (
@@ -332,7 +761,8 @@ class ServiceManager(object):
         self._state = "stopping"
         log.info("stopping services")
         try:
-            os.kill(self._nginx.pid, signal.SIGQUIT)
+            if self._nginx:
+                os.kill(self._nginx.pid, signal.SIGQUIT)
         except OSError:
             pass
         try:
@@ -350,16 +780,55 @@ class ServiceManager(object):
         log.info("stopped")
 
     def _wait_for_gunicorn(self):
-        while True:
-            if os.path.exists("/tmp/gunicorn.sock"):
-                log.info("gunicorn server is ready!")
-                return
+        interval = READY_INITIAL_INTERVAL_SECONDS
+        while not self._gunicorn_ping():
+            time.sleep(interval)
+            interval = min(interval * 2, READY_MAX_INTERVAL_SECONDS)
+        log.info("gunicorn server is ready!")
+
+    def _gunicorn_ping(self):
+        """Returns True if a gunicorn worker answers /ping on the unix socket"""
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(READY_MAX_INTERVAL_SECONDS * 4)
+                sock.connect(GUNICORN_SOCKET)
+                sock.sendall(b"GET /ping HTTP/1.0\r\nHost: localhost\r\n\r\n")
+                status_line = sock.recv(64).split(b"\r\n")[0]
+        except OSError:
+            return False
+        return status_line.split(b" ")[1:2] == [b"200"]
+
+    def _wait_for_nginx(self):
+        interval = READY_INITIAL_INTERVAL_SECONDS
+        deadline = time.time() + NGINX_WAIT_TIME_SECONDS
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("localhost", int(self._nginx_http_port)), 1).close()
+                return True
+            except OSError:
+                time.sleep(interval)
+                interval = min(interval * 2, READY_MAX_INTERVAL_SECONDS)
+        log.warning("nginx is not listening after {} seconds".format(NGINX_WAIT_TIME_SECONDS))
+        return False
+
+    def _record_phase(self, phase):
+        elapsed = time.time() - self._start_time
+        self._timeline.append((phase, elapsed))
+        log.info("startup phase '{}' completed after {:.3f}s".format(phase, elapsed))
+
+    def _log_timeline(self):
+        timeline = []
+        previous = 0.0
+        # pip install runs concurrently with the TFS phases
+        for phase, elapsed in sorted(self._timeline, key=lambda entry: entry[1]):
+            timeline.append("{}: {:.3f}s (+{:.3f}s)".format(phase, elapsed, elapsed - previous))
+            previous = elapsed
+        log.info("startup timeline: {}".format(", ".join(timeline)))
 
     def _wait_for_tfs(self):
-        for i in range(self._tfs_instance_count):
-            tfs_utils.wait_for_model(
-                self._tfs_rest_ports[i], self._tfs_default_model_name, self._tfs_wait_time_seconds
-            )
+        tfs_utils.wait_for_models(
+            self._tfs_rest_ports, self._tfs_default_model_name, self._tfs_wait_time_seconds
+        )
 
     @contextmanager
     def _timeout(self, seconds):
@@ -391,22 +860,83 @@ class ServiceManager(object):
             raise ValueError("Cannot find tfs with pid: {};".format(pid))
         p = self._start_single_tfs(instance_id)
         self._tfs[instance_id] = p
+        if self._tfs_consolidated_mme:
+            # the models of the instance are reported, and evicted, by the pid of the new process
+            registry = multi_model_utils.ModelRegistry(multi_model_utils.SharedState())
+            registry.set_instance_pid(int(self._tfs_rest_ports[instance_id]), p.pid)
+
+    def _partition_cpus(self):
+        topology = cpu_utils.read_topology()
+        partition = cpu_utils.partition_cpus(
+            topology, self._tfs_instance_count, self._service_cpu_count
+        )
+        if partition is None:
+            log.warning(
+                "not pinning tensorflow serving to CPUs, {} CPUs are not enough for {} instances "
+                "and {} service CPUs".format(
+                    len(topology), self._tfs_instance_count, self._service_cpu_count
+                )
+            )
+            return
+        self._tfs_cpu_partitions, self._service_cpus = partition
+        for instance_id, instance_partition in enumerate(self._tfs_cpu_partitions):
+            log.info("tensorflow serving instance {}: {}".format(instance_id, instance_partition))
+        log.info("nginx and gunicorn CPUs: {}".format(self._service_cpus))
+
+    def _service_preexec_fn(self):
+        if self._service_cpus is None:
+            return None
+        return cpu_utils.pin_to(self._service_cpus)
+
+    def _create_consolidated_tfs_configs(self):
+        # models are added to the instances by python_service when they are loaded
+        for rest_port in self._tfs_rest_ports:
+            config_file = multi_model_utils.INSTANCE_CONFIG_FILE.format(rest_port)
+            tfs_utils.write_tfs_config(config_file, tfs_utils.create_tfs_config([]))
 
     def _start_single_tfs(self, instance_id):
+        config_poll_seconds = None
+        config_path = self._tfs_config_path
+        if self._tfs_watch_models and not grpc_utils.GRPC_RELOAD_CONFIG_AVAILABLE:
+            config_poll_seconds = self._tfs_config_poll_seconds
+        if self._tfs_consolidated_mme:
+            # the config file holds the models loaded so far, which makes a restarted instance
+            # serve them again. Polling it is the fallback when the ReloadConfig API is missing
+            config_poll_seconds = self._tfs_config_poll_seconds
+            config_path = multi_model_utils.INSTANCE_CONFIG_FILE.format(
+                self._tfs_rest_ports[instance_id]
+            )
+
+        intra_op_parallelism = self._tfs_intra_op_parallelism
+        inter_op_parallelism = self._tfs_inter_op_parallelism
+        preexec_fn = None
+        if self._tfs_cpu_partitions:
+            partition = self._tfs_cpu_partitions[instance_id]
+            # thread pools sized to the pinned cores, unless set explicitly
+            intra_op_parallelism = intra_op_parallelism or partition.intra_op_parallelism
+            inter_op_parallelism = inter_op_parallelism or partition.inter_op_parallelism
+            preexec_fn = cpu_utils.pin_to(partition.cpus)
+
         cmd = tfs_utils.tfs_command(
             self._tfs_grpc_ports[instance_id],
             self._tfs_rest_ports[instance_id],
-            self._tfs_config_path,
+            config_path,
             self._tfs_enable_batching,
             self._tfs_batching_config_path,
-            tfs_intra_op_parallelism=self._tfs_intra_op_parallelism,
-            tfs_inter_op_parallelism=self._tfs_inter_op_parallelism,
+            tfs_intra_op_parallelism=intra_op_parallelism,
+            tfs_inter_op_parallelism=inter_op_parallelism,
             tfs_enable_gpu_memory_fraction=self._enable_per_process_gpu_memory_fraction(),
             tfs_gpu_memory_fraction=self._calculate_per_process_gpu_memory_fraction(),
+            tfs_config_file_poll_wait_seconds=config_poll_seconds,
         )
         log.info("tensorflow serving command: {}".format(cmd))
-        p = subprocess.Popen(cmd.split())
+        p = subprocess.Popen(cmd.split(), preexec_fn=preexec_fn)
         log.info("started tensorflow serving (pid: %d)", p.pid)
+
+        if self._tfs_consolidated_mme:
+            pid_file = multi_model_utils.INSTANCE_PID_FILE.format(self._tfs_rest_ports[instance_id])
+            with open(pid_file, "w", encoding="utf8") as f:
+                f.write(str(p.pid))
         return p
 
     def _monitor(self):
@@ -419,6 +949,7 @@ class ServiceManager(object):
             if pid == self._nginx.pid:
                 log.warning("unexpected nginx exit (status: {}). restarting.".format(status))
                 self._start_nginx()
+                self._record_restart("nginx")
 
             elif self._is_tfs_process(pid):
                 log.warning(
@@ -428,38 +959,87 @@ class ServiceManager(object):
                     self._restart_single_tfs(pid)
                 except (ValueError, OSError) as error:
                     log.error("Failed to restart tensorflow serving. {}".format(error))
+                self._record_restart("tfs")
 
             elif self._gunicorn and pid == self._gunicorn.pid:
                 log.warning("unexpected gunicorn exit (status: {}). restarting.".format(status))
                 self._start_gunicorn()
+                self._record_restart("gunicorn")
+
+    def _record_restart(self, process):
+        self._metrics.inc("sagemaker_process_restarts_total", {"process": process})
+        try:
+            self._metrics.flush()
+        except OSError as e:
+            log.warning("failed to write metrics: {}".format(e))
 
     def start(self):
         log.info("starting services")
         self._state = "starting"
         signal.signal(signal.SIGTERM, self._stop)
+        metrics_utils.remove_metrics()
+
+        if self._forward_invocations:
+            # python code and requirements do not depend on TFS, prepare them while it starts
+            executor = ThreadPoolExecutor(max_workers=1)
+            self._python_code = executor.submit(self._prepare_python_code)
+            executor.shutdown(wait=False)
+
+        if self._tfs_cpu_pinning:
+            self._partition_cpus()
+
+        if tfs_utils.grpc_socket_enabled():
+            self._check_grpc_socket()
 
         if self._tfs_enable_batching:
             log.info("batching is enabled")
             tfs_utils.create_batching_config(self._tfs_batching_config_path)
 
-        if self._tfs_enable_multi_model_endpoint:
+        if self._tfs_consolidated_mme:
+            log.info(
+                "multi-model endpoint is enabled, models will be loaded into {} TFS model "
+                "servers".format(self._tfs_instance_count)
+            )
+            multi_model_utils.remove_state()
+            self._create_consolidated_tfs_configs()
+            self._start_tfs()
+            self._record_phase("tfs spawn")
+        elif self._tfs_enable_multi_model_endpoint:
             log.info("multi-model endpoint is enabled, TFS model servers will be started later")
+            # ports and models of a previous run are not valid anymore
+            multi_model_utils.remove_state()
         else:
             self._create_tfs_config()
+            calibrate_batching = (
+                self._tfs_batching_calibration and not self._load_batching_calibration()
+            )
             self._start_tfs()
+            self._record_phase("tfs spawn")
             self._wait_for_tfs()
+            self._record_phase("model available")
+            if calibrate_batching:
+                self._calibrate_batching()
+                self._record_phase("batching calibration")
 
         self._create_nginx_config()
 
-        if self._use_gunicorn:
+        if self._forward_invocations:
+            if self._response_cache:
+                cache_utils.remove_cache()
             self._setup_gunicorn()
             self._start_gunicorn()
             # make sure gunicorn is up
             with self._timeout(seconds=self._gunicorn_timeout_seconds):
                 self._wait_for_gunicorn()
+            self._record_phase("gunicorn ready")
 
         self._start_nginx()
+        if self._wait_for_nginx():
+            self._record_phase("nginx ready")
+        self._log_timeline()
         self._state = "started"
+        if self._tfs_watch_models:
+            threading.Thread(target=self._watch_models, daemon=True).start()
         self._monitor()
         self._stop()
 
@@ -0,0 +1,92 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+import logging
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 32
+
+
+class SessionPool(object):
+    """Keep-alive HTTP sessions to TFS, one requests.Session (and connection pool) per port.
+
+    Each gunicorn worker imports python_service separately, so every worker owns one SessionPool.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True, max_retries=0):
+        self._pool_size = pool_size
+        self._keep_alive = keep_alive
+        self._max_retries = max_retries
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, port):
+        port = str(port)
+        session = self._sessions.get(port)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(port)
+                if session is None:
+                    session = self._create_session()
+                    self._sessions[port] = session
+        return session
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self._pool_size, max_retries=self._max_retries
+        )
+        session.mount("http://", adapter)
+        if not self._keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def get(self, url, **kwargs):
+        return self.session(urlsplit(url).port).get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session(urlsplit(url).port).post(url, **kwargs)
+
+    def close(self, port):
+        session = self._sessions.pop(str(port), None)
+        if session is not None:
+            session.close()
+
+    def stats(self):
+        """Returns connection reuse counters per TFS port. A hit is a request sent over an
+        already open connection, a miss is a request that had to open a new one.
+        """
+        stats = {}
+        for port, session in list(self._sessions.items()):
+            pools = session.get_adapter("http://").poolmanager.pools
+            num_requests = sum(pools[key].num_requests for key in pools.keys())
+            num_connections = sum(pools[key].num_connections for key in pools.keys())
+            stats[port] = {
+                "requests": num_requests,
+                "hits": num_requests - num_connections,
+                "misses": num_connections,
+            }
+        return stats
+
+
+def session_pool_from_env():
+    pool_size = int(os.environ.get("SAGEMAKER_TFS_CONNECTION_POOL_SIZE", DEFAULT_POOL_SIZE))
+    keep_alive = os.environ.get("SAGEMAKER_TFS_KEEP_ALIVE", "true").lower() == "true"
+    log.info("tfs connection pool size: {}, keep-alive: {}".format(pool_size, keep_alive))
+    return SessionPool(pool_size=pool_size, keep_alive=keep_alive)
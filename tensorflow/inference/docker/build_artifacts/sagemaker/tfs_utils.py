@@ -17,12 +17,18 @@ import os
 import re
 import requests
 import time
-import json
+import warnings
+import json_utils
 
-from multi_model_utils import timeout
-from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from urllib3.exceptions import NewConnectionError, MaxRetryError
 from collections import namedtuple
+from urllib.parse import urlsplit
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -30,6 +36,18 @@ log = logging.getLogger(__name__)
 DEFAULT_CONTENT_TYPE = "application/json"
 DEFAULT_ACCEPT_HEADER = "application/json"
 CUSTOM_ATTRIBUTES_HEADER = "X-Amzn-SageMaker-Custom-Attributes"
+JSON_CONTENT_TYPES = ("application/json", "application/jsonlines", "application/jsons")
+CSV_CONTENT_TYPE = "text/csv"
+# converts CSV and JSON lines invocations to TFS requests: tensorflowServing.js in nginx, or
+# convert_request in python_service
+REQUEST_CONVERTERS = ["njs", "python"]
+MODEL_BASE_PATH = "/opt/ml/model"
+# gRPC unix socket of the TFS instance of a grpc port, when SAGEMAKER_TFS_GRPC_SOCKET is true
+GRPC_SOCKET_PATH = "/tmp/tfs-grpc-{}.sock"
+# first and maximum delay between two checks of the model status in wait_for_model
+WAIT_INITIAL_INTERVAL_SECONDS = 0.005
+WAIT_MAX_INTERVAL_SECONDS = 0.25
+_MODEL_CONFIG_NAME_PATTERN = re.compile(r"^\s*name: '(.*)'$", re.MULTILINE)
 
 Context = namedtuple(
     "Context",
@@ -76,9 +94,17 @@ def make_tfs_uri(port, attributes, default_model_name, model_name=None):
     return uri
 
 
+def uri_model_name(uri):
+    """Model name of a TFS REST uri made by make_tfs_uri"""
+    return urlsplit(uri).path.split("/")[3].split(":")[0]
+
+
 def parse_tfs_custom_attributes(req):
+    return parse_custom_attributes_header(req.get_header(CUSTOM_ATTRIBUTES_HEADER))
+
+
+def parse_custom_attributes_header(header):
     attributes = {}
-    header = req.get_header(CUSTOM_ATTRIBUTES_HEADER)
     if header:
         matches = re.findall(r"(tfs-[a-z\-]+=[^,]+)", header)
         attributes = dict(attribute.split("=") for attribute in matches)
@@ -86,24 +112,39 @@ def parse_tfs_custom_attributes(req):
 
 
 def create_tfs_config_individual_model(model_name, base_path):
+    return create_tfs_config([(model_name, base_path)])
+
+
+def create_tfs_config(models, find_versions=None):
+    """Create a TFS model config for a list of (model_name, base_path) pairs, serving the
+    versions found in each base path by find_versions, find_model_versions by default
+    """
+    find_versions = find_versions or find_model_versions
+    # config (may) include duplicate 'config' keys, so we can't just dump a dict
     config = "model_config_list: {\n"
-    config += "  config: {\n"
-    config += "    name: '{}'\n".format(model_name)
-    config += "    base_path: '{}'\n".format(base_path)
-    config += "    model_platform: 'tensorflow'\n"
-
-    config += "    model_version_policy: {\n"
-    config += "      specific: {\n"
-    for version in find_model_versions(base_path):
-        config += "        versions: {}\n".format(version)
-    config += "      }\n"
-    config += "    }\n"
-
-    config += "  }\n"
+    for model_name, base_path in models:
+        config += "  config: {\n"
+        config += "    name: '{}'\n".format(model_name)
+        config += "    base_path: '{}'\n".format(base_path)
+        config += "    model_platform: 'tensorflow'\n"
+
+        config += "    model_version_policy: {\n"
+        config += "      specific: {\n"
+        for version in find_versions(base_path):
+            config += "        versions: {}\n".format(version)
+        config += "      }\n"
+        config += "    }\n"
+
+        config += "  }\n"
     config += "}\n"
     return config
 
 
+def model_config_names(config):
+    """Names of the models of a TFS model config created by create_tfs_config"""
+    return _MODEL_CONFIG_NAME_PATTERN.findall(config)
+
+
 def tfs_command(
     tfs_grpc_port,
     tfs_rest_port,
@@ -114,13 +155,14 @@ def tfs_command(
     tfs_inter_op_parallelism=None,
     tfs_enable_gpu_memory_fraction=False,
     tfs_gpu_memory_fraction=None,
+    tfs_config_file_poll_wait_seconds=None,
 ):
     cmd = (
         "tensorflow_model_server "
         "--port={} "
         "--rest_api_port={} "
         "--model_config_file={} "
-        "--max_num_load_retries=0 {} {} {} {}".format(
+        "--max_num_load_retries=0 {} {} {} {} {} {}".format(
             tfs_grpc_port,
             tfs_rest_port,
             tfs_config_path,
@@ -128,21 +170,117 @@ def tfs_command(
             get_tensorflow_intra_op_parallelism_args(tfs_intra_op_parallelism),
             get_tensorflow_inter_op_parallelism_args(tfs_inter_op_parallelism),
             get_tfs_gpu_mem_args(tfs_enable_gpu_memory_fraction, tfs_gpu_memory_fraction),
+            get_tfs_config_poll_args(tfs_config_file_poll_wait_seconds),
+            get_tfs_grpc_socket_args(tfs_grpc_port),
         )
     )
     return cmd
 
 
+def grpc_socket_enabled():
+    # set by serve.py, and turned off when tensorflow_model_server lacks --grpc_socket_path
+    return os.environ.get("SAGEMAKER_TFS_GRPC_SOCKET", "false").lower() == "true"
+
+
+def grpc_target(grpc_port):
+    """Address of the gRPC API of the TFS instance of grpc_port, its unix socket if enabled"""
+    if grpc_socket_enabled():
+        return "unix:{}".format(GRPC_SOCKET_PATH.format(grpc_port))
+    return "localhost:{}".format(grpc_port)
+
+
 def find_models():
-    base_path = "/opt/ml/model"
-    models = []
-    for f in _find_saved_model_files(base_path):
-        parts = f.split("/")
-        if len(parts) >= 6 and re.match(r"^\d+$", parts[-2]):
-            model_path = "/".join(parts[0:-2])
-            if model_path not in models:
-                models.append(model_path)
-    return models
+    return ModelScanner().find_models()
+
+
+class ModelScanner(object):
+    """Index of the SavedModel bundles under base_path.
+
+    The walk stops at version directories, the numeric directories holding a saved_model.pb.
+    Later scans only list the directories whose modification time changed, which happens when
+    entries are added to or removed from them. With an index_file, the index is kept across
+    restarts.
+    """
+
+    def __init__(self, base_path=MODEL_BASE_PATH, index_file=None):
+        self._base_path = base_path
+        self._index_file = index_file
+        # directory -> (mtime, subdirectory names, whether it is a version directory)
+        self._dirs = self._load_index()
+        self._changed = False
+
+    def _load_index(self):
+        if self._index_file is None:
+            return {}
+        try:
+            with open(self._index_file, encoding="utf8") as f:
+                index = json_utils.loads(f.read())
+            if index["base_path"] == self._base_path:
+                return {path: tuple(entry) for path, entry in index["dirs"].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return {}
+
+    def _save_index(self):
+        index = json_utils.dumps({"base_path": self._base_path, "dirs": self._dirs})
+        try:
+            # written in place, so that an index file in base_path does not change its mtime
+            with open(self._index_file, "wb") as f:
+                f.write(index)
+        except OSError as e:
+            log.warning("failed to write the model index {}: {}".format(self._index_file, e))
+
+    def find_models(self):
+        dirs = {}
+        models = []
+        found = set()
+        for path in self._walk(self._base_path, dirs):
+            parts = os.path.join(path, "saved_model.pb").split("/")
+            if len(parts) >= 6:
+                model_path = "/".join(parts[0:-2])
+                if model_path not in found:
+                    found.add(model_path)
+                    models.append(model_path)
+        # forget the directories that were removed
+        self._changed = self._changed or len(dirs) != len(self._dirs)
+        self._dirs = dirs
+        if self._changed and self._index_file:
+            self._save_index()
+        self._changed = False
+        return models
+
+    def find_model_versions(self, model_path):
+        """Versions of a model found by the last scan, like find_model_versions"""
+        entry = self._dirs.get(model_path)
+        if entry is None:
+            return find_model_versions(model_path)
+        return [
+            version[:-1].lstrip("0") + version[-1] for version in entry[1] if version.isnumeric()
+        ]
+
+    def _walk(self, path, dirs):
+        """Yields the version directories, in os.scandir order"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        entry = self._dirs.get(path)
+        if entry is None or entry[0] != mtime:
+            subdirs, saved_model = [], False
+            for e in os.scandir(path):
+                if e.is_dir():
+                    subdirs.append(e.name)
+                elif e.name == "saved_model.pb":
+                    saved_model = True
+            version = saved_model and os.path.basename(path).isnumeric()
+            # the variables and assets of a version are not searched for models
+            entry = (mtime, [] if version else subdirs, version)
+            self._changed = True
+        dirs[path] = entry
+        if entry[2]:
+            yield path
+        for name in entry[1]:
+            yield from self._walk(os.path.join(path, name), dirs)
 
 
 def find_model_versions(model_path):
@@ -154,15 +292,6 @@ def find_model_versions(model_path):
     ]
 
 
-def _find_saved_model_files(path):
-    for e in os.scandir(path):
-        if e.is_dir():
-            yield from _find_saved_model_files(os.path.join(path, e.name))
-        else:
-            if e.name == "saved_model.pb":
-                yield os.path.join(path, e.name)
-
-
 def get_tfs_batching_args(enable_batching, tfs_batching_config):
     if enable_batching:
         return "--enable_batching=true " "--batching_parameters_file={}".format(tfs_batching_config)
@@ -191,7 +320,35 @@ def get_tfs_gpu_mem_args(enable_gpu_memory_fraction, gpu_memory_fraction):
         return ""
 
 
-def create_batching_config(batching_config_file):
+def get_tfs_config_poll_args(config_file_poll_wait_seconds):
+    if config_file_poll_wait_seconds:
+        return "--model_config_file_poll_wait_seconds={}".format(config_file_poll_wait_seconds)
+    else:
+        return ""
+
+
+def get_tfs_grpc_socket_args(grpc_port):
+    if grpc_socket_enabled():
+        return "--grpc_socket_path={}".format(GRPC_SOCKET_PATH.format(grpc_port))
+    else:
+        return ""
+
+
+def write_tfs_config(config_file, config):
+    """Write a model config so that a polling TFS never reads a partially written file"""
+    os.makedirs(os.path.dirname(config_file), exist_ok=True)
+    tmp_file = "{}.tmp".format(config_file)
+    with open(tmp_file, "w", encoding="utf8") as f:
+        f.write(config)
+    os.replace(tmp_file, config_file)
+
+
+def create_batching_config(batching_config_file, calibrated_parameters=None):
+    """Writes the TFS batching parameters file. Parameters set by environment variables take
+    precedence over calibrated_parameters, which take precedence over the defaults.
+    """
+    calibrated_parameters = calibrated_parameters or {}
+
     class _BatchingParameter:
         def __init__(self, key, env_var, value, defaulted_message):
             self.key = key
@@ -237,6 +394,8 @@ def create_batching_config(batching_config_file):
     for batching_parameter in batching_parameters:
         if batching_parameter.env_var in os.environ:
             batching_parameter.value = os.environ[batching_parameter.env_var]
+        elif batching_parameter.key in calibrated_parameters:
+            batching_parameter.value = calibrated_parameters[batching_parameter.key]
         else:
             warning_message += batching_parameter.defaulted_message.format(
                 batching_parameter.value, batching_parameter.env_var
@@ -254,29 +413,154 @@ def create_batching_config(batching_config_file):
         f.write(config)
 
 
-def wait_for_model(rest_port, model_name, timeout_seconds, wait_interval_seconds=5):
+def wait_for_model(
+    rest_port,
+    model_name,
+    timeout_seconds,
+    wait_interval_seconds=WAIT_MAX_INTERVAL_SECONDS,
+    session=None,
+    versions=None,
+):
+    """Wait until all versions of a model, or the given versions, are available. The model
+    status is checked with an exponential backoff, from WAIT_INITIAL_INTERVAL_SECONDS up to
+    wait_interval_seconds between checks.
+
+    Unlike multi_model_utils.timeout, the deadline does not rely on signals, so several models
+    can be waited for from different threads.
+    """
     tfs_url = "http://localhost:{}/v1/models/{}".format(rest_port, model_name)
 
-    with timeout(timeout_seconds):
-        while True:
-            try:
-                session = requests.Session()
-                retries = Retry(total=9, backoff_factor=0.1)
-                session.mount("http://", requests.adapters.HTTPAdapter(max_retries=retries))
-                log.info("Trying to connect with model server: {}".format(tfs_url))
-                response = session.get(tfs_url)
-                log.info(response)
-                if response.status_code == 200:
-                    versions = json.loads(response.content)["model_version_status"]
-                    if all(version["state"] == "AVAILABLE" for version in versions):
-                        break
-            except (
-                ConnectionRefusedError,
-                NewConnectionError,
-                MaxRetryError,
-                requests.exceptions.ConnectionError,
-            ):
-                log.warning("model: {} is not available yet ".format(tfs_url))
-                time.sleep(wait_interval_seconds)
+    if session is None:
+        # failed checks are retried below, with backoff
+        session = requests.Session()
+
+    log.info("waiting for model server: {}".format(tfs_url))
+    deadline = time.time() + timeout_seconds
+    interval = WAIT_INITIAL_INTERVAL_SECONDS
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Exception(408, "Timed out after {} seconds".format(timeout_seconds))
+        try:
+            response = session.get(tfs_url, timeout=remaining)
+            if response.status_code == 200:
+                statuses = json_utils.loads(response.content)["model_version_status"]
+                available = set(s["version"] for s in statuses if s["state"] == "AVAILABLE")
+                if versions is None and len(available) == len(statuses):
+                    break
+                if versions is not None and available.issuperset(versions):
+                    break
+        except (
+            ConnectionRefusedError,
+            NewConnectionError,
+            MaxRetryError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ):
+            pass
+        # TFS answers 404 until it has read a config with the model
+        log.debug("model: {} is not available yet ".format(tfs_url))
+        time.sleep(min(interval, max(deadline - time.time(), 0)))
+        interval = min(interval * 2, wait_interval_seconds)
 
     log.info("model: {} is available now".format(tfs_url))
+
+
+def wait_for_models(rest_ports, model_name, timeout_seconds, versions=None):
+    """Wait for a model on several TFS instances concurrently"""
+    with ThreadPoolExecutor(max_workers=len(rest_ports)) as executor:
+        futures = [
+            executor.submit(
+                wait_for_model, rest_port, model_name, timeout_seconds, versions=versions
+            )
+            for rest_port in rest_ports
+        ]
+        for future in futures:
+            future.result()
+
+
+_TFS_JSON_PATTERN = re.compile(rb'"(instances|inputs|examples)"\s*:')
+_JSON_LINES_PATTERN = re.compile(rb"[}\]]\s*[\[{]")
+_JSON_NESTED_ARRAY_PATTERN = re.compile(rb"\s*\[\s*\[")
+_CSV_UNQUOTED_PATTERN = re.compile(rb'\s*("|[\d.Ee+\-]+)')
+
+
+def convert_request(body, content_type):
+    """Convert an invocation body to a TFS predict request, like tensorflowServing.js does.
+
+    :param body: request body (bytes)
+    :param content_type: content type of the request
+    :return: a numpy array of instances for numeric CSV, the TFS REST request body (bytes)
+        for other CSV and JSON bodies, or None if the content type is not supported
+    """
+    content_type = (content_type or "").split(";")[0].strip()
+    if content_type == CSV_CONTENT_TYPE:
+        instances = csv_to_array(body)
+        return instances if instances is not None else csv_to_tfs_json(body)
+    if content_type in JSON_CONTENT_TYPES:
+        if _JSON_LINES_PATTERN.search(body):
+            return json_lines_to_tfs_json(body)
+        if _TFS_JSON_PATTERN.search(body):
+            return body
+        return generic_json_to_tfs_json(body)
+    return None
+
+
+def csv_to_array(body):
+    """Parse a numeric CSV body in a single pass over its bytes. Single column rows are
+    scalars. Returns None if numpy is not installed, or if the body is not a rectangular table
+    of numbers.
+    """
+    text = body.strip() if np is not None else b""
+    if not text:
+        return None
+    lines = text.count(b"\n") + 1
+    columns = text.split(b"\n", 1)[0].count(b",") + 1
+    flat = text.replace(b"\r", b"").replace(b"\n", b",")
+    # without decimal points, exponents or nan/inf, keep integers as integers like the JSON
+    # built by tensorflowServing.js
+    is_integer = not re.search(rb"[.eEnN]", flat)
+    with warnings.catch_warnings():
+        # numpy warns, and stops, at the first value that is not a number
+        warnings.simplefilter("error")
+        try:
+            values = np.fromstring(flat, dtype=np.int64 if is_integer else np.float64, sep=",")
+        except (DeprecationWarning, ValueError):
+            return None
+    if values.size != lines * columns or values.size != flat.count(b",") + 1:
+        return None
+    return values if columns == 1 else values.reshape(lines, columns)
+
+
+def csv_to_tfs_json(body):
+    text = body.decode("utf-8")
+    # quote the fields unless the first one is quoted or numeric
+    needs_quotes = not _CSV_UNQUOTED_PATTERN.match(body)
+    instances = []
+    for line in text.strip().splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        has_multiple_columns = "," in line
+        if needs_quotes:
+            fields = line.split(",") if has_multiple_columns else line
+            instances.append(json_utils.dumps(fields).decode("utf-8"))
+        elif has_multiple_columns:
+            instances.append("[{}]".format(line))
+        else:
+            instances.append(line)
+    return '{{"instances":[{}]}}'.format(",".join(instances)).encode("utf-8")
+
+
+def json_lines_to_tfs_json(body):
+    lines = body.strip().splitlines()
+    instances = b",".join(line.strip() for line in lines if line.strip())
+    if len(lines) == 1:
+        return b'{"instances":' + instances + b"}"
+    return b'{"instances":[' + instances + b"]}"
+
+
+def generic_json_to_tfs_json(body):
+    if not _JSON_NESTED_ARRAY_PATTERN.match(body):
+        body = b"[" + body + b"]"
+    return b'{"instances":' + body + b"}"
@@ -35,8 +35,13 @@ def make_invocation_request(data, model_name, content_type="application/json", v
     return response.status_code, response.content.decode("utf-8")
 
 
-def make_list_model_request():
-    response = requests.get(MODELS_URL)
+def make_list_model_request(max_results=None, next_token=None):
+    params = {}
+    if max_results is not None:
+        params["max_results"] = max_results
+    if next_token is not None:
+        params["next_token"] = next_token
+    response = requests.get(MODELS_URL, params=params)
     return response.status_code, response.content.decode("utf-8")
 
 
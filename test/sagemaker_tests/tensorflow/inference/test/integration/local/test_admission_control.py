@@ -0,0 +1,98 @@
+# Copyright 2019-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+BASE_URL = 'http://localhost:8080/invocations'
+HEADERS = {
+    'Content-Type': 'application/json',
+    'X-Amzn-SageMaker-Custom-Attributes': 'tfs-model-name=half_plus_three',
+}
+
+
+@pytest.fixture(scope='session', autouse=True)
+def volume():
+    try:
+        model_dir = os.path.abspath('test/resources/models')
+        subprocess.check_call(
+            'docker volume create --name admission_model_volume --opt type=none '
+            '--opt device={} --opt o=bind'.format(model_dir).split())
+        yield model_dir
+    finally:
+        subprocess.check_call('docker volume rm admission_model_volume'.split())
+
+
+@pytest.fixture(scope='module', autouse=True)
+def container(request, docker_base_name, tag, runtime_config):
+    try:
+        command = (
+            'docker run {}--name sagemaker-tensorflow-serving-test -p 8080:8080'
+            ' --mount type=volume,source=admission_model_volume,target=/opt/ml/model,readonly'
+            ' -e SAGEMAKER_TFS_NGINX_LOGLEVEL=info'
+            ' -e SAGEMAKER_BIND_TO_PORT=8080'
+            ' -e SAGEMAKER_NGINX_MAX_REQUESTS_PER_SECOND_PER_MODEL=1'
+            ' -e SAGEMAKER_NGINX_REQUEST_BURST=1'
+            ' -e SAGEMAKER_RETRY_AFTER_SECONDS=2'
+            ' {}:{} serve'
+        ).format(runtime_config, docker_base_name, tag)
+
+        proc = subprocess.Popen(command.split(), stdout=sys.stdout, stderr=subprocess.STDOUT)
+
+        attempts = 0
+        while attempts < 40:
+            time.sleep(3)
+            try:
+                res_code = requests.get('http://localhost:8080/ping').status_code
+                if res_code == 200:
+                    break
+            except:
+                attempts += 1
+                pass
+
+        yield proc.pid
+    finally:
+        subprocess.check_call('docker rm -f sagemaker-tensorflow-serving-test'.split())
+
+
+@pytest.mark.model("half_plus_three")
+def test_invocations_over_rate_limit_rejected():
+    data = json.dumps({'instances': [1.0, 2.0, 5.0]})
+    time.sleep(2)
+
+    responses = [requests.post(BASE_URL, data=data, headers=HEADERS) for _ in range(10)]
+
+    # one request per second, with a burst of one more
+    codes = [response.status_code for response in responses]
+    assert codes[:2] == [200, 200]
+    assert codes.count(429) >= 7
+    rejected = [response for response in responses if response.status_code == 429]
+    assert all(response.headers['Retry-After'] == '2' for response in rejected)
+    assert rejected[0].json() == {'error': 'Too Many Requests'}
+    assert responses[0].json() == {'predictions': [3.5, 4.0, 5.5]}
+
+    time.sleep(2)
+    response = requests.post(BASE_URL, data=data, headers=HEADERS)
+    assert response.status_code == 200
+
+
+@pytest.mark.model("half_plus_three")
+def test_other_requests_not_limited():
+    for _ in range(10):
+        assert requests.get('http://localhost:8080/ping').status_code == 200
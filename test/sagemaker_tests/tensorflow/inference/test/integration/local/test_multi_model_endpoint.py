@@ -246,3 +246,46 @@ def test_invalid_model_version():
     code, res = make_load_model_request(json.dumps(invalid_model_version_data))
     assert code == 404
     assert 'Could not find valid base path {} for servable {}'.format(base_path, model_name) in str(res)
+
+
+@pytest.mark.model("half_plus_three")
+@pytest.mark.processor("cpu")
+@pytest.mark.skip_gpu
+def test_list_models_paginated():
+    model_names = ['page_model_{}'.format(i) for i in range(3)]
+    for model_name in model_names:
+        model_data = {
+            'model_name': model_name,
+            'url': '/opt/ml/models/half_plus_three'
+        }
+        code, res = make_load_model_request(json.dumps(model_data))
+        assert code == 200
+
+    code, res = make_list_model_request()
+    assert code == 200
+    all_models = json.loads(res)
+
+    pages = []
+    next_token = None
+    while True:
+        code, res = make_list_model_request(max_results=2, next_token=next_token)
+        assert code == 200
+        page = json.loads(res)
+        assert 0 < len(page['models']) <= 2
+        pages.append(page['models'])
+        next_token = page.get('next_token')
+        if next_token is None:
+            break
+        assert next_token == sorted(page['models'])[-1]
+
+    listed = [model_name for page in pages for model_name in sorted(page)]
+    assert listed == sorted(all_models)
+    assert set(model_names) <= set(listed)
+    assert all(pages[0][name] == all_models[name] for name in pages[0])
+
+    code, res = make_list_model_request(max_results=0)
+    assert code == 400
+
+    for model_name in model_names:
+        code, _ = make_unload_model_request(model_name)
+        assert code == 200
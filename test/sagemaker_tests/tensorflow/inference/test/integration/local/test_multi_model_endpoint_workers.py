@@ -0,0 +1,108 @@
+# Copyright 2019-2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+from .multi_model_endpoint_test_utils import (
+    make_invocation_request,
+    make_list_model_request,
+    make_load_model_request,
+    make_unload_model_request,
+)
+
+
+@pytest.fixture(scope='session', autouse=True)
+def volume():
+    try:
+        model_dir = os.path.abspath('test/resources/mme')
+        subprocess.check_call(
+           'docker volume create --name mme_workers_model_volume --opt type=none '
+           '--opt device={} --opt o=bind'.format(model_dir).split())
+        yield model_dir
+    finally:
+        subprocess.check_call('docker volume rm mme_workers_model_volume'.split())
+
+
+@pytest.fixture(scope='module', autouse=True)
+def container(request, docker_base_name, tag, runtime_config):
+    try:
+        command = (
+            'docker run {}--name sagemaker-tensorflow-serving-test -p 8080:8080'
+            ' --mount type=volume,source=mme_workers_model_volume,target=/opt/ml/models,readonly'
+            ' -e SAGEMAKER_TFS_NGINX_LOGLEVEL=info'
+            ' -e SAGEMAKER_BIND_TO_PORT=8080'
+            ' -e SAGEMAKER_SAFE_PORT_RANGE=9000-9999'
+            ' -e SAGEMAKER_MULTI_MODEL=true'
+            ' -e SAGEMAKER_GUNICORN_WORKERS=4'
+            ' {}:{} serve'
+        ).format(runtime_config, docker_base_name, tag)
+
+        proc = subprocess.Popen(command.split(), stdout=sys.stdout, stderr=subprocess.STDOUT)
+
+        attempts = 0
+        while attempts < 40:
+            time.sleep(3)
+            try:
+                res_code = requests.get('http://localhost:8080/ping').status_code
+                if res_code == 200:
+                    break
+            except:
+                attempts += 1
+                pass
+
+        yield proc.pid
+    finally:
+        subprocess.check_call('docker rm -f sagemaker-tensorflow-serving-test'.split())
+
+
+@pytest.mark.model("half_plus_three")
+@pytest.mark.processor("cpu")
+@pytest.mark.skip_gpu
+def test_model_shared_across_workers():
+    model_name = 'half_plus_three'
+    model_data = {
+        'model_name': model_name,
+        'url': '/opt/ml/models/half_plus_three'
+    }
+    code, res = make_load_model_request(json.dumps(model_data))
+    assert code == 200
+
+    # a second load is rejected whichever worker handles it
+    code, res = make_load_model_request(json.dumps(model_data))
+    assert code == 409
+
+    x = {
+        'instances': [1.0, 2.0, 5.0]
+    }
+    for _ in range(20):
+        code, y = make_invocation_request(json.dumps(x), model_name)
+        assert code == 200
+        assert json.loads(y) == {'predictions': [3.5, 4.0, 5.5]}
+
+    for _ in range(8):
+        code, res = make_list_model_request()
+        assert list(json.loads(res)) == [model_name]
+
+    code, res = make_unload_model_request(model_name)
+    assert code == 200
+
+    for _ in range(8):
+        code, y = make_invocation_request(json.dumps(x), model_name)
+        assert code == 404
@@ -12,6 +12,7 @@
 # language governing permissions and limitations under the License.
 
 import os
+import re
 import shutil
 import subprocess
 import sys
@@ -24,6 +25,8 @@ import requests
 
 PING_URL = 'http://localhost:8080/ping'
 INVOCATIONS_URL = 'http://localhost:8080/invocations'
+STATS_URL = 'http://localhost:8080/stats'
+METRICS_URL = 'http://localhost:8080/metrics'
 
 
 @pytest.fixture(scope='module', autouse=True, params=['1', '2', '3', '4', '5'])
@@ -92,6 +95,22 @@ def test_predict_json():
     assert response == {'predictions': [3.5, 4.0, 5.5]}
 
 
+@pytest.mark.model("half_plus_three")
+def test_predict_json_grpc(volume):
+    headers = make_headers('application/json', 'predict')
+    headers['X-Amzn-SageMaker-Custom-Attributes'] += ',tfs-protocol=grpc'
+    data = '{"instances": [1.0, 2.0, 5.0]}'
+    before = requests.get(STATS_URL).json()['grpc']
+    response = requests.post(INVOCATIONS_URL, data=data, headers=headers).json()
+    after = requests.get(STATS_URL).json()['grpc']
+    assert response == {'predictions': [3.5, 4.0, 5.5]}
+    assert after['rest_fallbacks'] == before['rest_fallbacks']
+    if volume == 'model_volume_1':
+        # input_handler and output_handler of test1 predict with tfs_predict, the other
+        # examples send their own REST requests
+        assert after['predictions'] == before['predictions'] + 1
+
+
 @pytest.mark.model("half_plus_three")
 def test_zero_content():
     headers = make_headers('application/json', 'predict')
@@ -134,3 +153,31 @@ def test_unsupported_content_type():
 def test_ping_service():
     response = requests.get(PING_URL)
     assert 200 == response.status_code
+
+
+def _metric_value(metrics, sample):
+    match = re.search(r'^{} (\S+)$'.format(re.escape(sample)), metrics, re.MULTILINE)
+    return float(match.group(1)) if match else 0
+
+
+@pytest.mark.model("half_plus_three")
+def test_metrics():
+    headers = make_headers('application/json', 'predict')
+    data = '{"instances": [1.0, 2.0, 5.0]}'
+    invocations = 'sagemaker_invocations_total{model="half_plus_three",status="200"}'
+    latency = 'sagemaker_invocation_duration_seconds_count{{model="half_plus_three",phase="{}"}}'
+
+    before = requests.get(METRICS_URL).text
+    for _ in range(3):
+        response = requests.post(INVOCATIONS_URL, data=data, headers=headers)
+        assert 200 == response.status_code
+    response = requests.get(METRICS_URL)
+
+    assert 200 == response.status_code
+    assert response.headers['Content-Type'].startswith('text/plain')
+    metrics = response.text
+    assert '# TYPE sagemaker_invocations_total counter' in metrics
+    assert '# TYPE sagemaker_invocation_duration_seconds histogram' in metrics
+    assert _metric_value(metrics, invocations) == _metric_value(before, invocations) + 3
+    total = latency.format('total')
+    assert _metric_value(metrics, total) == _metric_value(before, total) + 3
@@ -1,5 +1,9 @@
 #!/bin/bash
 
+# Compare "Requests per second" and the 99% line of each run between containers started with
+# SAGEMAKER_NGINX_TFS_KEEPALIVE=0 (a new TFS connection per request) and the default, and with
+# SAGEMAKER_TFS_GRPC_SOCKET=true for python_service invocations sent over gRPC.
+
 ab -k -n 10000 -c 16 -p test/resources/inputs/test.json -T 'application/json' http://localhost:8080/tfs/v1/models/half_plus_three:predict
 ab -k -n 10000 -c 16 -p test/resources/inputs/test.json -T 'application/json' http://localhost:8080/invocations
 ab -k -n 10000 -c 16 -p test/resources/inputs/test.jsons -T 'application/json' http://localhost:8080/invocations
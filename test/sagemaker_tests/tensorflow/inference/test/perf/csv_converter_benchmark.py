@@ -0,0 +1,67 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import requests
+
+SAGEMAKER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..',
+                             '..', '..', 'tensorflow', 'inference', 'docker', 'build_artifacts',
+                             'sagemaker')
+
+
+def make_csv(rows, columns):
+    values = np.random.rand(rows, columns)
+    return '\n'.join(','.join('{:.6f}'.format(v) for v in row) for row in values).encode()
+
+
+def _report(rows, body, seconds, count):
+    return {
+        'requests': count,
+        'rows_per_second': round(rows * count / seconds, 1),
+        'mb_per_second': round(len(body) * count / seconds / 2 ** 20, 3),
+        'ms_per_request': round(seconds / count * 1000, 3),
+    }
+
+
+def benchmark_endpoint(url, body, rows, count):
+    """Run once against a container started with SAGEMAKER_TFS_REQUEST_CONVERTER=njs and once
+    with SAGEMAKER_TFS_REQUEST_CONVERTER=python to compare both converters."""
+    start = time.time()
+    for _ in range(count):
+        response = requests.post(url, data=body, headers={'Content-Type': 'text/csv'})
+        response.raise_for_status()
+    return _report(rows, body, time.time() - start, count)
+
+
+def benchmark_converter(body, rows, count):
+    """Time of tfs_utils.convert_request and the REST request body built from its array"""
+    sys.path.insert(0, SAGEMAKER_DIR)
+    tfs_utils = importlib.import_module('tfs_utils')
+    json_utils = importlib.import_module('json_utils')
+    start = time.time()
+    for _ in range(count):
+        json_utils.dumps({'instances': tfs_utils.convert_request(body, 'text/csv')})
+    return _report(rows, body, time.time() - start, count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measures the throughput of CSV invocations converted to TFS requests.')
+    parser.add_argument('-u', '--url', help='Invocations URL. Without it, only the python '
+                                            'converter is timed in process.', type=str)
+    parser.add_argument('-r', '--rows', help='Number of CSV rows per request.', type=int,
+                        default=10000)
+    parser.add_argument('-c', '--columns', help='Number of CSV columns.', type=int, default=10)
+    parser.add_argument('-n', '--count', help='Number of requests.', type=int, default=20)
+    args = parser.parse_args()
+
+    csv_body = make_csv(args.rows, args.columns)
+    if args.url:
+        result = benchmark_endpoint(args.url, csv_body, args.rows, args.count)
+    else:
+        result = benchmark_converter(csv_body, args.rows, args.count)
+    print(json.dumps(result, indent=2))
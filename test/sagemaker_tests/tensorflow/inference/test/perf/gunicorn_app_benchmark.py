@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+CONTAINER_NAME = 'sagemaker-tensorflow-serving-gunicorn-app-benchmark'
+BASE_URL = 'http://localhost:8080'
+
+
+def start_container(image, model_dir, app, workers):
+    # a code/inference.py in the model dir makes the container serve invocations with gunicorn
+    command = (
+        'docker run -d --name {} -p 8080:8080'
+        ' --mount type=bind,source={},target=/opt/ml/model,readonly'
+        ' -e SAGEMAKER_BIND_TO_PORT=8080'
+        ' -e SAGEMAKER_SAFE_PORT_RANGE=9000-9999'
+        ' -e SAGEMAKER_GUNICORN_APP={}'
+        ' -e SAGEMAKER_GUNICORN_WORKERS={}'
+        ' {} serve'
+    ).format(CONTAINER_NAME, os.path.abspath(model_dir), app, workers, image)
+    subprocess.check_call(command.split(), stdout=subprocess.DEVNULL)
+
+
+def remove_container():
+    subprocess.call('docker rm -f {}'.format(CONTAINER_NAME).split(),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_for_ping(timeout_seconds):
+    start = time.time()
+    while time.time() - start < timeout_seconds:
+        try:
+            if requests.get(BASE_URL + '/ping', timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError('container did not answer /ping within {} seconds'.format(timeout_seconds))
+
+
+def measure(payload, concurrency, requests_count):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+
+    def invoke(_):
+        start = time.time()
+        response = session.post(BASE_URL + '/invocations', data=payload,
+                                headers={'Content-Type': 'application/json'})
+        return response.status_code, time.time() - start
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(invoke, range(requests_count)))
+    seconds = time.time() - start
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'concurrency': concurrency,
+        'requests_per_second': round(requests_count / seconds, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+        'errors': len([status for status, _ in results if status != 200]),
+    }
+
+
+def benchmark(image, model_dir, app, workers, concurrencies, requests_count, payload):
+    remove_container()
+    start_container(image, model_dir, app, workers)
+    try:
+        wait_for_ping(300)
+        # warm up the connections and the signature caches
+        measure(payload, max(concurrencies), max(concurrencies))
+        return {
+            'app': app,
+            'workers': workers,
+            'results': [measure(payload, c, requests_count) for c in concurrencies],
+        }
+    finally:
+        remove_container()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compares the invocation throughput and latency of python_service, served '
+                    'by gevent workers, and asgi_service, served by uvicorn workers, as the '
+                    'number of concurrent clients grows.')
+    parser.add_argument('-i', '--image', help='Serving image, e.g. sagemaker-tensorflow-serving:'
+                                              '2.8.0-cpu', type=str, required=True)
+    parser.add_argument('-m', '--model-dir', help='Host directory mounted as /opt/ml/model, with '
+                                                  'a code/inference.py.', type=str, required=True)
+    parser.add_argument('-w', '--workers', help='SAGEMAKER_GUNICORN_WORKERS.', type=int,
+                        default=1)
+    parser.add_argument('-c', '--concurrency', help='Numbers of concurrent clients.', type=int,
+                        nargs='+', default=[1, 16, 64, 256])
+    parser.add_argument('-n', '--requests', help='Invocations per concurrency.', type=int,
+                        default=2000)
+    parser.add_argument('-p', '--payload', help='Invocation body.', type=str,
+                        default='{"instances": [[1.0, 2.0, 5.0]]}')
+    args = parser.parse_args()
+
+    print(json.dumps([benchmark(args.image, args.model_dir, app, args.workers, args.concurrency,
+                                args.requests, args.payload.encode())
+                      for app in ['wsgi', 'asgi']], indent=2))
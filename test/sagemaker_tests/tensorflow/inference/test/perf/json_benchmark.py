@@ -0,0 +1,57 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+SAGEMAKER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..',
+                             '..', '..', 'tensorflow', 'inference', 'docker', 'build_artifacts',
+                             'sagemaker')
+
+
+def payloads(rows, columns):
+    values = np.random.rand(rows, columns).astype('float32')
+    return {
+        'instances': {'instances': values.tolist()},
+        'columnar': {'inputs': {'x': values.tolist(), 'y': values[:, 0].tolist()}},
+        'predictions': {'predictions': values},
+    }
+
+
+def benchmark(library, rows, columns, number):
+    os.environ['SAGEMAKER_JSON_LIBRARY'] = library
+    sys.path.insert(0, SAGEMAKER_DIR)
+    json_utils = importlib.reload(importlib.import_module('json_utils'))
+
+    results = {}
+    for name, payload in payloads(rows, columns).items():
+        encoded = json_utils.dumps(payload)
+        results[name] = {
+            'bytes': len(encoded),
+            'dumps_ms': round(timeit.timeit(lambda: json_utils.dumps(payload), number=number)
+                              / number * 1000, 3),
+            'loads_ms': round(timeit.timeit(lambda: json_utils.loads(encoded), number=number)
+                              / number * 1000, 3),
+        }
+    return {'library': json_utils.JSON_LIBRARY, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compares the JSON libraries supported by json_utils on TFS request and '
+                    'response payloads.')
+    parser.add_argument('-l', '--libraries', help='Comma separated libraries to compare.',
+                        type=str, default='json,ujson,orjson')
+    parser.add_argument('-r', '--rows', help='Number of instances per payload.', type=int,
+                        default=1000)
+    parser.add_argument('-c', '--columns', help='Number of values per instance.', type=int,
+                        default=100)
+    parser.add_argument('-n', '--number', help='Repetitions per measurement.', type=int,
+                        default=20)
+    args = parser.parse_args()
+
+    print(json.dumps([benchmark(library, args.rows, args.columns, args.number)
+                      for library in args.libraries.split(',')], indent=2))
@@ -0,0 +1,42 @@
+import argparse
+import json
+
+import requests
+
+BASE_URL = 'http://localhost:8080'
+
+
+def max_rss_bytes():
+    return json.loads(requests.get(BASE_URL + '/stats').content)['max_rss_bytes']
+
+
+def benchmark(rows, columns, requests_count):
+    payload = json.dumps({'instances': [[float(i)] * columns for i in range(rows)]}).encode()
+    # /stats answers from one gunicorn worker, run the container with a single worker
+    before = max_rss_bytes()
+    for _ in range(requests_count):
+        response = requests.post(BASE_URL + '/invocations', data=payload,
+                                 headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+    after = max_rss_bytes()
+    return {
+        'payload_bytes': len(payload),
+        'max_rss_bytes_before': before,
+        'max_rss_bytes_after': after,
+        'max_rss_growth_bytes': after - before,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measures the peak memory of a gunicorn worker serving large invocation '
+                    'payloads. Run against a container with SAGEMAKER_GUNICORN_WORKERS=1 '
+                    'listening on port 8080.')
+    parser.add_argument('-r', '--rows', help='Number of instances in the payload.', type=int,
+                        default=400000)
+    parser.add_argument('-c', '--columns', help='Number of values per instance.', type=int,
+                        default=8)
+    parser.add_argument('-n', '--requests', help='Number of invocations.', type=int, default=3)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.rows, args.columns, args.requests), indent=2))
@@ -0,0 +1,47 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BASE_URL = 'http://localhost:8080'
+
+
+def invoke(payload):
+    response = requests.post(BASE_URL + '/invocations', data=payload,
+                             headers={'Content-Type': 'application/json'})
+    response.raise_for_status()
+
+
+def benchmark(concurrency, requests_count, columns):
+    """Run once against a container with SAGEMAKER_MICRO_BATCHING=false and once with
+    SAGEMAKER_MICRO_BATCHING=true, serving a model with an input_handler/output_handler
+    inference.py, to compare both."""
+    payload = json.dumps({'instances': [[1.0] * columns]}).encode()
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(invoke, [payload] * requests_count))
+    seconds = time.time() - start
+    # /stats answers from one gunicorn worker
+    stats = json.loads(requests.get(BASE_URL + '/stats').content)
+    return {
+        'requests_per_second': round(requests_count / seconds, 1),
+        'ms_per_request': round(seconds / requests_count * 1000 * concurrency, 3),
+        'micro_batching': stats.get('micro_batching'),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measures the invocation throughput of concurrent single instance requests '
+                    'to a container listening on port 8080.')
+    parser.add_argument('-c', '--concurrency', help='Number of concurrent clients.', type=int,
+                        default=32)
+    parser.add_argument('-n', '--requests', help='Number of invocations.', type=int,
+                        default=2000)
+    parser.add_argument('--columns', help='Number of values per instance.', type=int,
+                        default=8)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.concurrency, args.requests, args.columns), indent=2))
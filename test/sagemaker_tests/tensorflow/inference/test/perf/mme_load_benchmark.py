@@ -0,0 +1,59 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+MODELS_URL = 'http://localhost:8080/models'
+
+
+def load_model(name, url):
+    start = time.time()
+    response = requests.post(MODELS_URL, data=json.dumps({'model_name': name, 'url': url}))
+    return response.status_code, time.time() - start
+
+
+def unload_model(name):
+    start = time.time()
+    response = requests.delete('{}/{}'.format(MODELS_URL, name))
+    return response.status_code, time.time() - start
+
+
+def _run(executor, fn, args):
+    start = time.time()
+    results = list(executor.map(lambda a: fn(*a), args))
+    elapsed = time.time() - start
+    failed = [code for code, _ in results if code != 200]
+    latencies = sorted(latency for _, latency in results)
+    return {
+        'count': len(results),
+        'failed': len(failed),
+        'seconds': round(elapsed, 3),
+        'per_second': round(len(results) / elapsed, 3),
+        'p50_seconds': round(latencies[len(latencies) // 2], 3),
+        'max_seconds': round(latencies[-1], 3),
+    }
+
+
+def benchmark(model_url, count, concurrency):
+    names = ['benchmark_model_{}'.format(i) for i in range(count)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        loads = _run(executor, load_model, [(name, model_url) for name in names])
+        unloads = _run(executor, unload_model, [(name,) for name in names])
+    return {'load': loads, 'unload': unloads}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measures concurrent load/unload throughput of a running multi-model endpoint '
+                    'container (SAGEMAKER_MULTI_MODEL=true, listening on port 8080).')
+    parser.add_argument('-u', '--model-url', help='Model path inside the container.', type=str,
+                        default='/opt/ml/models/half_plus_two')
+    parser.add_argument('-n', '--count', help='Number of models to load and unload.', type=int,
+                        default=20)
+    parser.add_argument('-c', '--concurrency', help='Number of concurrent requests.', type=int,
+                        default=4)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.model_url, args.count, args.concurrency), indent=2))
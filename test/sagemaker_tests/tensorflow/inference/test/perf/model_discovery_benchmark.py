@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+SAGEMAKER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..',
+                             '..', '..', 'tensorflow', 'inference', 'docker', 'build_artifacts',
+                             'sagemaker')
+
+
+def create_models(base_path, model_count, version_count, variable_files):
+    for i in range(model_count):
+        for version in range(1, version_count + 1):
+            version_dir = os.path.join(base_path, 'model-{}'.format(i), str(version))
+            os.makedirs(os.path.join(version_dir, 'variables'))
+            os.makedirs(os.path.join(version_dir, 'assets'))
+            open(os.path.join(version_dir, 'saved_model.pb'), 'w').close()
+            for j in range(variable_files):
+                open(os.path.join(version_dir, 'variables',
+                                  'variables.data-{:05d}-of-{:05d}'.format(j, variable_files)),
+                     'w').close()
+
+
+def _saved_model_files(path):
+    for e in os.scandir(path):
+        if e.is_dir():
+            yield from _saved_model_files(os.path.join(path, e.name))
+        elif e.name == 'saved_model.pb':
+            yield os.path.join(path, e.name)
+
+
+def legacy_find_models(base_path):
+    """Model discovery before the ModelScanner: a full walk, then a listdir per model"""
+    models = []
+    for f in _saved_model_files(base_path):
+        parts = f.split('/')
+        if len(parts) >= 6 and re.match(r'^\d+$', parts[-2]):
+            model_path = '/'.join(parts[0:-2])
+            if model_path not in models:
+                models.append(model_path)
+    versions = {m: [v for v in os.listdir(m) if v.isnumeric()] for m in models}
+    return models, versions
+
+
+def scan(scanner):
+    models = scanner.find_models()
+    versions = {m: scanner.find_model_versions(m) for m in models}
+    return models, versions
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return round(time.time() - start, 4), result
+
+
+def benchmark(model_count, version_count, variable_files):
+    sys.path.insert(0, SAGEMAKER_DIR)
+    import tfs_utils
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        base_path = os.path.join(work_dir, 'opt', 'ml', 'model')
+        index_file = os.path.join(work_dir, 'model-index.json')
+        create_models(base_path, model_count, version_count, variable_files)
+
+        results = {'models': model_count, 'versions': version_count}
+        results['legacy_seconds'], expected = timed(legacy_find_models, base_path)
+
+        scanner = tfs_utils.ModelScanner(base_path, index_file)
+        results['cold_scan_seconds'], found = timed(scan, scanner)
+        assert sorted(found[0]) == sorted(expected[0]), 'models differ from the legacy walk'
+        results['warm_scan_seconds'], _ = timed(scan, scanner)
+
+        restarted = tfs_utils.ModelScanner(base_path, index_file)
+        results['restart_scan_seconds'], found = timed(scan, restarted)
+        assert sorted(found[0]) == sorted(expected[0]), 'models differ after a restart'
+
+        new_version = os.path.join(base_path, 'model-0', str(version_count + 1))
+        os.makedirs(new_version)
+        open(os.path.join(new_version, 'saved_model.pb'), 'w').close()
+        results['changed_scan_seconds'], found = timed(scan, restarted)
+        assert str(version_count + 1) in found[1][os.path.join(base_path, 'model-0')], \
+            'added version not found'
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measures model discovery in /opt/ml/model over a synthetic tree of '
+                    'SavedModel bundles: the legacy full walk, a first scan, a rescan, a scan '
+                    'after a restart using the model index file, and a rescan after a version '
+                    'is added.')
+    parser.add_argument('-m', '--models', help='Number of models.', type=int, default=10000)
+    parser.add_argument('-v', '--versions', help='Versions per model.', type=int, default=1)
+    parser.add_argument('-f', '--variable-files', help='Variable shards per version.', type=int,
+                        default=2)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.models, args.versions, args.variable_files), indent=2))
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import subprocess
+import time
+
+import requests
+
+CONTAINER_NAME = 'sagemaker-tensorflow-serving-startup-benchmark'
+PING_URL = 'http://localhost:8080/ping'
+
+
+def start_container(image, model_dir, instance_count):
+    command = (
+        'docker run -d --name {} -p 8080:8080'
+        ' --mount type=bind,source={},target=/opt/ml/model,readonly'
+        ' -e SAGEMAKER_BIND_TO_PORT=8080'
+        ' -e SAGEMAKER_SAFE_PORT_RANGE=9000-9999'
+        ' -e SAGEMAKER_TFS_INSTANCE_COUNT={}'
+        ' {} serve'
+    ).format(CONTAINER_NAME, os.path.abspath(model_dir), instance_count, image)
+    subprocess.check_call(command.split(), stdout=subprocess.DEVNULL)
+
+
+def remove_container():
+    subprocess.call('docker rm -f {}'.format(CONTAINER_NAME).split(),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def seconds_to_first_ping(image, model_dir, instance_count, timeout_seconds):
+    remove_container()
+    start = time.time()
+    start_container(image, model_dir, instance_count)
+    try:
+        while time.time() - start < timeout_seconds:
+            try:
+                if requests.get(PING_URL, timeout=1).status_code == 200:
+                    return time.time() - start
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.01)
+        raise TimeoutError('container did not answer /ping within {} seconds'.format(
+            timeout_seconds))
+    finally:
+        remove_container()
+
+
+def benchmark(image, model_dir, instance_count, runs, timeout_seconds):
+    results = sorted(seconds_to_first_ping(image, model_dir, instance_count, timeout_seconds)
+                     for _ in range(runs))
+    return {
+        'instance_count': instance_count,
+        'runs': runs,
+        'min_seconds': round(results[0], 3),
+        'p50_seconds': round(results[len(results) // 2], 3),
+        'max_seconds': round(results[-1], 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measures the cold start time of the serving container, from docker run to '
+                    'the first successful /ping.')
+    parser.add_argument('-i', '--image', help='Serving image, e.g. sagemaker-tensorflow-serving:'
+                                              '2.1.0-cpu', type=str, required=True)
+    parser.add_argument('-m', '--model-dir', help='Host directory mounted as /opt/ml/model.',
+                        type=str, default='test/resources/models')
+    parser.add_argument('-n', '--instance-count', help='SAGEMAKER_TFS_INSTANCE_COUNT.', type=int,
+                        default=1)
+    parser.add_argument('-r', '--runs', help='Number of container starts.', type=int, default=5)
+    parser.add_argument('-t', '--timeout', help='Seconds to wait for each start.', type=int,
+                        default=300)
+    args = parser.parse_args()
+
+    print(json.dumps(benchmark(args.image, args.model_dir, args.instance_count, args.runs,
+                               args.timeout), indent=2))
@@ -0,0 +1,25 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+import os
+import sys
+
+# the modules of /sagemaker in the container, tested without docker
+SAGEMAKER_DIR = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__),
+        '..', '..', '..', '..', '..', '..',
+        'tensorflow', 'inference', 'docker', 'build_artifacts', 'sagemaker',
+    )
+)
+sys.path.insert(0, SAGEMAKER_DIR)
@@ -0,0 +1,156 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from admission_utils import (
+    AdmissionControl,
+    AsyncAdmissionControl,
+    Overloaded,
+    admission_control_from_env,
+)
+
+
+def test_disabled():
+    admission_control = AdmissionControl()
+
+    with admission_control.admit('m'):
+        with admission_control.admit('m'):
+            pass
+    assert not admission_control.enabled
+
+
+def test_rejects_over_concurrency():
+    admission_control = AdmissionControl(max_concurrency=1, retry_after_seconds=3)
+
+    with admission_control.admit('m'):
+        with pytest.raises(Overloaded) as e:
+            with admission_control.admit('m'):
+                pass
+        # the limits are per model
+        with admission_control.admit('n'):
+            pass
+
+    assert e.value.reason == 'concurrency'
+    assert e.value.retry_after_seconds == 3
+    with admission_control.admit('m'):
+        pass
+    stats = admission_control.stats()
+    assert stats['rejected'] == {'concurrency': 1, 'queue_timeout': 0}
+    # the entries of idle models are dropped
+    assert stats['models'] == {}
+
+
+def test_queued_invocation_admitted_on_release():
+    admission_control = AdmissionControl(max_concurrency=1, max_queue=1, queue_timeout_seconds=5)
+    admitted = threading.Event()
+
+    def _invoke():
+        with admission_control.admit('m'):
+            admitted.set()
+
+    with admission_control.admit('m'):
+        thread = threading.Thread(target=_invoke)
+        thread.start()
+        while admission_control.stats()['models']['m']['queued'] == 0:
+            time.sleep(0.001)
+        # the queue is full
+        with pytest.raises(Overloaded):
+            with admission_control.admit('m'):
+                pass
+        assert not admitted.is_set()
+    thread.join(5)
+
+    assert admitted.is_set()
+
+
+def test_queue_timeout():
+    admission_control = AdmissionControl(max_concurrency=1, max_queue=1, queue_timeout_seconds=0.05)
+
+    with admission_control.admit('m'):
+        with pytest.raises(Overloaded) as e:
+            with admission_control.admit('m'):
+                pass
+
+    assert e.value.reason == 'queue_timeout'
+    assert admission_control.stats()['models'] == {}
+
+
+def test_async_admission_control():
+    admission_control = AsyncAdmissionControl(
+        max_concurrency=2, max_queue=1, queue_timeout_seconds=5
+    )
+
+    async def _invoke(results):
+        try:
+            release = await admission_control.admit_async('m')
+        except Overloaded as e:
+            results.append(e.reason)
+            return
+        await asyncio.sleep(0.05)
+        await release()
+        results.append('admitted')
+
+    async def _main():
+        results = []
+        await asyncio.gather(*[_invoke(results) for _ in range(4)])
+        return results
+
+    # two run at once, one waits for them, the fourth does not fit in the queue
+    assert sorted(asyncio.run(_main())) == ['admitted', 'admitted', 'admitted', 'concurrency']
+    assert admission_control.stats()['models'] == {}
+
+
+def test_async_queue_timeout():
+    admission_control = AsyncAdmissionControl(
+        max_concurrency=1, max_queue=1, queue_timeout_seconds=0.05
+    )
+
+    async def _main():
+        release = await admission_control.admit_async('m')
+        try:
+            await admission_control.admit_async('m')
+        finally:
+            await release()
+
+    with pytest.raises(Overloaded) as e:
+        asyncio.run(_main())
+    assert e.value.reason == 'queue_timeout'
+    assert admission_control.stats()['models'] == {}
+
+
+def test_stats_of_active_models():
+    admission_control = AdmissionControl(max_concurrency=2)
+
+    with admission_control.admit('m'):
+        with admission_control.admit('m'):
+            assert admission_control.stats()['models'] == {'m': {'in_flight': 2, 'queued': 0}}
+        assert admission_control.stats()['models'] == {'m': {'in_flight': 1, 'queued': 0}}
+    assert admission_control.stats()['models'] == {}
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv('SAGEMAKER_MAX_CONCURRENT_INVOCATIONS_PER_MODEL', '4')
+    monkeypatch.setenv('SAGEMAKER_MAX_QUEUED_INVOCATIONS_PER_MODEL', '8')
+    monkeypatch.setenv('SAGEMAKER_INVOCATION_QUEUE_TIMEOUT_SECONDS', '0.5')
+
+    stats = admission_control_from_env().stats()
+
+    assert (stats['max_concurrency'], stats['max_queue']) == (4, 8)
+    assert stats['queue_timeout_seconds'] == 0.5
+    assert isinstance(admission_control_from_env(asynchronous=True), AsyncAdmissionControl)
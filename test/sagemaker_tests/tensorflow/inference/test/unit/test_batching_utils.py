@@ -0,0 +1,151 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from batching_utils import MicroBatcher
+from tfs_utils import Context
+
+REST_URI = 'http://localhost:8501/v1/models/half_plus_three:predict'
+
+
+def _context(custom_attributes=None):
+    return Context('half_plus_three', None, 'predict', REST_URI, '9000', None,
+                   custom_attributes, 'application/json', 'application/json', None)
+
+
+def _response(status_code, payload):
+    response = requests.models.Response()
+    response.status_code = status_code
+    response._content = json.dumps(payload).encode('utf-8')
+    return response
+
+
+class FakeTfs(object):
+    """Doubles the instances. The first request blocks until released, so that the next
+    requests are batched while it is in flight.
+    """
+
+    def __init__(self, error=None):
+        self.bodies = []
+        self.release = threading.Event()
+        self._error = error
+
+    def send(self, body, context):
+        self.bodies.append(json.loads(body))
+        if len(self.bodies) == 1:
+            self.release.wait(5)
+        if self._error is not None:
+            raise self._error
+        instances = json.loads(body)['instances']
+        return _response(200, {'predictions': [i * 2 for i in instances]})
+
+
+def _predict_concurrently(batcher, tfs, bodies, context=None):
+    results = [None] * len(bodies)
+
+    def _predict(index):
+        try:
+            response = batcher.predict(bodies[index], context or _context(), tfs.send)
+            results[index] = json.loads(response.content)['predictions']
+        except Exception as e:  # pylint: disable=broad-except
+            results[index] = e
+
+    first = threading.Thread(target=_predict, args=(0,))
+    first.start()
+    while not tfs.bodies:
+        time.sleep(0.001)
+    others = [threading.Thread(target=_predict, args=(i,)) for i in range(1, len(bodies))]
+    for thread in others:
+        thread.start()
+    time.sleep(0.1)
+    tfs.release.set()
+    for thread in [first] + others:
+        thread.join(5)
+    return results
+
+
+def test_lone_request_sent_as_is():
+    tfs = FakeTfs()
+    tfs.release.set()
+    body = '{"instances": [1, 2]}'
+
+    response = MicroBatcher().predict(body, _context(), tfs.send)
+
+    assert json.loads(response.content) == {'predictions': [2, 4]}
+    assert tfs.bodies == [json.loads(body)]
+
+
+@pytest.mark.parametrize('body', ['{"inputs": [1]}', '{"instances": 1}', 'not json'])
+def test_other_bodies_not_batched(body):
+    sent = []
+    MicroBatcher().predict(body, _context(), lambda b, c: sent.append(b))
+
+    assert sent == [body]
+
+
+def test_concurrent_requests_batched_while_busy():
+    tfs = FakeTfs()
+    batcher = MicroBatcher(max_batch_size=32, window_seconds=0.5)
+    bodies = ['{{"instances": [{}, {}]}}'.format(i, i + 10) for i in range(4)]
+
+    results = _predict_concurrently(batcher, tfs, bodies)
+
+    assert results == [[2 * i, 2 * (i + 10)] for i in range(4)]
+    # the first request, then one batch of the three others
+    assert len(tfs.bodies) == 2
+    assert sorted(tfs.bodies[1]['instances']) == [1, 2, 3, 11, 12, 13]
+    assert batcher.stats()['batches'] == 2
+    assert batcher.stats()['requests'] == 4
+
+
+def test_different_custom_attributes_not_batched():
+    tfs = FakeTfs()
+    batcher = MicroBatcher(max_batch_size=32, window_seconds=0.2)
+    sent = []
+
+    def _predict(body, custom_attributes):
+        context = _context(custom_attributes)
+        sent.append(batcher.predict(body, context, tfs.send))
+
+    first = threading.Thread(target=_predict, args=('{"instances": [0]}', None))
+    first.start()
+    while not tfs.bodies:
+        time.sleep(0.001)
+    others = [
+        threading.Thread(target=_predict, args=('{"instances": [1]}', 'tfs-cache=false')),
+        threading.Thread(target=_predict, args=('{"instances": [2]}', 'tfs-protocol=grpc')),
+    ]
+    for thread in others:
+        thread.start()
+    tfs.release.set()
+    for thread in [first] + others:
+        thread.join(5)
+
+    assert sorted(body['instances'] for body in tfs.bodies) == [[0], [1], [2]]
+
+
+def test_send_error_raised_in_every_request():
+    tfs = FakeTfs(error=requests.ConnectionError('connection refused'))
+    batcher = MicroBatcher(max_batch_size=32, window_seconds=0.5)
+    bodies = ['{{"instances": [{}]}}'.format(i) for i in range(4)]
+
+    results = _predict_concurrently(batcher, tfs, bodies)
+
+    assert all(isinstance(result, requests.ConnectionError) for result in results)
@@ -0,0 +1,113 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+
+import time
+
+import pytest
+
+from cache_utils import ResponseCache, request_key
+from multi_model_utils import SharedState
+
+
+@pytest.fixture
+def state(tmp_path):
+    return SharedState(str(tmp_path / 'cache.db'))
+
+
+def test_request_key_ignores_instance():
+    key = request_key('http://localhost:8501/v1/models/m:predict', b'{}')
+
+    assert key == request_key('http://localhost:8511/v1/models/m:predict', b'{}')
+    assert key != request_key('http://localhost:8501/v1/models/m:predict', b'{"a": 1}')
+    assert key != request_key('http://localhost:8501/v1/models/n:predict', b'{}')
+
+
+def test_get_and_put(state):
+    cache = ResponseCache(state)
+
+    assert cache.get('k') is None
+    cache.put('k', 'm', 200, b'{"predictions": [1]}')
+    assert cache.get('k') == (200, b'{"predictions": [1]}')
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['stores']) == (1, 1, 1)
+    assert stats['entries'] == 1
+    assert stats['hit_ratio'] == 0.5
+
+
+def test_get_does_not_write(state):
+    cache = ResponseCache(state, flush_seconds=60)
+    cache.put('k', 'm', 200, b'x')
+
+    transaction = state.transaction
+    state.transaction = None
+    try:
+        for _ in range(10):
+            assert cache.get('k') == (200, b'x')
+    finally:
+        state.transaction = transaction
+    assert cache.stats()['hits'] == 10
+
+
+def test_shared_by_workers(tmp_path):
+    ResponseCache(SharedState(str(tmp_path / 'cache.db'))).put('k', 'm', 200, b'x')
+
+    assert ResponseCache(SharedState(str(tmp_path / 'cache.db'))).get('k') == (200, b'x')
+
+
+def test_expired_response(state):
+    cache = ResponseCache(state, ttl_seconds=0.05)
+    cache.put('k', 'm', 200, b'x')
+    time.sleep(0.1)
+
+    assert cache.get('k') is None
+    cache.put('other', 'm', 200, b'y')
+    stats = cache.stats()
+    assert stats['expirations'] == 1
+    assert stats['entries'] == 1
+
+
+def test_evicts_least_recently_used(state):
+    cache = ResponseCache(state, max_entries=3, flush_seconds=60)
+    for key in ['a', 'b', 'c']:
+        cache.put(key, 'm', 200, key.encode())
+        time.sleep(0.01)
+    # the access is written with the next put, before evicting
+    assert cache.get('a') is not None
+    cache.put('d', 'm', 200, b'd')
+
+    assert cache.get('b') is None
+    assert [cache.get(key) is not None for key in ['a', 'c', 'd']] == [True, True, True]
+    assert cache.stats()['evictions'] == 1
+
+
+def test_evicts_by_size(state):
+    cache = ResponseCache(state, max_bytes=10)
+    cache.put('large', 'm', 200, b'x' * 11)
+    cache.put('a', 'm', 200, b'x' * 6)
+    cache.put('b', 'm', 200, b'x' * 6)
+
+    assert cache.get('large') is None
+    assert cache.get('a') is None
+    assert cache.get('b') == (200, b'x' * 6)
+
+
+def test_invalidate_model(state):
+    cache = ResponseCache(state)
+    cache.put('a', 'm', 200, b'a')
+    cache.put('b', 'n', 200, b'b')
+    cache.invalidate('m')
+
+    assert cache.get('a') is None
+    assert cache.get('b') == (200, b'b')
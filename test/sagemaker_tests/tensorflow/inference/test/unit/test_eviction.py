@@ -0,0 +1,79 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+
+import pytest
+
+from multi_model_utils import LruEviction, ModelRegistry, SharedState
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return ModelRegistry(SharedState(str(tmp_path / 'state.db')))
+
+
+def _load(registry, model_name, size_bytes, rest_port):
+    registry.reserve(model_name, '/opt/ml/models/' + model_name, size_bytes)
+    registry.assign(model_name, [(rest_port, rest_port + 1)], size_bytes)
+    registry.set_available(model_name, rest_port, rest_port + 1, None)
+
+
+def test_max_models_counts_loading_models(registry):
+    eviction = LruEviction(registry, max_models=2, consolidated=True)
+    _load(registry, 'a', 1, 9000)
+    # another worker is loading b
+    registry.reserve('b', '/opt/ml/models/b', 1)
+
+    registry.reserve('c', '/opt/ml/models/c', 1)
+    assert eviction.over_budget(None, 'c', 1)
+
+    registry.remove('b')
+    assert not eviction.over_budget(None, 'c', 1)
+
+
+def test_memory_budget_counts_loading_and_incoming_models(registry):
+    eviction = LruEviction(registry, memory_budget_bytes=100, consolidated=True)
+    _load(registry, 'a', 40, 9000)
+    registry.reserve('b', '/opt/ml/models/b', 40)
+
+    registry.reserve('c', '/opt/ml/models/c', 20)
+    assert not eviction.over_budget(None, 'c', 20)
+    registry.remove('c')
+
+    registry.reserve('c', '/opt/ml/models/c', 30)
+    assert eviction.over_budget(None, 'c', 30)
+
+
+def test_model_larger_than_memory_budget(registry):
+    eviction = LruEviction(registry, memory_budget_bytes=100, consolidated=True)
+    registry.reserve('a', '/opt/ml/models/a', 101)
+
+    assert eviction.over_budget(None, 'a', 101)
+    assert eviction.pick_victim() is None
+
+
+def test_unloading_models_are_not_counted(registry):
+    eviction = LruEviction(registry, max_models=1, consolidated=True)
+    _load(registry, 'a', 1, 9000)
+    registry.reserve('b', '/opt/ml/models/b', 1)
+    assert eviction.over_budget(None, 'b', 1)
+
+    assert registry.claim('a')
+    assert not eviction.over_budget(None, 'b', 1)
+
+
+def test_no_free_ports(registry):
+    eviction = LruEviction(registry)
+
+    assert eviction.over_budget(0, 'a', 1)
+    assert not eviction.over_budget(1, 'a', 1)
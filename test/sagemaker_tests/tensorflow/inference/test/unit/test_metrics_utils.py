@@ -0,0 +1,107 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+
+import json
+import os
+import subprocess
+import sys
+
+from metrics_utils import Metrics, collect, metric_key, render
+
+
+def test_render_counter_and_gauge():
+    values = {
+        metric_key('sagemaker_invocations_total', {'model': 'm', 'status': '200'}): 3,
+        metric_key('sagemaker_tfs_in_flight_requests', {'port': 8501}): 1,
+    }
+
+    assert render(values, [0.1]).splitlines() == [
+        '# HELP sagemaker_invocations_total Invocations by model and HTTP status.',
+        '# TYPE sagemaker_invocations_total counter',
+        'sagemaker_invocations_total{model="m",status="200"} 3',
+        '# HELP sagemaker_tfs_in_flight_requests Requests being processed by TFS, by port.',
+        '# TYPE sagemaker_tfs_in_flight_requests gauge',
+        'sagemaker_tfs_in_flight_requests{port="8501"} 1',
+    ]
+
+
+def test_render_histogram_buckets_are_cumulative():
+    key = metric_key('sagemaker_model_load_duration_seconds', {'status': '200'})
+    values = {key: {'buckets': [1, 0, 2], 'sum': 1.5, 'count': 4}}
+
+    lines = render(values, [0.1, 0.5, 1.0]).splitlines()
+
+    assert lines[1] == '# TYPE sagemaker_model_load_duration_seconds histogram'
+    assert lines[2:] == [
+        'sagemaker_model_load_duration_seconds_bucket{status="200",le="0.1"} 1',
+        'sagemaker_model_load_duration_seconds_bucket{status="200",le="0.5"} 1',
+        'sagemaker_model_load_duration_seconds_bucket{status="200",le="1.0"} 3',
+        'sagemaker_model_load_duration_seconds_bucket{status="200",le="+Inf"} 4',
+        'sagemaker_model_load_duration_seconds_sum{status="200"} 1.5',
+        'sagemaker_model_load_duration_seconds_count{status="200"} 4',
+    ]
+
+
+def test_render_escapes_label_values():
+    values = {metric_key('sagemaker_invocations_total', {'model': 'a"b', 'status': '200'}): 1}
+
+    assert 'sagemaker_invocations_total{model="a\\"b",status="200"} 1' in render(values, [])
+
+
+def test_invocation_phases(tmp_path):
+    metrics = Metrics(metrics_dir=str(tmp_path))
+    with metrics.invocation('m') as status:
+        with metrics.tfs_call(8501):
+            # nested TFS calls are counted once
+            with metrics.tfs_call(8501):
+                pass
+        status[0] = '200'
+
+    values = metrics._values
+    assert values[metric_key('sagemaker_invocations_total', {'model': 'm', 'status': '200'})] == 1
+    assert values[metric_key('sagemaker_tfs_in_flight_requests', {'port': 8501})] == 0
+    for phase in ['pre_process', 'tfs', 'post_process', 'total']:
+        labels = {'model': 'm', 'phase': phase}
+        assert values[metric_key('sagemaker_invocation_duration_seconds', labels)]['count'] == 1
+
+
+def test_collect_adds_up_processes(tmp_path):
+    metrics_dir = str(tmp_path)
+    for name in ['a', 'b']:
+        metrics = Metrics(metrics_dir=metrics_dir, name=name, buckets=[1.0])
+        metrics.inc('sagemaker_invocations_total', {'model': 'm', 'status': '200'}, 2)
+        metrics.inc('sagemaker_tfs_in_flight_requests', {'port': 8501})
+        metrics.observe('sagemaker_model_load_duration_seconds', {'status': '200'}, 0.5)
+        metrics.flush()
+    # an exited process: its counters and histograms are kept, not its gauges
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    snapshot = {
+        'pid': exited.pid,
+        'buckets': [1.0],
+        'values': [
+            [metric_key('sagemaker_invocations_total', {'model': 'm', 'status': '200'}), 5],
+            [metric_key('sagemaker_tfs_in_flight_requests', {'port': 8501}), 7],
+        ],
+    }
+    with open(os.path.join(metrics_dir, 'exited.json'), 'w') as f:
+        json.dump(snapshot, f)
+
+    values, buckets = collect(metrics_dir)
+
+    assert buckets == [1.0]
+    assert values[metric_key('sagemaker_invocations_total', {'model': 'm', 'status': '200'})] == 9
+    assert values[metric_key('sagemaker_tfs_in_flight_requests', {'port': 8501})] == 2
+    histogram = values[metric_key('sagemaker_model_load_duration_seconds', {'status': '200'})]
+    assert histogram == {'buckets': [2], 'sum': 1.0, 'count': 2}
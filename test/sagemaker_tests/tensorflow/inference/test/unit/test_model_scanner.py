@@ -0,0 +1,97 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+
+import os
+import shutil
+
+import pytest
+
+import tfs_utils
+from tfs_utils import ModelScanner
+
+
+def _add_version(base_path, model, version):
+    version_dir = os.path.join(base_path, model, version)
+    os.makedirs(os.path.join(version_dir, 'variables'))
+    open(os.path.join(version_dir, 'saved_model.pb'), 'w').close()
+    # not a model, the variables of a version are not searched
+    open(os.path.join(version_dir, 'variables', 'saved_model.pb'), 'w').close()
+
+
+@pytest.fixture
+def base_path(tmp_path):
+    base_path = str(tmp_path / 'model')
+    _add_version(base_path, 'a', '1')
+    _add_version(base_path, 'a', '002')
+    _add_version(base_path, 'b', '1')
+    os.makedirs(os.path.join(base_path, 'a', 'not_a_version'))
+    os.makedirs(os.path.join(base_path, 'c', '1'))
+    return base_path
+
+
+def test_find_models(base_path):
+    scanner = ModelScanner(base_path)
+
+    models = scanner.find_models()
+
+    assert sorted(models) == [os.path.join(base_path, 'a'), os.path.join(base_path, 'b')]
+    assert sorted(scanner.find_model_versions(os.path.join(base_path, 'a'))) == ['1', '2']
+
+
+def test_rescan_finds_changes(base_path):
+    scanner = ModelScanner(base_path)
+    scanner.find_models()
+
+    _add_version(base_path, 'a', '3')
+    _add_version(base_path, 'd', '1')
+    shutil.rmtree(os.path.join(base_path, 'b'))
+    models = scanner.find_models()
+
+    assert sorted(models) == [os.path.join(base_path, 'a'), os.path.join(base_path, 'd')]
+    assert sorted(scanner.find_model_versions(os.path.join(base_path, 'a'))) == ['1', '2', '3']
+
+
+def test_rescan_only_lists_changed_directories(base_path, monkeypatch):
+    scanner = ModelScanner(base_path)
+    scanner.find_models()
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(tfs_utils.os, 'scandir', lambda path: scanned.append(path) or scandir(path))
+
+    scanner.find_models()
+    assert scanned == []
+
+    _add_version(base_path, 'b', '2')
+    scanner.find_models()
+    assert scanned == [os.path.join(base_path, 'b'), os.path.join(base_path, 'b', '2')]
+
+
+def test_index_file_kept_across_restarts(base_path, tmp_path, monkeypatch):
+    index_file = str(tmp_path / 'index.json')
+    models = ModelScanner(base_path, index_file).find_models()
+    scanned = []
+    scandir = os.scandir
+    monkeypatch.setattr(tfs_utils.os, 'scandir', lambda path: scanned.append(path) or scandir(path))
+
+    assert ModelScanner(base_path, index_file).find_models() == models
+    assert scanned == []
+    # the index of another base path is not used
+    ModelScanner(str(tmp_path), index_file).find_models()
+    assert str(tmp_path) in scanned
+
+
+def test_unknown_model_versions_listed(tmp_path):
+    _add_version(str(tmp_path), 'a', '7')
+
+    assert ModelScanner(str(tmp_path)).find_model_versions(str(tmp_path / 'a')) == ['7']
@@ -0,0 +1,70 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+
+import json
+
+import numpy as np
+import pytest
+
+from tfs_utils import convert_request
+
+
+def _instances(request):
+    return json.loads(request)['instances']
+
+
+def test_numeric_csv_to_array():
+    instances = convert_request(b'1,2\n3,4\n', 'text/csv')
+
+    assert instances.dtype == np.int64
+    assert instances.tolist() == [[1, 2], [3, 4]]
+
+
+def test_single_column_csv_to_scalars():
+    instances = convert_request(b'1.5\n2\n', 'text/csv; charset=utf-8')
+
+    assert instances.dtype == np.float64
+    assert instances.tolist() == [1.5, 2.0]
+
+
+def test_ragged_csv_to_json():
+    assert _instances(convert_request(b'1,2\n3\n', 'text/csv')) == [[1, 2], 3]
+
+
+def test_string_csv_to_json():
+    assert _instances(convert_request(b'a,b\nc,d', 'text/csv')) == [['a', 'b'], ['c', 'd']]
+    assert _instances(convert_request(b'"x"\n', 'text/csv')) == ['x']
+
+
+@pytest.mark.parametrize('content_type', ['application/jsonlines', 'application/json'])
+def test_json_lines(content_type):
+    assert _instances(convert_request(b'{"a":1}\n{"a":2}', content_type)) == [{'a': 1}, {'a': 2}]
+    assert _instances(convert_request(b'[1,2]\n[3,4]\n', content_type)) == [[1, 2], [3, 4]]
+
+
+def test_tfs_json_unchanged():
+    body = b'{"signature_name": "s", "instances": [1, 2]}'
+
+    assert convert_request(body, 'application/json') is body
+
+
+def test_bare_json():
+    assert _instances(convert_request(b'[1,2]', 'application/json')) == [[1, 2]]
+    assert _instances(convert_request(b'[[1,2],[3,4]]', 'application/json')) == [[1, 2], [3, 4]]
+    assert _instances(convert_request(b'{"a":1}', 'application/json')) == [{'a': 1}]
+
+
+def test_unsupported_content_type():
+    assert convert_request(b'x', 'image/png') is None
+    assert convert_request(b'1,2', None) is None
@@ -0,0 +1,93 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+import pytest
+
+from routing_utils import TfsRouter
+
+
+def _router(policy, count=3):
+    ports = list(range(count))
+    return TfsRouter(['9{}'.format(p) for p in ports], ['8{}'.format(p) for p in ports], policy)
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        TfsRouter(['9000'], ['8501'], 'round_robin')
+
+
+def test_mismatched_ports():
+    with pytest.raises(ValueError):
+        TfsRouter(['9000', '9001'], ['8501'])
+
+
+def test_least_outstanding_spreads_requests():
+    router = _router('least_outstanding')
+    tickets = [router.acquire() for _ in range(6)]
+
+    assert sorted(instance.index for instance, _ in tickets) == [0, 0, 1, 1, 2, 2]
+    assert [i['in_flight'] for i in router.stats()['instances']] == [2, 2, 2]
+
+
+def test_least_outstanding_picks_released_instance():
+    router = _router('least_outstanding')
+    tickets = [router.acquire() for _ in range(3)]
+    router.release(tickets[1])
+
+    instance, _ = router.acquire()
+    assert instance.index == tickets[1][0].index
+
+
+def test_release_updates_in_flight_and_latency():
+    router = _router('least_outstanding', count=1)
+    instance, start_time = router.acquire()
+    router.release((instance, start_time - 0.1))
+
+    stats = router.stats()['instances'][0]
+    assert stats['in_flight'] == 0
+    assert stats['requests'] == 1
+    assert stats['ewma_latency_ms'] >= 100
+
+
+def test_ewma_prefers_faster_instance():
+    router = _router('ewma', count=2)
+    slow, fast = router._instances
+    slow.ewma_latency = 1.0
+    fast.ewma_latency = 0.01
+
+    for _ in range(10):
+        instance, _ = router.acquire()
+        assert instance is fast
+    # ten in-flight requests on the fast instance still score lower than one on the slow one
+    assert router.stats()['instances'][1]['in_flight'] == 10
+
+
+def test_ewma_moving_average():
+    router = TfsRouter(['9000'], ['8501'], 'ewma', ewma_alpha=0.5)
+    instance, start_time = router.acquire()
+    router.release((instance, start_time - 1.0))
+    instance, start_time = router.acquire()
+    router.release((instance, start_time))
+
+    assert instance.ewma_latency == pytest.approx(0.5, abs=0.05)
+
+
+def test_random_policy_uses_all_instances():
+    router = _router('random')
+    indexes = set()
+    for _ in range(200):
+        ticket = router.acquire()
+        indexes.add(ticket[0].index)
+        router.release(ticket)
+
+    assert indexes == {0, 1, 2}